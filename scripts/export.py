@@ -0,0 +1,23 @@
+import argparse
+from torchmdnet.export import export
+
+
+def get_args():
+    # fmt: off
+    parser = argparse.ArgumentParser(description='Export a checkpoint as a frozen TorchScript module for inference')
+    parser.add_argument('checkpoint', type=str, help='Path to the model checkpoint')
+    parser.add_argument('output', type=str, help='Path of the exported module')
+    parser.add_argument('--derivative', action='store_true', help='Whether the exported module computes forces')
+    parser.add_argument('--device', default='cpu', type=str, help='Device of the exported module')
+    # fmt: on
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    export(args.checkpoint, args.output, derivative=args.derivative, device=args.device)
+    print(f"Exported {args.checkpoint} to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
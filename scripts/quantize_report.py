@@ -0,0 +1,69 @@
+import argparse
+import os
+from os.path import dirname, exists, join
+import torch
+from torch_geometric.data import DataLoader
+from torchmdnet.data import DataModule
+from torchmdnet.models.model import load_model
+from torchmdnet.quantize import quantization_report, quantize_modes
+
+
+def get_args():
+    # fmt: off
+    parser = argparse.ArgumentParser(description='Compare a quantized model with the float32 model on the test split')
+    parser.add_argument('checkpoint', type=str, help='Path to the model checkpoint')
+    parser.add_argument('--quantize', default='dynamic-int8', type=str, choices=quantize_modes, help='Quantization mode')
+    parser.add_argument('--splits', default=None, type=str, help='Splits file of the training run, defaults to splits.npz next to the checkpoint')
+    parser.add_argument('--split', default='test', type=str, choices=['val', 'test'], help='Held-out split to evaluate on')
+    parser.add_argument('--batch-size', default=None, type=int, help='Batch size, defaults to the inference batch size of the training run')
+    parser.add_argument('--num-threads', default=None, type=int, help='Number of CPU threads')
+    parser.add_argument('--num-repeats', default=1, type=int, help='Number of passes over the split for the throughput measurement')
+    parser.add_argument('--log-dir', default='.', type=str, help='Directory the splits are written to if they have to be created')
+    # fmt: on
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    hparams = torch.load(args.checkpoint, map_location="cpu")["hyper_parameters"]
+    splits = args.splits or join(dirname(args.checkpoint), "splits.npz")
+    hparams = dict(
+        hparams,
+        splits=splits if exists(splits) else hparams["splits"],
+        log_dir=args.log_dir,
+        # the model contains the standardization of the training run
+        standardize=False,
+        derivative=False,
+        position_noise_scale=0.0,
+    )
+    if args.batch_size is not None:
+        hparams["inference_batch_size"] = args.batch_size
+    elif hparams["inference_batch_size"] is None:
+        hparams["inference_batch_size"] = hparams["batch_size"]
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    data = DataModule(hparams)
+    data.prepare_data()
+    data.setup("test")
+    loader = DataLoader(
+        getattr(data, f"{args.split}_dataset"),
+        batch_size=hparams["inference_batch_size"],
+        num_workers=hparams["num_workers"],
+    )
+
+    reference = load_model(args.checkpoint, derivative=False)
+    quantized = load_model(args.checkpoint, derivative=False, quantize=args.quantize)
+    report = quantization_report(
+        reference, quantized, loader, num_repeats=args.num_repeats
+    )
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    speedup = report["int8_samples_per_second"] / report["fp32_samples_per_second"]
+    print(f"speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,7 @@ from torchmdnet.module import LNNP
 from torchmdnet import datasets, priors, models
 from torchmdnet.data import DataModule
 from torchmdnet.models import output_modules
-from torchmdnet.models.utils import rbf_class_mapping, act_class_mapping
+from torchmdnet.models.utils import rbf_class_mapping, act_class_mapping, neighbor_list_options
 from torchmdnet.utils import LoadFromFile, LoadFromCheckpoint, save_argparse, number
 from pathlib import Path
 import wandb
@@ -27,6 +27,9 @@ def get_args():
     parser.add_argument('--num-steps', default=None, type=int, help='Maximum number of gradient steps.')
     parser.add_argument('--batch-size', default=32, type=int, help='batch size')
     parser.add_argument('--inference-batch-size', default=None, type=int, help='Batchsize for validation and tests.')
+    parser.add_argument('--batch-budget', default=None, type=int, help='If set, training batches are packed up to this many atoms (or edges, see --batch-budget-type) instead of using --batch-size')
+    parser.add_argument('--batch-budget-type', default='atoms', type=str, choices=['atoms', 'edges'], help='Whether the batch budget counts atoms or an estimate of the number of edges')
+    parser.add_argument('--batch-bucket-size', default=None, type=int, help='If set, groups of this many samples are sorted by size before packing batches, so batches contain molecules of similar size')
     parser.add_argument('--lr', default=1e-4, type=float, help='learning rate')
     parser.add_argument('--lr-schedule', default="reduce_on_plateau", type=str, choices=['cosine', 'reduce_on_plateau'], help='Learning rate schedule.')
     parser.add_argument('--lr-patience', type=int, default=10, help='Patience for lr-schedule. Patience per eval-interval of validation')
@@ -83,6 +86,7 @@ def get_args():
     parser.add_argument('--activation', type=str, default='silu', choices=list(act_class_mapping.keys()), help='Activation function')
     parser.add_argument('--rbf-type', type=str, default='expnorm', choices=list(rbf_class_mapping.keys()), help='Type of distance expansion')
     parser.add_argument('--trainable-rbf', type=bool, default=False, help='If distance expansion functions should be trainable')
+    parser.add_argument('--rbf-table-size', type=int, default=None, help='If set, tabulate the distance expansion on this many points and interpolate it (requires non-trainable RBFs)')
     parser.add_argument('--neighbor-embedding', type=bool, default=False, help='If a neighbor embedding should be applied before interactions')
     parser.add_argument('--aggr', type=str, default='add', help='Aggregation operation for CFConv filter output. Must be one of \'add\', \'mean\', or \'max\'')
 
@@ -91,6 +95,8 @@ def get_args():
     parser.add_argument('--attn-activation', default='silu', choices=list(act_class_mapping.keys()), help='Attention activation function')
     parser.add_argument('--num-heads', type=int, default=8, help='Number of attention heads')
     parser.add_argument('--layernorm-on-vec', type=str, default=None, choices=['whitened'], help='Whether to apply an equivariant layer norm to vec features. Off by default.')
+    parser.add_argument('--fuse-edge-projections', type=bool, default=False, help='If true, compute the distance projections of all layers in one matrix multiplication (equivariant-transformer only)')
+    parser.add_argument('--edge-chunk-size', type=int, default=None, help='Number of edges whose messages are computed at once, to bound memory on large systems (equivariant-transformer only)')
 
     # other args
     parser.add_argument('--derivative', default=False, type=bool, help='If true, take the derivative of the prediction w.r.t coordinates')
@@ -99,6 +105,9 @@ def get_args():
     parser.add_argument('--atom-filter', type=int, default=-1, help='Only sum over atoms with Z > atom_filter')
     parser.add_argument('--max-z', type=int, default=100, help='Maximum atomic number that fits in the embedding matrix')
     parser.add_argument('--max-num-neighbors', type=int, default=32, help='Maximum number of neighbors to consider in the network')
+    parser.add_argument('--neighbor-list', type=str, default='radius_graph', choices=neighbor_list_options, help='Neighbor search algorithm. The cell list scales linearly with the number of atoms')
+    parser.add_argument('--adaptive-max-num-neighbors', type=bool, default=False, help='If true, double max-num-neighbors whenever an atom reaches it instead of dropping neighbors')
+    parser.add_argument('--half-list', type=bool, default=False, help='If true, compute pair-symmetric edge features once per atom pair (graph-network and transformer only)')
     parser.add_argument('--standardize', type=bool, default=False, help='If true, multiply prediction by dataset std and add mean')
     parser.add_argument('--reduce-op', type=str, default='add', choices=['add', 'mean'], help='Reduce operation to apply to atomic predictions')
     # fmt: on
@@ -193,6 +202,8 @@ def main():
         callbacks=[early_stopping, checkpoint_callback],
         logger=[tb_logger, csv_logger, wandb_logger],
         reload_dataloaders_every_epoch=False,
+        # the batch budget sampler splits the data between processes itself
+        replace_sampler_ddp=args.batch_budget is None,
         precision=args.precision,
         plugins=[ddp_plugin],
     )
@@ -3,10 +3,10 @@ from torch.testing import assert_allclose
 from pytest import mark
 from glob import glob
 from os.path import dirname, join
-from torchmdnet.calculators import External
+from torchmdnet.calculators import External, ReplicaExternal
 from torchmdnet.models.model import load_model
 
-from utils import create_example_batch
+from utils import create_example_batch, save_example_checkpoint
 
 
 def test_compare_forward():
@@ -38,3 +38,82 @@ def test_compare_forward_multiple():
 
     assert_allclose(e_calc, e_pred)
     assert_allclose(f_calc, f_pred.view(-1, len(z1), 3))
+
+
+@mark.parametrize("neighbor_list", ["radius_graph", "cell_list"])
+def test_verlet_list(neighbor_list, tmpdir):
+    checkpoint = save_example_checkpoint(
+        join(tmpdir, "model.ckpt"), "equivariant-transformer", derivative=True
+    )
+    z, pos, _ = create_example_batch(n_atoms=20, multiple_batches=False)
+    pos = pos * 2
+    calc = External(checkpoint, z.unsqueeze(0))
+    verlet_calc = External(checkpoint, z.unsqueeze(0), skin=1.0)
+    for module in [calc.model, verlet_calc.model]:
+        module.representation_model.distance.neighbor_list = neighbor_list
+    distance = verlet_calc.model.representation_model.distance
+
+    edge_index = None
+    for step in range(10):
+        pos = pos + 0.02 * torch.randn_like(pos)
+        e_ref, f_ref = calc.calculate(pos, None)
+        e_calc, f_calc = verlet_calc.calculate(pos, None)
+        assert_allclose(e_calc, e_ref)
+        assert_allclose(f_calc, f_ref)
+        if step > 0:
+            # atoms moved less than skin / 2, the neighbor list should be reused
+            assert distance.verlet_edge_index is edge_index
+        edge_index = distance.verlet_edge_index
+
+    # large displacements trigger a rebuild
+    verlet_calc.calculate(pos + 1.0, None)
+    assert distance.verlet_edge_index is not edge_index
+
+
+def test_periodic_box(tmpdir):
+    checkpoint = save_example_checkpoint(
+        join(tmpdir, "model.ckpt"), "equivariant-transformer", derivative=True
+    )
+    z, pos, batch = create_example_batch(n_atoms=20, multiple_batches=False)
+    calc = External(checkpoint, z.unsqueeze(0))
+    model = load_model(checkpoint, derivative=True)
+
+    # an all-zero box is treated as non-periodic
+    e_calc, f_calc = calc.calculate(pos, torch.zeros(1, 3, 3))
+    e_ref, f_ref = calc.calculate(pos, None)
+    assert_allclose(e_calc, e_ref)
+    assert_allclose(f_calc, f_ref)
+
+    box = torch.eye(3).unsqueeze(0) * 10.0
+    e_calc, f_calc = calc.calculate(pos, box)
+    e_pred, _, f_pred = model(z, pos, batch, box)
+    assert_allclose(e_calc, e_pred)
+    assert_allclose(f_calc, f_pred.unsqueeze(0))
+
+
+def test_replica_external(tmpdir):
+    checkpoint = save_example_checkpoint(
+        join(tmpdir, "model.ckpt"), "equivariant-transformer", derivative=True
+    )
+    molecules = [
+        create_example_batch(n_atoms=n_atoms, multiple_batches=False)[:2]
+        for n_atoms in [6, 10, 8]
+    ]
+    calc = ReplicaExternal(checkpoint, [z for z, _ in molecules])
+
+    # pad the positions with values that must be ignored
+    pos = torch.full((3, 10, 3), 100.0)
+    for i, (_, mol_pos) in enumerate(molecules):
+        pos[i, : len(mol_pos)] = mol_pos
+
+    for step in range(2):
+        pos = pos + 0.01
+        energies, forces = calc.calculate(pos, None)
+        assert energies.shape == (3, 1) and forces.shape == (3, 10, 3)
+        for i, (z, _) in enumerate(molecules):
+            e_ref, f_ref = External(checkpoint, z.unsqueeze(0)).calculate(
+                pos[i, : len(z)], None
+            )
+            assert_allclose(energies[i], e_ref.view(-1))
+            assert_allclose(forces[i, : len(z)], f_ref[0])
+            assert (forces[i, len(z) :] == 0).all()
@@ -1,6 +1,12 @@
+import os
+import time
+from types import SimpleNamespace
+from os.path import join
 from pytest import mark
+import numpy as np
 import torch
-from torchmdnet.data import DataModule
+from torch.utils.data import Subset
+from torchmdnet.data import DataModule, DynamicBatchSampler, get_num_atoms
 from utils import load_example_args, DummyDataset
 
 
@@ -61,3 +67,141 @@ def test_datamodule_standardize(energy, forces, has_atomref, tmpdir):
     else:
         # the data module should not have mean and std set if the dataset does not include energies
         assert data.mean is None and data.std is None
+
+
+def test_standardize_cache_key(tmpdir):
+    args = load_example_args("graph-network")
+    args["train_size"] = 800
+    args["val_size"] = 100
+    args["test_size"] = 100
+    args["log_dir"] = tmpdir
+    np.save(join(tmpdir, "energy_0.npy"), np.zeros((10, 1)))
+    args["energy_files"] = join(tmpdir, "energy_*.npy")
+
+    data = DataModule(args, dataset=DummyDataset())
+    data.prepare_data()
+    data.setup("fit")
+    key = data._standardize_cache_key(None)
+    assert data._standardize_cache_key(None) == key
+
+    # changing the dataset argument or the matched files invalidates the cache
+    data.hparams["dataset_arg"] = "other"
+    assert data._standardize_cache_key(None) != key
+    data.hparams["dataset_arg"] = args["dataset_arg"]
+    np.save(join(tmpdir, "energy_1.npy"), np.zeros((10, 1)))
+    assert data._standardize_cache_key(None) != key
+
+
+def test_standardize_local_rank(tmpdir, monkeypatch):
+    args = load_example_args("graph-network")
+    args["standardize"] = True
+    args["train_size"] = 800
+    args["val_size"] = 100
+    args["test_size"] = 100
+    args["log_dir"] = tmpdir
+    dataset = DummyDataset()
+
+    computed_on = []
+    compute_energy_stats = DataModule._compute_energy_stats
+
+    def counting_compute_energy_stats(self, atomref):
+        computed_on.append(os.environ.get("LOCAL_RANK", "0"))
+        return compute_energy_stats(self, atomref)
+
+    def setup():
+        data = DataModule(args, dataset=dataset)
+        data.prepare_data()
+        data.setup("fit")
+        return data
+
+    ranks = {}
+
+    def sleep(seconds):
+        # local rank zero finishes while the other process waits for the cache
+        if 0 not in ranks:
+            with monkeypatch.context() as m:
+                m.setenv("LOCAL_RANK", "0")
+                ranks[0] = setup()
+
+    monkeypatch.setattr(
+        DataModule, "_compute_energy_stats", counting_compute_energy_stats
+    )
+    monkeypatch.setattr(time, "sleep", sleep)
+    monkeypatch.setenv("LOCAL_RANK", "1")
+    ranks[1] = setup()
+
+    assert computed_on == ["0"]
+    assert torch.allclose(ranks[1].mean, ranks[0].mean)
+    assert torch.allclose(ranks[1].std, ranks[0].std)
+
+
+@mark.parametrize("training", [True, False])
+@mark.parametrize("denoising_only", [True, False])
+def test_datamodule_noise(training, denoising_only, tmpdir):
+    args = load_example_args("graph-network")
+    args["train_size"] = 800
+    args["val_size"] = 100
+    args["test_size"] = 100
+    args["log_dir"] = tmpdir
+    args["position_noise_scale"] = 0.1
+    args["denoising_only"] = denoising_only
+
+    data = DataModule(args, dataset=DummyDataset())
+    data.prepare_data()
+    data.setup("fit")
+    data.trainer = SimpleNamespace(
+        training=training, global_rank=0, reload_dataloaders_every_epoch=False
+    )
+
+    batch = next(iter(data._get_dataloader(data.val_dataset, "val", False)))
+    assert "pos_target" not in batch
+    pos = batch.pos.clone()
+    batch = data.on_after_batch_transfer(batch, 0)
+    if training or denoising_only:
+        torch.testing.assert_allclose(batch.pos, pos + batch.pos_target)
+        assert batch.pos_target.std() > 0
+    else:
+        assert "pos_target" not in batch
+        assert (batch.pos == pos).all()
+
+
+@mark.parametrize("budget_type", ["atoms", "edges"])
+@mark.parametrize("bucket_size", [None, 50])
+def test_dynamic_batch_sampler(budget_type, bucket_size):
+    num_atoms = np.random.default_rng(0).integers(1, 40, size=500)
+    sampler = DynamicBatchSampler(
+        num_atoms,
+        300,
+        budget_type=budget_type,
+        max_num_neighbors=8,
+        shuffle=True,
+        bucket_size=bucket_size,
+    )
+    sizes = sampler.sizes
+    num_batches = len(sampler)
+    batches = list(sampler)
+    assert len(batches) == num_batches
+    assert sorted(i for batch in batches for i in batch) == list(range(500))
+    assert all(len(b) == 1 or sizes[b].sum() <= 300 for b in batches)
+    # a new order in every epoch
+    assert list(sampler) != batches
+
+    # distributed processes get disjoint batches of equal number
+    ranks = [
+        list(
+            DynamicBatchSampler(
+                num_atoms, 300, num_replicas=3, rank=rank, shuffle=True, seed=1
+            )
+        )
+        for rank in range(3)
+    ]
+    assert len(set(len(batches) for batches in ranks)) == 1
+    indices = [i for batches in ranks for batch in batches for i in batch]
+    assert set(indices) == set(range(500))
+    assert len(indices) - 500 < 3 * max(len(b) for batches in ranks for b in batches)
+
+
+def test_get_num_atoms():
+    dataset = DummyDataset(num_samples=20)
+    subset = Subset(dataset, [3, 1, 7])
+    assert get_num_atoms(subset).tolist() == [len(dataset.z[i]) for i in [3, 1, 7]]
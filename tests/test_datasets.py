@@ -1,8 +1,14 @@
+import os
+import pickle
 import pytest
 from pytest import mark, raises
 from os.path import join
 import numpy as np
-from torchmdnet.datasets import Custom
+import h5py
+import torch
+from torch_geometric.data import DataLoader
+from torchmdnet.datasets import Custom, HDF5, MD17, ANI1, PCQM4MV2
+from torchmdnet.datasets.memmap import MemmapWriter, MemmapStorage, ConcatStorage
 
 
 @mark.parametrize("energy", [True, False])
@@ -30,7 +36,8 @@ def test_custom(energy, forces, num_files, tmpdir, num_samples=100):
     if energy == False and forces == False:
         with raises(AssertionError):
             Custom(
-                coordglob=join(tmpdir, "coords*"), embedglob=join(tmpdir, "embed*"),
+                coordglob=join(tmpdir, "coords*"),
+                embedglob=join(tmpdir, "embed*"),
             )
         return
 
@@ -49,3 +56,224 @@ def test_custom(energy, forces, num_files, tmpdir, num_samples=100):
         assert hasattr(sample, "y"), "Sample doesn't contain energy"
     if forces:
         assert hasattr(sample, "dy"), "Sample doesn't contain forces"
+
+    # samples are looked up in the correct file and survive pickling
+    idx = len(data) - 1
+    coords = np.load(join(tmpdir, f"coords_{num_files - 1}.npy"))
+    sample = pickle.loads(pickle.dumps(data))[idx]
+    assert torch.allclose(sample.pos, torch.from_numpy(coords[-1]))
+    assert sample.z.dtype == torch.long
+    # samples do not share memory with the cached embeddings
+    z = data[idx].z
+    z += 1
+    assert (data[idx].z == z - 1).all()
+    assert (data.num_atoms() == 5).all() and len(data.num_atoms()) == len(data)
+    if energy:
+        energies = np.concatenate(
+            [np.load(join(tmpdir, f"energy_{i}.npy")) for i in range(num_files)]
+        ).reshape(-1)
+        assert np.allclose(data.energies(), energies)
+        atomref = np.random.uniform(size=100)
+        embed = np.load(join(tmpdir, f"embed_{num_files - 1}.npy"))
+        assert np.isclose(
+            data.energies(atomref)[idx], energies[idx] - atomref[embed].sum()
+        )
+
+
+def test_hdf5(tmpdir):
+    # one group with and one without forces, spread over two files
+    groups = []
+    for i, num_atoms in enumerate([3, 5]):
+        types = np.random.randint(0, 10, size=(8, num_atoms))
+        pos = np.random.normal(size=(8, num_atoms, 3)).astype(np.float32)
+        energy = np.random.uniform(size=8)
+        forces = np.random.normal(size=(8, num_atoms, 3)).astype(np.float32)
+        with h5py.File(join(tmpdir, f"data{i}.h5"), "w") as f:
+            group = f.create_group(f"group{num_atoms}")
+            group["types"] = types
+            group["pos"] = pos
+            group["energy"] = energy
+            if i == 0:
+                group["forces"] = forces
+        groups.append((types, pos, energy, forces))
+
+    data = HDF5(";".join(join(tmpdir, f"data{i}.h5") for i in range(2)))
+    assert len(data) == 16
+    assert data.has_forces
+    assert (data.num_atoms() == np.repeat([3, 5], 8)).all()
+    assert np.allclose(data.energies(), np.concatenate([g[2] for g in groups]))
+    atomref = np.random.uniform(size=10)
+    types, _, energy, _ = groups[1]
+    assert np.allclose(data.energies(atomref)[8:], energy - atomref[types].sum(axis=1))
+    # reading metadata leaves no open file handles behind
+    assert data._files is None
+
+    # batches are read in one go and match single samples in the requested order,
+    # the samples of the second group are sparse and read by fancy indexing
+    data = pickle.loads(pickle.dumps(data))
+    indices = [9, 2, 3, 4, 15, 3, 0, 9]
+    for idx, sample in zip(indices, data.__getitems__(indices)):
+        types, pos, energy, forces = groups[idx // 8]
+        assert (sample.z == torch.from_numpy(types[idx % 8])).all()
+        assert torch.allclose(sample.pos, torch.from_numpy(pos[idx % 8]))
+        assert sample.y.shape == (1, 1) and np.isclose(sample.y.item(), energy[idx % 8])
+        if idx < 8:
+            assert torch.allclose(sample.dy, torch.from_numpy(forces[idx % 8]))
+        else:
+            assert "dy" not in sample
+        assert torch.equal(sample.pos, data[idx].pos)
+
+
+def test_md17(tmpdir, num_samples=30):
+    os.makedirs(join(tmpdir, "raw"))
+    molecules = dict(aspirin=5, benzene=7)
+    raw = dict()
+    for mol, num_atoms in molecules.items():
+        raw[mol] = dict(
+            z=np.random.randint(1, 10, size=num_atoms),
+            R=np.random.normal(size=(num_samples, num_atoms, 3)),
+            E=np.random.normal(size=(num_samples, 1)),
+            F=np.random.normal(size=(num_samples, num_atoms, 3)),
+        )
+        np.savez(join(tmpdir, "raw", MD17.molecule_files[mol]), **raw[mol])
+
+    data = MD17(tmpdir, dataset_arg="aspirin,benzene")
+    assert len(data) == num_samples * len(molecules)
+    for i, mol in enumerate(molecules):
+        sample = data[i * num_samples + 3]
+        assert (sample.z == torch.from_numpy(raw[mol]["z"])).all()
+        torch.testing.assert_allclose(sample.pos, raw[mol]["R"][3])
+        torch.testing.assert_allclose(sample.y, raw[mol]["E"][3].reshape(1, 1))
+        torch.testing.assert_allclose(sample.dy, raw[mol]["F"][3])
+
+    # energies are read without creating Data objects
+    atomref = torch.randn(100, 1)
+    energies = np.concatenate([raw[mol]["E"] for mol in molecules])
+    np.testing.assert_allclose(data.energies(), energies, rtol=1e-6)
+    reference = np.concatenate(
+        [raw[mol]["E"][:, 0] - atomref[raw[mol]["z"]].sum().item() for mol in molecules]
+    )
+    np.testing.assert_allclose(data.energies(atomref), reference, rtol=1e-5, atol=1e-6)
+    assert data.num_atoms().tolist() == [5] * num_samples + [7] * num_samples
+
+    # reopening a processed dataset reuses the files of the single molecules
+    assert len(MD17(tmpdir, dataset_arg="benzene")) == num_samples
+
+    # conformers are written one by one when a pre_transform is given
+    def shift(data):
+        data.pos = data.pos + 1
+        return data
+
+    os.makedirs(join(tmpdir, "shifted"))
+    os.symlink(join(tmpdir, "raw"), join(tmpdir, "shifted", "raw"))
+    shifted = MD17(
+        join(tmpdir, "shifted"), pre_transform=shift, dataset_arg="aspirin,benzene"
+    )
+    assert len(shifted) == len(data)
+    for i in [0, num_samples + 3, len(data) - 1]:
+        torch.testing.assert_allclose(shifted[i].pos, data[i].pos + 1)
+        torch.testing.assert_allclose(shifted[i].y, data[i].y)
+        torch.testing.assert_allclose(shifted[i].dy, data[i].dy)
+        assert (shifted[i].z == data[i].z).all()
+
+
+def test_ani1(tmpdir):
+    os.makedirs(join(tmpdir, "raw", "ANI-1_release"))
+    energies = []
+    for i in range(8):
+        path = join(tmpdir, "raw", "ANI-1_release", f"ani_gdb_s{i + 1:02d}.h5")
+        with h5py.File(path, "w") as f:
+            for j in range(2):
+                group = f.create_group(f"gdb_{i}/mol_{j}")
+                group["species"] = np.array([b"C", b"H", b"H", b"O"][: j + 3])
+                group["coordinates"] = np.random.normal(size=(4, j + 3, 3))
+                group["energies"] = np.random.normal(size=4)
+                energies.append(group["energies"][:] * ANI1.HAR2EV)
+
+    data = ANI1(tmpdir)
+    assert len(data) == 8 * 2 * 4
+    torch.testing.assert_allclose(
+        torch.cat([data[i].y for i in range(len(data))]).view(-1),
+        np.concatenate(energies),
+    )
+    assert (data[5].z == torch.tensor([6, 1, 1, 8])).all()
+
+    # conformers are written one by one when a pre_transform is given
+    def shift(data):
+        data.pos = data.pos + 1
+        return data
+
+    os.makedirs(join(tmpdir, "shifted"))
+    os.symlink(join(tmpdir, "raw"), join(tmpdir, "shifted", "raw"))
+    shifted = ANI1(join(tmpdir, "shifted"), pre_transform=shift)
+    assert len(shifted) == len(data)
+    for i in [0, 5, len(data) - 1]:
+        torch.testing.assert_allclose(shifted[i].pos, data[i].pos + 1)
+        torch.testing.assert_allclose(shifted[i].y, data[i].y)
+        assert (shifted[i].z == data[i].z).all()
+
+
+def test_pcqm4mv2(tmpdir, monkeypatch, num_samples=10):
+    # several shards with several chunks each
+    monkeypatch.setattr(PCQM4MV2, "shard_size", 4)
+    monkeypatch.setattr(PCQM4MV2, "chunk_size", 3)
+
+    raw_dir = join(tmpdir, "raw", "pcqm4m-v2_xyz", "00000000_00009999")
+    os.makedirs(raw_dir)
+    molecules = []
+    for i in range(num_samples):
+        symbols = ["C", "O", "H", "N"][: i % 3 + 2]
+        pos = np.random.normal(size=(len(symbols), 3))
+        with open(join(raw_dir, f"{i}.xyz"), "w") as f:
+            f.write(f"{len(symbols)}\n\n")
+            for symbol, xyz in zip(symbols, pos):
+                f.write(f"{symbol} {xyz[0]:.6f} {xyz[1]:.6f} {xyz[2]:.6f}\n")
+        molecules.append((symbols, pos))
+
+    data = PCQM4MV2(tmpdir, num_processes=2)
+    assert len(data) == num_samples
+    assert (
+        torch.cat([data[i].idx for i in range(num_samples)])
+        == torch.arange(num_samples)
+    ).all()
+    assert not any("shard" in file_name for file_name in os.listdir(data.processed_dir))
+    numbers = dict(C=6, O=8, H=1, N=7)
+    for i, (symbols, pos) in enumerate(molecules):
+        assert data[i].z.tolist() == [numbers[symbol] for symbol in symbols]
+        torch.testing.assert_allclose(data[i].pos, pos, atol=1e-5, rtol=0)
+
+    # the memory maps are not pickled and can be opened in DataLoader workers
+    data = pickle.loads(pickle.dumps(data))
+    batch = next(iter(DataLoader(data, batch_size=num_samples, num_workers=2)))
+    assert batch.pos.size(0) == sum(len(symbols) for symbols, _ in molecules)
+
+    # processing resumes from completed shards
+    for file_name in data.processed_file_names:
+        os.remove(join(data.processed_dir, file_name))
+    with data.memmap_writer("pcqm4mv2_xyz-shard0001") as writer:
+        for i in range(4, 8):
+            writer.append(z=data[i].z, pos=torch.zeros_like(data[i].pos), idx=i)
+    data = PCQM4MV2(tmpdir, num_processes=2)
+    assert len(data) == num_samples
+    assert (data[5].pos == 0).all() and (data[8].pos != 0).any()
+
+
+def test_concat_storage(tmpdir):
+    fields = dict(z=(np.uint8, ())), dict(y=(np.float32, (1,)))
+    storages, expected = [], []
+    for i, length in enumerate([3, 0, 5, 1]):
+        prefix = join(tmpdir, f"part{i}")
+        with MemmapWriter(prefix, *fields) as writer:
+            for j in range(length):
+                writer.append(z=np.full(j + 1, i), y=len(expected))
+                expected.append((i, j + 1))
+        storages.append(MemmapStorage(prefix, *fields))
+
+    storage = ConcatStorage(storages)
+    assert len(storage) == len(expected)
+    for idx, (part, num_atoms) in enumerate(expected):
+        sample = storage[idx]
+        assert (sample["z"] == part).all() and len(sample["z"]) == num_atoms
+        assert sample["y"][0, 0] == idx
+    assert storage.num_atoms().tolist() == [n for _, n in expected]
+    np.testing.assert_allclose(storage.energies()[:, 0], np.arange(len(expected)))
@@ -1,5 +1,7 @@
 import torch
+from pytest import mark
 from torchmdnet.models.model import create_model
+from torchmdnet.models.torchmd_et import EquivariantLayerNorm, SymInvSqrt3x3
 from utils import load_example_args
 
 
@@ -45,3 +47,78 @@ def test_vector_equivariance():
     y = model(z, pos, batch)[0]
     y_rot = model(z, pos @ rotate, batch)[0]
     torch.testing.assert_allclose(y @ rotate, y_rot)
+
+
+def whiten_reference(norm, vec):
+    vec = vec - vec.mean(-1, keepdim=True)
+    covar = vec @ vec.transpose(-1, -2) / vec.size(-1)
+    covar = covar + norm.eps * torch.diag(torch.tensor([2.0, 3.0, 4.0])).to(vec)
+    eigvals, eigvecs = torch.linalg.eigh(covar)
+    covar_sqrtinv = (
+        eigvecs @ torch.diag_embed(eigvals.rsqrt()) @ eigvecs.transpose(-1, -2)
+    )
+    return covar_sqrtinv @ vec
+
+
+@mark.parametrize("scale", [1.0, 1e-4, 0.0])
+def test_equivariant_layer_norm(scale):
+    torch.manual_seed(1234)
+    norm = EquivariantLayerNorm(16)
+    vec = torch.randn(20, 3, 16)
+    # make some of the samples almost planar or linear
+    vec[:10, 2] *= scale
+    vec[:5, 1] *= scale
+
+    torch.testing.assert_allclose(norm(vec), whiten_reference(norm, vec.double()))
+    torch.testing.assert_allclose(torch.jit.script(norm)(vec), norm(vec))
+
+    norm = norm.double()
+    vec = vec.double().requires_grad_(True)
+    weight = torch.randn_like(vec)
+    grad = torch.autograd.grad((norm(vec) * weight).sum(), vec)[0]
+    ref_grad = torch.autograd.grad((whiten_reference(norm, vec) * weight).sum(), vec)[0]
+    torch.testing.assert_allclose(grad, ref_grad)
+
+
+@mark.parametrize("rank", [1, 2])
+@mark.parametrize("scale", [100.0, 1000.0])
+def test_equivariant_layer_norm_rank_deficient(rank, scale):
+    torch.manual_seed(1234)
+    norm = EquivariantLayerNorm(128).double()
+    # vector features of linear (rank 1) or planar (rank 2) molecules with large
+    # norms, in a random orientation
+    vec = torch.randn(50, 3, 128, dtype=torch.float64) * scale
+    vec[:, rank:] = 0
+    rotation = torch.linalg.qr(torch.randn(3, 3, dtype=torch.float64))[0]
+    vec = (rotation @ vec).requires_grad_(True)
+
+    weight = torch.randn_like(vec)
+    out = norm(vec)
+    grad = torch.autograd.grad((out * weight).sum(), vec)[0]
+    ref_out = whiten_reference(norm, vec)
+    ref_grad = torch.autograd.grad((ref_out * weight).sum(), vec)[0]
+    assert out.isfinite().all() and grad.isfinite().all()
+    torch.testing.assert_allclose(out, ref_out)
+    torch.testing.assert_allclose(grad, ref_grad, rtol=1e-7, atol=1e-9 * ref_grad.abs().max())
+
+    # the covariances of single precision inputs are accumulated in single
+    # precision and can be indefinite
+    vec = vec.detach().float().requires_grad_(True)
+    out = norm.float()(vec)
+    grad = torch.autograd.grad((out * weight.float()).sum(), vec)[0]
+    assert out.isfinite().all() and grad.isfinite().all()
+
+
+def test_sym_inv_sqrt_gradients():
+    torch.manual_seed(1234)
+    a = torch.randn(4, 3, 3, dtype=torch.float64)
+    # include exactly degenerate eigenvalues
+    a[0] = torch.eye(3)
+    a[1] = torch.diag(torch.tensor([1.0, 1.0, 0.0]))
+
+    def inv_sqrt(a):
+        return SymInvSqrt3x3.apply(a @ a.transpose(-1, -2) + 0.1 * torch.eye(3))
+
+    a.requires_grad_(True)
+    assert torch.autograd.gradcheck(inv_sqrt, a)
+    assert torch.autograd.gradgradcheck(inv_sqrt, a)
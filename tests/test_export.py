@@ -0,0 +1,52 @@
+import json
+from os.path import join
+import torch
+from torch.testing import assert_allclose
+from pytest import mark
+from torchmdnet import models
+from torchmdnet.export import export, strip_model
+from torchmdnet.models.model import create_model, load_model
+
+from utils import load_example_args, create_example_batch, save_example_checkpoint
+
+
+def test_strip_model():
+    z, pos, batch = create_example_batch()
+    args = load_example_args(
+        "equivariant-transformer", remove_prior=True, derivative=True
+    )
+    args["output_model_noise"] = "VectorOutput"
+    args["position_noise_scale"] = 0.1
+    model = create_model(args).eval()
+    pred, noise_pred, deriv = model(z, pos, batch)
+    assert noise_pred is not None
+
+    model = strip_model(model)
+    assert not hasattr(model, "pos_normalizer")
+    stripped_pred, stripped_noise_pred, stripped_deriv = model(z, pos, batch)
+    assert stripped_noise_pred is None
+    assert_allclose(stripped_pred, pred)
+    assert_allclose(stripped_deriv, deriv)
+
+
+@mark.parametrize("model_name", models.__all__)
+@mark.parametrize("derivative", [True, False])
+def test_export(model_name, derivative, tmpdir):
+    z, pos, batch = create_example_batch()
+    checkpoint = save_example_checkpoint(
+        join(tmpdir, "model.ckpt"), model_name, derivative=derivative
+    )
+    export(checkpoint, join(tmpdir, "model.pt"), derivative=derivative)
+
+    extra_files = {"hparams.json": ""}
+    module = torch.jit.load(join(tmpdir, "model.pt"), _extra_files=extra_files)
+    assert json.loads(extra_files["hparams.json"])["derivative"] == derivative
+    pred, _, deriv = module(z, pos, batch)
+    ref_pred, _, ref_deriv = load_model(checkpoint, derivative=derivative).eval()(
+        z, pos, batch
+    )
+    assert_allclose(pred, ref_pred)
+    if derivative:
+        assert_allclose(deriv, ref_deriv)
+    else:
+        assert deriv is None
@@ -6,7 +6,7 @@ import torch
 import pytorch_lightning as pl
 from torchmdnet import models
 from torchmdnet.models.model import create_model
-from torchmdnet.models import output_modules
+from torchmdnet.models import output_modules, torchmd_et
 
 from utils import load_example_args, create_example_batch
 
@@ -93,3 +93,186 @@ def test_forward_output(model_name, output_model, overwrite_reference=False):
         torch.testing.assert_allclose(
             deriv, expected[model_name][output_model]["deriv"]
         )
+
+
+@mark.parametrize("distance_influence", ["keys", "values", "both", "none"])
+def test_fuse_edge_projections(distance_influence):
+    z, pos, batch = create_example_batch()
+    args = load_example_args(
+        "equivariant-transformer",
+        remove_prior=True,
+        derivative=True,
+        distance_influence=distance_influence,
+    )
+    pl.seed_everything(1234)
+    ref_model = create_model(args)
+    args["fuse_edge_projections"] = True
+    pl.seed_everything(1234)
+    model = create_model(args)
+
+    pred, _, deriv = model(z, pos, batch)
+    ref_pred, _, ref_deriv = ref_model(z, pos, batch)
+    torch.testing.assert_allclose(pred, ref_pred)
+    torch.testing.assert_allclose(deriv, ref_deriv)
+
+    # gradients reach the parameters of every layer's projections
+    (pred.sum() + deriv.sum()).backward()
+    (ref_pred.sum() + ref_deriv.sum()).backward()
+    for p, ref_p in zip(model.parameters(), ref_model.parameters()):
+        if ref_p.grad is not None:
+            torch.testing.assert_allclose(p.grad, ref_p.grad)
+
+
+@mark.parametrize("distance_influence", ["keys", "values", "both", "none"])
+def test_first_layer_zero_vec(distance_influence):
+    z, pos, batch = create_example_batch()
+    args = load_example_args(
+        "equivariant-transformer",
+        remove_prior=True,
+        distance_influence=distance_influence,
+    )
+    model = create_model(args).representation_model
+    attn = model.attention_layers[0]
+    pos.requires_grad_(True)
+
+    edge_index, edge_weight, edge_vec = model.distance(pos, batch)
+    edge_attr = model.distance_expansion(edge_weight)
+    mask = edge_index[0] != edge_index[1]
+    edge_vec[mask] = edge_vec[mask] / torch.norm(edge_vec[mask], dim=1).unsqueeze(1)
+    x = model.embedding(z)
+    x = model.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr)
+    zero_vec = torch.zeros(x.size(0), 3, x.size(1))
+
+    # the specialized path for zero vector features matches the general one
+    dx, dvec = attn(x, None, edge_index, edge_weight, edge_attr, edge_vec)
+    ref_dx, ref_dvec = attn(x, zero_vec, edge_index, edge_weight, edge_attr, edge_vec)
+    torch.testing.assert_allclose(dx, ref_dx)
+    torch.testing.assert_allclose(dvec, ref_dvec)
+
+    grad = torch.autograd.grad((dx.sum() + dvec.sum()), pos, retain_graph=True)[0]
+    ref_grad = torch.autograd.grad((ref_dx.sum() + ref_dvec.sum()), pos)[0]
+    torch.testing.assert_allclose(grad, ref_grad)
+
+
+@mark.parametrize("model_name", models.__all__)
+def test_all_parameters_receive_gradients(model_name):
+    # DistributedDataParallel with find_unused_parameters=False expects a gradient
+    # for every parameter
+    z, pos, batch = create_example_batch()
+    args = load_example_args(model_name, remove_prior=True, derivative=True)
+    model = create_model(args)
+    pred, _, deriv = model(z, pos, batch)
+    (pred.sum() + deriv.sum()).backward()
+    unused = [name for name, p in model.named_parameters() if p.grad is None]
+    assert len(unused) == 0, f"Parameters without gradient: {unused}"
+
+
+@mark.parametrize("edge_chunk_size", [1, 7, 10000])
+def test_edge_chunk_size(edge_chunk_size):
+    z, pos, batch = create_example_batch()
+    args = load_example_args(
+        "equivariant-transformer", remove_prior=True, derivative=True
+    )
+    pl.seed_everything(1234)
+    ref_model = create_model(args)
+    args["edge_chunk_size"] = edge_chunk_size
+    pl.seed_everything(1234)
+    model = create_model(args)
+    model.train()
+    ref_model.train()
+
+    pred, _, deriv = model(z, pos, batch)
+    ref_pred, _, ref_deriv = ref_model(z, pos, batch)
+    torch.testing.assert_allclose(pred, ref_pred)
+    torch.testing.assert_allclose(deriv, ref_deriv)
+
+    # the chunks are recomputed in the backward pass, training on forces
+    # differentiates through it
+    (pred.sum() + deriv.pow(2).sum()).backward()
+    (ref_pred.sum() + ref_deriv.pow(2).sum()).backward()
+    for p, ref_p in zip(model.parameters(), ref_model.parameters()):
+        # the messages are summed in a different order
+        torch.testing.assert_allclose(
+            p.grad, ref_p.grad, rtol=1e-4, atol=1e-4 * ref_p.grad.abs().max()
+        )
+
+    # without gradients the chunks are not checkpointed
+    with torch.no_grad():
+        x, vec = model.representation_model(z, pos, batch)[:2]
+        ref_x, ref_vec = ref_model.representation_model(z, pos, batch)[:2]
+    torch.testing.assert_allclose(x, ref_x)
+    torch.testing.assert_allclose(vec, ref_vec)
+
+
+@mark.skipif(
+    not torchmd_et.has_non_reentrant_checkpoint
+    or not hasattr(torch.Tensor, "untyped_storage"),
+    reason="requires non-reentrant checkpointing",
+)
+def test_edge_chunk_size_memory():
+    z, pos, batch = create_example_batch(n_atoms=20)
+    args = load_example_args(
+        "equivariant-transformer", remove_prior=True, derivative=True
+    )
+
+    def saved_bytes(edge_chunk_size):
+        args["edge_chunk_size"] = edge_chunk_size
+        model = create_model(args)
+        model.eval()
+        saved = []
+
+        def pack(tensor):
+            saved.append(tensor)
+            return tensor
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            model(z, pos, batch)
+        # tensors saved several times or as views share their storage
+        storages = {t.untyped_storage().data_ptr(): t.untyped_storage() for t in saved}
+        return sum(storage.nbytes() for storage in storages.values())
+
+    # the per-edge tensors of the chunks are not stored for the forces
+    assert saved_bytes(8) < 0.6 * saved_bytes(None)
+
+
+def test_edge_chunk_size_fused_projections():
+    args = load_example_args("equivariant-transformer", remove_prior=True)
+    args["fuse_edge_projections"] = True
+    args["edge_chunk_size"] = 10
+    with pytest.raises(AssertionError):
+        create_model(args)
+
+
+@mark.parametrize("model_name", models.__all__)
+def test_rbf_table_size(model_name):
+    z, pos, batch = create_example_batch()
+    args = load_example_args(
+        model_name, remove_prior=True, derivative=True, trainable_rbf=False
+    )
+    pl.seed_everything(1234)
+    ref_model = create_model(args)
+    args["rbf_table_size"] = 4096
+    pl.seed_everything(1234)
+    model = create_model(args)
+
+    pred, _, deriv = model(z, pos, batch)
+    ref_pred, _, ref_deriv = ref_model(z, pos, batch)
+    torch.testing.assert_allclose(pred, ref_pred, atol=1e-4, rtol=1e-4)
+    torch.testing.assert_allclose(deriv, ref_deriv, atol=1e-4, rtol=1e-4)
+
+
+@mark.parametrize("model_name", models.__all__)
+def test_derivative_eval(model_name):
+    z, pos, batch = create_example_batch()
+    args = load_example_args(model_name, remove_prior=True, derivative=True)
+    model = create_model(args)
+
+    pred, _, deriv = model(z, pos, batch)
+    assert deriv.requires_grad, "Forces must be differentiable during training."
+
+    # in eval mode the graph of the forces is not created
+    model.eval()
+    eval_pred, _, eval_deriv = model(z, pos, batch)
+    assert not eval_deriv.requires_grad
+    torch.testing.assert_allclose(eval_pred, pred)
+    torch.testing.assert_allclose(eval_deriv, deriv)
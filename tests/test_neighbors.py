@@ -0,0 +1,229 @@
+from pytest import mark, raises
+import torch
+from torch_cluster import radius_graph
+from torchmdnet.models.model import create_model
+from torchmdnet.models.utils import cell_list_graph, symmetrize_half_list, Distance
+from torchmdnet import models
+
+from utils import load_example_args, create_example_batch
+
+
+def edge_set(edge_index):
+    return set(map(tuple, edge_index.t().tolist()))
+
+
+@mark.parametrize("loop", [True, False])
+@mark.parametrize("num_samples", [1, 5])
+@mark.parametrize("cutoff", [1.5, 5.0])
+def test_cell_list_matches_radius_graph(loop, num_samples, cutoff):
+    torch.manual_seed(1234)
+    pos = torch.randn(40 * num_samples, 3) * 3
+    batch = torch.arange(num_samples).repeat_interleave(40)
+
+    expected = radius_graph(pos, cutoff, batch, loop, max_num_neighbors=200)
+    edge_index = cell_list_graph(pos, cutoff, batch, loop, max_num_neighbors=200)
+    assert edge_set(edge_index) == edge_set(expected)
+
+
+def test_cell_list_max_num_neighbors():
+    torch.manual_seed(1234)
+    pos = torch.rand(100, 3)
+    edge_index = cell_list_graph(pos, 5.0, max_num_neighbors=10)
+    assert (torch.bincount(edge_index[1]) == 10).all()
+
+
+@mark.parametrize("model_name", models.__all__)
+def test_cell_list_model(model_name):
+    z, pos, batch = create_example_batch()
+    args = load_example_args(model_name, remove_prior=True)
+    torch.manual_seed(1234)
+    ref_model = create_model(args)
+    args["neighbor_list"] = "cell_list"
+    torch.manual_seed(1234)
+    model = create_model(args)
+
+    torch.testing.assert_allclose(model(z, pos, batch)[0], ref_model(z, pos, batch)[0])
+
+
+def test_cell_list_torchscript():
+    pos = torch.randn(20, 3)
+    distance = torch.jit.script(Distance(0.0, 5.0, neighbor_list="cell_list"))
+    edge_index, _, _ = distance(pos, torch.zeros(20, dtype=torch.long))
+    assert edge_set(edge_index) == edge_set(radius_graph(pos, 5.0))
+
+
+def periodic_edge_set(pos, box, batch, cutoff):
+    # brute force search over all pairs and the 27 surrounding images
+    shift = torch.arange(-1, 2, dtype=pos.dtype)
+    images = torch.cartesian_prod(shift, shift, shift)
+    edges = set()
+    for i in range(pos.size(0)):
+        for j in range(pos.size(0)):
+            if i == j or batch[i] != batch[j]:
+                continue
+            vec = pos[j] - pos[i] + images @ box[batch[i]]
+            frac = torch.round((pos[j] - pos[i]) @ torch.inverse(box[batch[i]]))
+            vec = vec - frac @ box[batch[i]]
+            if vec.norm(dim=-1).min() < cutoff:
+                edges.add((j, i))
+    return edges
+
+
+@mark.parametrize("box_size", [3.0, 5.0, 11.0])
+def test_cell_list_periodic(box_size):
+    torch.manual_seed(1234)
+    num_samples = 2
+    box = torch.tensor(
+        [
+            [[box_size, 0, 0], [0, box_size, 0], [0, 0, box_size]],
+            [[box_size, 0, 0], [0.3, box_size, 0], [-0.4, 0.2, box_size]],
+        ]
+    )
+    cutoff = 1.4
+    batch = torch.arange(num_samples).repeat_interleave(30)
+    # positions partly outside of the box must be wrapped as well
+    pos = (torch.rand(batch.size(0), 3) * 1.4 - 0.2) * box_size
+
+    edge_index = cell_list_graph(pos, cutoff, batch, max_num_neighbors=100, box=box)
+    assert edge_set(edge_index) == periodic_edge_set(pos, box, batch, cutoff)
+
+
+@mark.parametrize("skewed", [False, True])
+def test_cell_list_box_too_small(skewed):
+    box = torch.eye(3) * 4.0
+    if skewed:
+        # the perpendicular width of a skewed box is smaller than its edge length
+        box = torch.tensor([[4.0, 0, 0], [1.9, 4.0, 0], [0, 0, 4.0]])
+    pos = torch.rand(20, 3) * 4.0
+    with raises(ValueError):
+        cell_list_graph(pos, 2.1 if not skewed else 1.9, box=box)
+    with raises(ValueError):
+        Distance(0.0, 2.1, max_num_neighbors=100)(pos, box=box)
+
+
+def test_distance_periodic():
+    torch.manual_seed(1234)
+    box = torch.eye(3) * 4.0
+    pos = torch.rand(30, 3) * 4.0
+    batch = torch.zeros(30, dtype=torch.long)
+    distance = Distance(0.0, 1.5, max_num_neighbors=100, return_vecs=True)
+    edge_index, edge_weight, edge_vec = distance(pos, batch, box)
+
+    # the same edges are found after translating atoms by box vectors
+    shifted = pos + torch.randint(-2, 3, (30, 3)) * 4.0
+    shifted_index, shifted_weight, _ = distance(shifted, batch, box)
+    assert edge_set(edge_index) == edge_set(shifted_index)
+    assert (edge_weight < 1.5).all() and (edge_vec.abs() <= 2.0).all()
+    torch.testing.assert_allclose(edge_weight.sort()[0], shifted_weight.sort()[0])
+
+
+@mark.parametrize("model_name", models.__all__)
+def test_periodic_model(model_name):
+    z, pos, batch = create_example_batch(n_atoms=6, multiple_batches=False)
+    args = load_example_args(model_name, remove_prior=True, derivative=True)
+    model = create_model(args)
+
+    # the box has to be at least twice as wide as the cutoff
+    size = 2 * args["cutoff_upper"]
+    box = torch.eye(3) * size
+    energy, _, forces = model(z, pos, batch, box)
+    shifted = pos.detach() + torch.tensor([size, -2 * size, 0.0])
+    shifted_energy, _, shifted_forces = model(z, shifted, batch, box)
+    torch.testing.assert_allclose(energy, shifted_energy)
+    torch.testing.assert_allclose(forces, shifted_forces)
+
+
+def test_periodic_torchscript():
+    pos = torch.rand(20, 3) * 3.0
+    box = torch.eye(3) * 3.0
+    batch = torch.zeros(20, dtype=torch.long)
+    distance = Distance(0.0, 1.2, max_num_neighbors=100)
+    edge_index, _, _ = torch.jit.script(distance)(pos, batch, box)
+    assert edge_set(edge_index) == edge_set(distance(pos, batch, box)[0])
+
+
+@mark.parametrize("neighbor_list", ["radius_graph", "cell_list"])
+def test_num_truncated(neighbor_list):
+    torch.manual_seed(1234)
+    pos = torch.cat([torch.rand(10, 3), torch.rand(10, 3) + 10])
+    distance = Distance(0.0, 5.0, max_num_neighbors=5, neighbor_list=neighbor_list)
+    distance(pos)
+    assert distance.num_truncated == 20
+    distance.max_num_neighbors = 9
+    distance(pos)
+    assert distance.num_truncated == 20
+    distance.max_num_neighbors = 10
+    distance(pos)
+    assert distance.num_truncated == 0
+
+
+@mark.parametrize("neighbor_list", ["radius_graph", "cell_list"])
+def test_adaptive_max_num_neighbors(neighbor_list):
+    torch.manual_seed(1234)
+    pos = torch.rand(50, 3)
+    distance = Distance(
+        0.0,
+        5.0,
+        max_num_neighbors=4,
+        neighbor_list=neighbor_list,
+        adaptive_max_num_neighbors=True,
+    )
+    edge_index, _, _ = distance(pos)
+    assert distance.max_num_neighbors == 64
+    assert distance.num_truncated == 0
+    assert edge_index.size(1) == 50 * 49
+
+    # the grown cap is restored from the state dict
+    reloaded = Distance(
+        0.0,
+        5.0,
+        max_num_neighbors=4,
+        neighbor_list=neighbor_list,
+        adaptive_max_num_neighbors=True,
+    )
+    reloaded.load_state_dict(distance.state_dict())
+    assert reloaded.max_num_neighbors == 64
+    assert "grown_max_num_neighbors" not in Distance(0.0, 5.0).state_dict()
+
+    scripted = torch.jit.script(
+        Distance(0.0, 5.0, max_num_neighbors=4, adaptive_max_num_neighbors=True)
+    )
+    assert scripted(pos)[0].size(1) == 50 * 49
+    assert scripted.max_num_neighbors == 64
+    assert scripted.grown_max_num_neighbors == 64
+
+
+def test_symmetrize_half_list():
+    torch.manual_seed(1234)
+    pos = torch.randn(30, 3)
+    full = Distance(0.0, 2.0, loop=True)(pos)[0]
+    half = Distance(0.0, 2.0, loop=True, half_list=True)(pos)[0]
+    assert (half[0] <= half[1]).all()
+
+    edge_index, half_index = symmetrize_half_list(half)
+    assert edge_set(edge_index) == edge_set(full)
+    assert edge_index.size(1) == full.size(1)
+    # every full edge points back to its pair in the half list
+    assert (edge_index.sort(dim=0)[0] == half[:, half_index]).all()
+
+
+@mark.parametrize("model_name", ["graph-network", "transformer"])
+@mark.parametrize("neighbor_embedding", [True, False])
+def test_half_list_model(model_name, neighbor_embedding):
+    z, pos, batch = create_example_batch()
+    args = load_example_args(
+        model_name,
+        remove_prior=True,
+        derivative=True,
+        neighbor_embedding=neighbor_embedding,
+    )
+    torch.manual_seed(1234)
+    ref_model = create_model(args)
+    args["half_list"] = True
+    torch.manual_seed(1234)
+    model = create_model(args)
+
+    energy, _, forces = model(z, pos, batch)
+    ref_energy, _, ref_forces = ref_model(z, pos, batch)
+    torch.testing.assert_allclose(energy, ref_energy)
+    torch.testing.assert_allclose(forces, ref_forces)
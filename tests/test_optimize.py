@@ -2,12 +2,16 @@ import pytest
 from pytest import mark
 import torch as pt
 from torchmdnet.models.model import create_model
-from torchmdnet.optimize import optimize
+from torchmdnet.optimize import optimize, TorchMD_GN_optimized
+
+from utils import load_example_args, create_example_batch
 
 @mark.parametrize('device', ['cpu', 'cuda'])
 @mark.parametrize('num_atoms', [10, 100])
 def test_gn(device, num_atoms):
 
+    pytest.importorskip('NNPOps')
+
     if not pt.cuda.is_available() and device == 'cuda':
         pytest.skip('No GPU')
 
@@ -19,36 +23,81 @@ def test_gn(device, num_atoms):
 
     # Crate a non-optimized model
     #   SchNet: TorchMD_GN(rbf_type='gauss', trainable_rbf=False, activation='ssp', neighbor_embedding=False)
-    args = {
-        'embedding_dimension': 128,
-        'num_layers': 6,
-        'num_rbf': 50,
-        'rbf_type': 'gauss',
-        'trainable_rbf': False,
-        'activation': 'ssp',
-        'neighbor_embedding': False,
-        'cutoff_lower': 0.0,
-        'cutoff_upper': 5.0,
-        'max_z': 100,
-        'max_num_neighbors': num_atoms,
-        'model': 'graph-network',
-        'aggr': 'add',
-        'derivative': True,
-        'atom_filter': -1,
-        'prior_model': None,
-        'output_model': 'Scalar',
-        'reduce_op': 'add'
-    }
+    args = load_example_args('graph-network', remove_prior=True,
+                             embedding_dimension=128, num_layers=6, num_rbf=50,
+                             rbf_type='gauss', trainable_rbf=False, activation='ssp',
+                             neighbor_embedding=False, cutoff_lower=0.0, cutoff_upper=5.0,
+                             max_z=100, max_num_neighbors=num_atoms, aggr='add',
+                             derivative=True, atom_filter=-1, output_model='Scalar',
+                             reduce_op='add')
     ref_model = create_model(args).to(device)
 
     # Execute the non-optimized model
-    ref_energy, ref_gradient = ref_model(elements, positions)
+    ref_energy, _, ref_gradient = ref_model(elements, positions)
 
     # Optimize the model
     model = optimize(ref_model).to(device)
 
     # Execute the optimize model
-    energy, gradient = model(elements, positions)
+    energy, _, gradient = model(elements, positions)
 
     assert pt.allclose(ref_energy, energy, atol=5e-7)
-    assert pt.allclose(ref_gradient, gradient, atol=1e-5)
\ No newline at end of file
+    assert pt.allclose(ref_gradient, gradient, atol=1e-5)
+
+@mark.parametrize('num_molecules', [1, 3])
+@mark.parametrize('neighbor_embedding', [False, True])
+def test_gn_batch(num_molecules, neighbor_embedding):
+
+    pytest.importorskip('NNPOps')
+
+    args = load_example_args('graph-network', remove_prior=True, derivative=True,
+                             rbf_type='gauss', trainable_rbf=False, activation='ssp',
+                             neighbor_embedding=neighbor_embedding, cutoff_lower=0.0)
+    z, pos, batch = create_example_batch(n_atoms=10 * num_molecules)
+    batch = pt.arange(num_molecules).repeat_interleave(10)
+
+    ref_model = create_model(args)
+    ref_energy, _, ref_forces = ref_model(z, pos, batch)
+
+    model = optimize(ref_model)
+    assert isinstance(model.representation_model, TorchMD_GN_optimized)
+    energy, _, forces = model(z, pos, batch)
+
+    assert pt.allclose(ref_energy, energy, atol=5e-7)
+    assert pt.allclose(ref_forces, forces, atol=1e-5)
+
+
+def test_gn_per_layer():
+
+    pytest.importorskip('NNPOps')
+
+    args = load_example_args('graph-network', remove_prior=True, derivative=True,
+                             rbf_type='gauss', trainable_rbf=False, activation='ssp',
+                             neighbor_embedding=False, cutoff_lower=0.0)
+    z, pos, _ = create_example_batch(n_atoms=10)
+
+    ref_model = create_model(args)
+    # NNPOps has no kernel for the filter network of the second interaction block
+    ref_model.representation_model.interactions[1].mlp[1] = pt.nn.SiLU()
+    ref_energy, _, ref_forces = ref_model(z, pos)
+
+    with pytest.warns(UserWarning, match=r'Interaction blocks \[1\] are not optimized'):
+        model = optimize(ref_model)
+    convs = model.representation_model.convs
+    assert convs[0] is not None and convs[1] is None
+    energy, _, forces = model(z, pos)
+
+    assert pt.allclose(ref_energy, energy, atol=5e-7)
+    assert pt.allclose(ref_forces, forces, atol=1e-5)
+
+
+@mark.parametrize('model_name', ['transformer', 'equivariant-transformer'])
+def test_unsupported(model_name):
+
+    args = load_example_args(model_name, remove_prior=True)
+    model = create_model(args)
+    representation_model = model.representation_model
+
+    with pytest.warns(UserWarning, match='not optimized'):
+        model = optimize(model)
+    assert model.representation_model is representation_model
@@ -0,0 +1,94 @@
+import copy
+from os.path import join
+import torch
+from torch import nn
+from pytest import mark, raises
+from torch_geometric.data import DataLoader, Data
+from torchmdnet import models
+from torchmdnet.models.model import create_model, load_model
+from torchmdnet.quantize import quantize_model, quantization_report
+
+from utils import load_example_args, create_example_batch, save_example_checkpoint
+
+
+@mark.parametrize("model_name", models.__all__)
+def test_load_quantized(model_name, tmpdir):
+    torch.manual_seed(1234)
+    z, pos, _ = create_example_batch(n_atoms=40)
+    batch = torch.arange(8).repeat_interleave(5)
+    checkpoint = save_example_checkpoint(join(tmpdir, "model.ckpt"), model_name)
+    ref_model = load_model(checkpoint).eval()
+    model = load_model(checkpoint, quantize="dynamic-int8").eval()
+
+    linears = {name for name, m in model.named_modules() if type(m) == nn.Linear}
+    quantized = {
+        name
+        for name, m in model.named_modules()
+        if isinstance(m, nn.quantized.dynamic.Linear)
+    }
+    assert len(quantized) > 0
+    assert all(
+        name.split(".")[-1]
+        in ["vec_proj", "vec1_proj", "vec2_proj", "dk_proj", "dv_proj"]
+        or name.endswith("attention_layers.0.o_proj")
+        for name in linears
+    )
+
+    with torch.no_grad():
+        pred = model(z, pos, batch)[0]
+        ref_pred = ref_model(z, pos, batch)[0]
+    # the quantization error is small compared to the spread of the predictions
+    assert (pred - ref_pred).abs().mean() < 0.25 * ref_pred.std()
+
+
+def test_quantized_vector_equivariance():
+    torch.manual_seed(1234)
+    rotate = torch.tensor(
+        [
+            [0.9886788, -0.1102370, 0.1017945],
+            [0.1363630, 0.9431761, -0.3030248],
+            [-0.0626055, 0.3134752, 0.9475304],
+        ]
+    )
+
+    args = load_example_args(
+        "equivariant-transformer", prior_model=None, output_model="VectorOutput"
+    )
+    model = quantize_model(create_model(args).eval())
+    z = torch.ones(100, dtype=torch.long)
+    pos = torch.randn(100, 3)
+    batch = torch.arange(50, dtype=torch.long).repeat_interleave(2)
+
+    with torch.no_grad():
+        y = model(z, pos, batch)[0]
+        y_rot = model(z, pos @ rotate, batch)[0]
+    torch.testing.assert_allclose(y @ rotate, y_rot, rtol=1e-3, atol=1e-3)
+
+
+def test_quantize_derivative():
+    args = load_example_args(
+        "equivariant-transformer", remove_prior=True, derivative=True
+    )
+    with raises(ValueError):
+        quantize_model(create_model(args))
+
+
+def test_quantization_report():
+    args = load_example_args("equivariant-transformer", remove_prior=True)
+    reference = create_model(args)
+    quantized = quantize_model(copy.deepcopy(reference))
+
+    samples = []
+    for _ in range(8):
+        z, pos, _ = create_example_batch(multiple_batches=False)
+        samples.append(Data(z=z, pos=pos, y=torch.randn(1, 1)))
+    report = quantization_report(
+        reference, quantized, DataLoader(samples, batch_size=3)
+    )
+
+    assert report["num_samples"] == 8
+    for key in ["fp32_mae", "int8_mae", "mean_deviation", "max_deviation"]:
+        assert report[key] >= 0
+    assert (
+        report["fp32_samples_per_second"] > 0 and report["int8_samples_per_second"] > 0
+    )
@@ -28,3 +28,22 @@ def test_cutoff(name, rbf_class, cutoff_lower, cutoff_upper, y_tol=0.3, x_tol=0.
     ).all(), (
         f"Found entries larger than {y_tol:.1e} above cutoff distance using {name}."
     )
+
+
+@mark.parametrize("cutoff_lower,cutoff_upper", [(0, 5), (1, 5), (3, 15)])
+@mark.parametrize("name,rbf_class", list(rbf_class_mapping.items()))
+def test_table(name, rbf_class, cutoff_lower, cutoff_upper):
+    rbf = rbf_class(cutoff_lower, cutoff_upper, trainable=False)
+    table_rbf = rbf_class(cutoff_lower, cutoff_upper, trainable=False, table_size=4096)
+    x = torch.linspace(0, cutoff_upper, 1000, requires_grad=True)
+
+    y = rbf(x)
+    y_table = table_rbf(x)
+    torch.testing.assert_allclose(y_table, y, atol=1e-4, rtol=0)
+
+    grad = torch.autograd.grad(y.sum(), x)[0]
+    grad_table = torch.autograd.grad(y_table.sum(), x)[0]
+    torch.testing.assert_allclose(grad_table, grad, atol=1e-3, rtol=1e-3)
+
+    table_rbf = torch.jit.script(table_rbf)
+    torch.testing.assert_allclose(table_rbf(x), y_table)
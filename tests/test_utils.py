@@ -1,7 +1,7 @@
 from os.path import join, exists
 from pytest import mark, raises
 import torch
-from torchmdnet.utils import make_splits
+from torchmdnet.utils import make_splits, RunningStats
 
 
 def sum_lengths(*args):
@@ -77,3 +77,14 @@ def test_make_splits_errors():
         make_splits(100, None, None, 5, 1234)
     with raises(AssertionError):
         make_splits(100, 60, 60, None, 1234)
+
+
+@mark.parametrize("shape", [(1,), (3,), ()])
+def test_running_stats(shape):
+    values = torch.randn(1000, *shape) * 3 + 100
+    stats = RunningStats()
+    for chunk in values.split(77):
+        stats.update(chunk)
+    stats.update(values[:0])
+    torch.testing.assert_allclose(stats.mean, values.mean(dim=0))
+    torch.testing.assert_allclose(stats.std, values.std(dim=0))
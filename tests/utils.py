@@ -2,6 +2,7 @@ import yaml
 from os.path import dirname, join
 import torch
 from torch_geometric.data import Dataset, Data
+from torchmdnet.models.model import create_model
 
 
 def load_example_args(model_name, remove_prior=False, **kwargs):
@@ -82,3 +83,11 @@ class DummyDataset(Dataset):
 
     def len(self):
         return len(self.z)
+
+
+def save_example_checkpoint(path, model_name, **kwargs):
+    args = load_example_args(model_name, remove_prior=True, **kwargs)
+    model = create_model(args)
+    state_dict = {"model." + k: v for k, v in model.state_dict().items()}
+    torch.save(dict(hyper_parameters=args, state_dict=state_dict), path)
+    return path
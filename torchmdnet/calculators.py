@@ -1,19 +1,111 @@
 import torch
 from torchmdnet.models.model import load_model
+from torchmdnet.models.utils import Distance
+
+
+def _load_model(netfile, device, skin):
+    model = load_model(netfile, device=device, derivative=True)
+    model.eval()
+    for module in model.modules():
+        if isinstance(module, Distance):
+            module.skin = float(skin)
+            module.reset_verlet_list()
+    return model
 
 
 class External:
-    def __init__(self, netfile, embeddings, device="cpu"):
-        self.model = load_model(netfile, device=device, derivative=True)
+    """Wraps a trained model as an external force provider for torchmd.
+
+    Periodic boxes passed to `calculate` are expected in reduced lower-triangular
+    form with shape (n_replicas, 3, 3) or (3, 3) and are applied with the minimum
+    image convention. An all-zero box disables periodicity.
+
+    Args:
+        netfile (str): Path to the model checkpoint.
+        embeddings (Tensor): Atom types with shape (n_replicas, n_atoms).
+        device (str, optional): Device to run the model on. (default: "cpu")
+        skin (float, optional): If larger than zero, neighbor lists are built with
+            radius cutoff_upper + skin and only rebuilt once an atom has moved
+            more than skin / 2, instead of on every step. (default: 0.0)
+    """
+
+    def __init__(self, netfile, embeddings, device="cpu", skin=0.0):
+        self.model = _load_model(netfile, device, skin)
         self.device = device
         self.n_atoms = embeddings.size(1)
         self.embeddings = embeddings.reshape(-1).to(device)
         self.batch = torch.arange(embeddings.size(0), device=device).repeat_interleave(
             embeddings.size(1)
         )
-        self.model.eval()
 
     def calculate(self, pos, box):
         pos = pos.to(self.device).type(torch.float32).reshape(-1, 3)
-        energy, forces = self.model(self.embeddings, pos, self.batch)
+        if box is not None:
+            # torchmd passes an all-zero box for non-periodic systems
+            box = box.to(self.device).type(torch.float32).reshape(-1, 3, 3)
+            if not box.any():
+                box = None
+        energy, _, forces = self.model(self.embeddings, pos, self.batch, box)
         return energy.detach(), forces.reshape(-1, self.n_atoms, 3).detach()
+
+
+class ReplicaExternal:
+    """Evaluates several replicas, for example for replica exchange or parallel
+    tempering, in a single forward pass of the model.
+
+    The replicas may contain different molecules. Positions and forces are
+    exchanged as padded tensors of shape (n_replicas, max_atoms, 3), where the
+    entries beyond the number of atoms of a replica are ignored on input and
+    zero on output. Inputs and outputs are kept in buffers that are allocated
+    once, so the returned energies and forces are overwritten by the next call
+    to `calculate` and have to be copied if they should be kept.
+
+    Args:
+        netfile (str): Path to the model checkpoint.
+        embeddings (list of Tensor): Atom types of every replica, each with shape
+            (n_atoms,). A tensor of shape (n_replicas, n_atoms) is accepted for
+            replicas of the same molecule.
+        device (str, optional): Device to run the model on. (default: "cpu")
+        skin (float, optional): Skin of the neighbor lists, see `External`.
+            (default: 0.0)
+    """
+
+    def __init__(self, netfile, embeddings, device="cpu", skin=0.0):
+        self.model = _load_model(netfile, device, skin)
+        self.device = device
+        self.n_replicas = len(embeddings)
+        num_atoms = torch.tensor([len(emb) for emb in embeddings], device=device)
+        self.max_atoms = int(num_atoms.max())
+
+        self.embeddings = torch.cat([emb.reshape(-1) for emb in embeddings]).to(device)
+        self.batch = torch.arange(self.n_replicas, device=device).repeat_interleave(
+            num_atoms
+        )
+        # position of every atom in the flattened padded tensors
+        offsets = torch.cumsum(num_atoms, dim=0) - num_atoms
+        self.atom_index = (
+            torch.arange(len(self.embeddings), device=device)
+            - offsets[self.batch]
+            + self.batch * self.max_atoms
+        )
+
+        self.pos = torch.zeros(len(self.embeddings), 3, device=device)
+        self.energies = torch.zeros(self.n_replicas, 1, device=device)
+        self.forces = torch.zeros(self.n_replicas, self.max_atoms, 3, device=device)
+
+    def calculate(self, pos, box):
+        """Returns the energies with shape (n_replicas, 1) and the padded forces
+        with shape (n_replicas, max_atoms, 3) of all replicas.
+        """
+        pos = pos.to(self.device).type(torch.float32).reshape(-1, 3)
+        with torch.no_grad():
+            torch.index_select(pos, 0, self.atom_index, out=self.pos)
+        if box is not None:
+            box = box.to(self.device).type(torch.float32).reshape(-1, 3, 3)
+            if not box.any():
+                box = None
+        energy, _, forces = self.model(self.embeddings, self.pos, self.batch, box)
+        with torch.no_grad():
+            self.energies.copy_(energy)
+            self.forces.view(-1, 3).index_copy_(0, self.atom_index, forces)
+        return self.energies, self.forces
@@ -1,15 +1,142 @@
-from os.path import join
+import os
+import time
+import glob
+import hashlib
+import tempfile
+from os.path import join, exists, dirname
 from tqdm import tqdm
+import numpy as np
 import torch
-from torch.utils.data import Subset
+import torch.distributed as dist
+from torch.utils.data import Subset, Sampler
+from torch.utils.data.distributed import DistributedSampler
 from torch_geometric.data import DataLoader
 from pytorch_lightning import LightningDataModule
 from pytorch_lightning.utilities import rank_zero_warn
 from torchmdnet import datasets
-from torchmdnet.utils import make_splits, MissingEnergyException
+from torchmdnet.utils import make_splits, MissingEnergyException, RunningStats
 from torch_scatter import scatter
 
 
+def get_num_atoms(dataset):
+    """Returns the number of atoms of every sample in :obj:`dataset`. Uses the
+    :obj:`num_atoms` method of the dataset if it has one and loads all samples
+    otherwise.
+    """
+    if isinstance(dataset, Subset):
+        return get_num_atoms(dataset.dataset)[np.asarray(dataset.indices)]
+    if hasattr(dataset, "num_atoms"):
+        return np.asarray(dataset.num_atoms())
+    return np.array([dataset[i].z.size(0) for i in range(len(dataset))])
+
+
+class DynamicBatchSampler(Sampler):
+    r"""Batch sampler that packs samples into batches whose total size stays below
+    a budget, instead of using a fixed number of samples per batch.
+
+    Args:
+        num_atoms (np.ndarray): The number of atoms of every sample.
+        budget (int): The maximum size of a batch. Samples exceeding the budget on
+            their own form a batch of their own.
+        budget_type (str, optional): Whether the size of a sample is its number of
+            atoms (:obj:`"atoms"`) or an estimate of its number of edges
+            (:obj:`"edges"`), :math:`n \min(n - 1, \text{max_num_neighbors})`.
+            (default: :obj:`"atoms"`)
+        max_num_neighbors (int, optional): Used for estimating the number of edges.
+            (default: :obj:`32`)
+        shuffle (bool, optional): Whether to shuffle the samples in every epoch.
+            (default: :obj:`False`)
+        bucket_size (int, optional): If set, consecutive groups of this many
+            samples are sorted by size before packing, so that batches contain
+            molecules of similar size. The order of the batches is shuffled
+            afterwards. (default: :obj:`None`)
+        num_replicas (int, optional): The number of distributed processes. Every
+            process gets the same number of batches, which are assigned round
+            robin after repeating batches from the start as needed.
+            (default: :obj:`1`)
+        rank (int, optional): The rank of the current process. (default: :obj:`0`)
+        seed (int, optional): Seed for shuffling, which has to be identical on all
+            processes. (default: :obj:`0`)
+    """
+
+    def __init__(
+        self,
+        num_atoms,
+        budget,
+        budget_type="atoms",
+        max_num_neighbors=32,
+        shuffle=False,
+        bucket_size=None,
+        num_replicas=1,
+        rank=0,
+        seed=0,
+    ):
+        assert budget_type in ["atoms", "edges"], f'Unknown budget type "{budget_type}".'
+        num_atoms = np.asarray(num_atoms, dtype=np.int64)
+        if budget_type == "atoms":
+            self.sizes = num_atoms
+        else:
+            self.sizes = num_atoms * np.minimum(num_atoms - 1, max_num_neighbors)
+        self.budget = budget
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        # advanced after every iteration, as the DataLoader does not forward
+        # set_epoch calls to batch samplers
+        self.epoch = 0
+        self._cached_batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        if self._cached_batches is not None and self._cached_batches[0] == self.epoch:
+            return self._cached_batches[1]
+
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = np.arange(len(self.sizes))
+        if self.shuffle:
+            order = rng.permutation(order)
+        if self.bucket_size:
+            order = np.concatenate(
+                [
+                    chunk[np.argsort(self.sizes[chunk], kind="stable")]
+                    for chunk in np.split(
+                        order, range(self.bucket_size, len(order), self.bucket_size)
+                    )
+                ]
+            )
+
+        batches, batch, batch_size = [], [], 0
+        for idx, size in zip(order.tolist(), self.sizes[order].tolist()):
+            if len(batch) > 0 and batch_size + size > self.budget:
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(idx)
+            batch_size += size
+        if len(batch) > 0:
+            batches.append(batch)
+
+        if self.shuffle and self.bucket_size:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            batches = batches + batches[: (-len(batches)) % self.num_replicas]
+            batches = batches[self.rank :: self.num_replicas]
+
+        self._cached_batches = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._batches())
+
+
 class DataModule(LightningDataModule):
     def __init__(self, hparams, dataset=None):
         super(DataModule, self).__init__()
@@ -17,6 +144,7 @@ class DataModule(LightningDataModule):
         self._mean, self._std = None, None
         self._saved_dataloaders = dict()
         self.dataset = dataset
+        self._noise_generator = None
 
     def setup(self, stage):
         if self.dataset is None:
@@ -28,21 +156,9 @@ class DataModule(LightningDataModule):
                     self.hparams["force_files"],
                 )
             else:
-                if self.hparams['position_noise_scale'] > 0.:
-                    def transform(data):
-                        noise = torch.randn_like(data.pos) * self.hparams['position_noise_scale']
-                        data.pos_target = noise
-                        data.pos = data.pos + noise
-                        return data
-                else:
-                    transform = None
-
-                dataset_factory = lambda t: getattr(datasets, self.hparams["dataset"])(self.hparams["dataset_root"], dataset_arg=self.hparams["dataset_arg"], transform=t)
-
-                # Noisy version of dataset
-                self.dataset_maybe_noisy = dataset_factory(transform)
-                # Clean version of dataset
-                self.dataset = dataset_factory(None)
+                self.dataset = getattr(datasets, self.hparams["dataset"])(
+                    self.hparams["dataset_root"], dataset_arg=self.hparams["dataset_arg"]
+                )
 
         self.idx_train, self.idx_val, self.idx_test = make_splits(
             len(self.dataset),
@@ -57,15 +173,10 @@ class DataModule(LightningDataModule):
             f"train {len(self.idx_train)}, val {len(self.idx_val)}, test {len(self.idx_test)}"
         )
 
-        self.train_dataset = Subset(self.dataset_maybe_noisy, self.idx_train)
-
-        # If denoising is the only task, test/val datasets are also used for measuring denoising performance.
-        if self.hparams['denoising_only']:
-            self.val_dataset = Subset(self.dataset_maybe_noisy, self.idx_val)
-            self.test_dataset = Subset(self.dataset_maybe_noisy, self.idx_test)            
-        else:
-            self.val_dataset = Subset(self.dataset, self.idx_val)
-            self.test_dataset = Subset(self.dataset, self.idx_test)
+        # position noise for denoising is added to whole batches in on_after_batch_transfer
+        self.train_dataset = Subset(self.dataset, self.idx_train)
+        self.val_dataset = Subset(self.dataset, self.idx_val)
+        self.test_dataset = Subset(self.dataset, self.idx_test)
 
         if self.hparams["standardize"]:
             self._standardize()
@@ -85,6 +196,31 @@ class DataModule(LightningDataModule):
     def test_dataloader(self):
         return self._get_dataloader(self.test_dataset, "test")
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Denoising: add Gaussian noise to the positions of the whole batch on the
+        # training device. If denoising is the only task, val/test batches are also
+        # noisy to measure denoising performance.
+        noise_scale = self.hparams.get("position_noise_scale", 0.0)
+        if noise_scale > 0 and (self.trainer.training or self.hparams["denoising_only"]):
+            noise = torch.randn(
+                batch.pos.shape,
+                generator=self._get_noise_generator(batch.pos.device),
+                device=batch.pos.device,
+                dtype=batch.pos.dtype,
+            )
+            batch.pos_target = noise * noise_scale
+            batch.pos = batch.pos + batch.pos_target
+        return batch
+
+    def _get_noise_generator(self, device):
+        # seeded per rank, so that ranks draw different but reproducible noise
+        if self._noise_generator is None or self._noise_generator.device != device:
+            self._noise_generator = torch.Generator(device=device)
+            self._noise_generator.manual_seed(
+                self.hparams["seed"] + self.trainer.global_rank
+            )
+        return self._noise_generator
+
     @property
     def atomref(self):
         if hasattr(self.dataset, "get_atomref"):
@@ -115,46 +251,158 @@ class DataModule(LightningDataModule):
             batch_size = self.hparams["inference_batch_size"]
             shuffle = False
 
-        dl = DataLoader(
-            dataset=dataset,
-            batch_size=batch_size,
-            shuffle=shuffle,
-            num_workers=self.hparams["num_workers"],
-            pin_memory=True,
-        )
+        if self.hparams.get("batch_budget") is not None:
+            # Lightning cannot insert its distributed sampler next to a batch sampler,
+            # so the data is split between the processes here
+            if stage == "train":
+                dl = DataLoader(
+                    dataset=dataset,
+                    batch_sampler=DynamicBatchSampler(
+                        get_num_atoms(dataset),
+                        self.hparams["batch_budget"],
+                        budget_type=self.hparams.get("batch_budget_type", "atoms"),
+                        max_num_neighbors=self.hparams["max_num_neighbors"],
+                        shuffle=True,
+                        bucket_size=self.hparams.get("batch_bucket_size"),
+                        num_replicas=self.trainer.world_size,
+                        rank=self.trainer.global_rank,
+                        seed=self.hparams["seed"],
+                    ),
+                    num_workers=self.hparams["num_workers"],
+                    pin_memory=True,
+                )
+            else:
+                dl = DataLoader(
+                    dataset=dataset,
+                    batch_size=batch_size,
+                    sampler=DistributedSampler(
+                        dataset,
+                        num_replicas=self.trainer.world_size,
+                        rank=self.trainer.global_rank,
+                        shuffle=False,
+                    )
+                    if self.trainer.world_size > 1
+                    else None,
+                    num_workers=self.hparams["num_workers"],
+                    pin_memory=True,
+                )
+        else:
+            dl = DataLoader(
+                dataset=dataset,
+                batch_size=batch_size,
+                shuffle=shuffle,
+                num_workers=self.hparams["num_workers"],
+                pin_memory=True,
+            )
 
         if store_dataloader:
             self._saved_dataloaders[stage] = dl
         return dl
 
     def _standardize(self):
-        def get_energy(batch, atomref):
-            if batch.y is None:
-                raise MissingEnergyException()
+        # only remove atomref energies if the atomref prior is used
+        atomref = self.atomref if self.hparams["prior_model"] == "Atomref" else None
+        cache_path = join(
+            self.hparams["log_dir"],
+            f"standardize-{self._standardize_cache_key(atomref)}.pt",
+        )
 
-            if atomref is None:
-                return batch.y.clone()
+        if dist.is_available() and dist.is_initialized():
+            # compute the statistics on rank zero and share them with the other ranks
+            stats = [None]
+            if dist.get_rank() == 0:
+                stats[0] = self._load_or_compute_energy_stats(cache_path, atomref)
+            dist.broadcast_object_list(stats, src=0)
+            stats = stats[0]
+        elif int(os.environ.get("LOCAL_RANK", 0)) > 0:
+            # the DDP processes are launched before the process group exists (the
+            # data module is set up before the trainer in train.py), local rank zero
+            # writes the cache and the other processes of the node read it
+            stats = self._wait_for_energy_stats(cache_path, atomref)
+        else:
+            stats = self._load_or_compute_energy_stats(cache_path, atomref)
 
-            # remove atomref energies from the target energy
-            atomref_energy = scatter(atomref[batch.z], batch.batch, dim=0)
-            return (batch.y.squeeze() - atomref_energy.squeeze()).clone()
+        if stats is not None:
+            self._mean, self._std = stats
 
-        data = tqdm(
-            self._get_dataloader(self.train_dataset, "val", store_dataloader=False),
-            desc="computing mean and std",
-        )
+    def _standardize_cache_key(self, atomref):
+        # the statistics are cached for the dataset, training split and atomref
+        key = hashlib.sha1()
+        for name in [
+            "dataset",
+            "dataset_root",
+            "dataset_arg",
+            "coord_files",
+            "embed_files",
+            "energy_files",
+            "force_files",
+        ]:
+            key.update(repr((name, self.hparams.get(name))).encode())
+        for name in ["coord_files", "embed_files", "energy_files", "force_files"]:
+            if self.hparams.get(name) is not None:
+                # include the files matched by the globs of the Custom dataset,
+                # so that changed files invalidate the cache
+                for path in sorted(glob.glob(self.hparams[name])):
+                    stat = os.stat(path)
+                    key.update(repr((path, stat.st_size, stat.st_mtime_ns)).encode())
+        key.update(repr(len(self.dataset)).encode())
+        key.update(np.asarray(self.idx_train).tobytes())
+        if atomref is not None:
+            key.update(atomref.cpu().numpy().tobytes())
+        return key.hexdigest()
+
+    def _load_or_compute_energy_stats(self, cache_path, atomref):
+        if exists(cache_path):
+            return torch.load(cache_path)
         try:
-            # only remove atomref energies if the atomref prior is used
-            atomref = self.atomref if self.hparams["prior_model"] == "Atomref" else None
-            # extract energies from the data
-            ys = torch.cat([get_energy(batch, atomref) for batch in data])
+            stats = self._compute_energy_stats(atomref)
         except MissingEnergyException:
             rank_zero_warn(
                 "Standardize is true but failed to compute dataset mean and "
                 "standard deviation. Maybe the dataset only contains forces."
             )
-            return
+            stats = None
+        # write to a unique temporary file first, the cache only appears complete
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(cache_path), suffix=".tmp")
+        os.close(fd)
+        torch.save(stats, tmp_path)
+        os.replace(tmp_path, cache_path)
+        return stats
+
+    def _wait_for_energy_stats(self, cache_path, atomref, timeout=3600):
+        deadline = time.monotonic() + timeout
+        while not exists(cache_path):
+            if time.monotonic() > deadline:
+                # local rank zero did not finish in time, compute the statistics
+                # in this process instead
+                return self._load_or_compute_energy_stats(cache_path, atomref)
+            time.sleep(1)
+        return torch.load(cache_path)
+
+    def _compute_energy_stats(self, atomref):
+        stats = RunningStats()
+        if callable(getattr(self.dataset, "energies", None)):
+            # read the energies directly from the dataset's arrays
+            energies = self.dataset.energies(atomref)[np.asarray(self.idx_train)]
+            for start in range(0, len(energies), 1000000):
+                stats.update(energies[start : start + 1000000])
+        else:
+
+            def get_energy(batch, atomref):
+                if batch.y is None:
+                    raise MissingEnergyException()
+
+                if atomref is None:
+                    return batch.y.clone()
 
-        # compute mean and standard deviation
-        self._mean = ys.mean(dim=0)
-        self._std = ys.std(dim=0)
+                # remove atomref energies from the target energy
+                atomref_energy = scatter(atomref[batch.z], batch.batch, dim=0)
+                return (batch.y.squeeze() - atomref_energy.squeeze()).clone()
+
+            data = tqdm(
+                self._get_dataloader(self.train_dataset, "val", store_dataloader=False),
+                desc="computing mean and std",
+            )
+            for batch in data:
+                stats.update(get_energy(batch, atomref))
+        return stats.mean, stats.std
@@ -2,12 +2,14 @@ import os
 from os.path import join
 from tqdm import tqdm
 from urllib import request
+import numpy as np
 import torch
-from torch_geometric.data import InMemoryDataset, extract_tar, Data
+from torch_geometric.data import extract_tar, Data
+from torchmdnet.datasets.memmap import MemmapDataset
 import h5py
 
 
-class ANI1(InMemoryDataset):
+class ANI1(MemmapDataset):
 
     raw_url = "https://ndownloader.figshare.com/files/9057631"
 
@@ -22,9 +24,11 @@ class ANI1(InMemoryDataset):
         "O": -75.0362229210 * HAR2EV,
     }
 
+    mol_fields = dict(y=(np.float32, (1,)))
+
     def __init__(self, root, transform=None, pre_transform=None, **kwargs):
         super(ANI1, self).__init__(root, transform, pre_transform)
-        self.data, self.slices = torch.load(self.processed_paths[0])
+        self.storage = self.memmap_storage("ani1")
 
     @property
     def raw_file_names(self):
@@ -32,7 +36,7 @@ class ANI1(InMemoryDataset):
 
     @property
     def processed_file_names(self):
-        return ["ani1.pt"]
+        return self.memmap_file_names("ani1")
 
     def download(self):
         raw_archive = join(self.raw_dir, "ANI1_release.tar.gz")
@@ -42,37 +46,43 @@ class ANI1(InMemoryDataset):
         os.remove(raw_archive)
 
     def process(self):
-        data_list = []
-        for path in tqdm(self.raw_paths, desc="raw h5 files"):
-            data = h5py.File(path, "r")
-            for file_name in data:
-                for molecule_name in tqdm(
-                    data[file_name], desc="molecules", leave=False
-                ):
-                    group = data[file_name][molecule_name]
-                    elements = torch.tensor(
-                        [
-                            self.element_numbers[str(elem)[-2]]
-                            for elem in group["species"]
-                        ]
-                    )
-                    positions = torch.from_numpy(group["coordinates"][:])
-                    energies = torch.from_numpy(
-                        group["energies"][:] * self.HAR2EV
-                    ).float()
-
-                    elements = elements.expand(positions.size(0), -1)
-                    for z, pos, energy in zip(elements, positions, energies):
-                        data_list.append(Data(z=z, pos=pos, y=energy.view(1, 1)))
-
-        if self.pre_filter is not None:
-            data_list = [data for data in data_list if self.pre_filter(data)]
-
-        if self.pre_transform is not None:
-            data_list = [self.pre_transform(data) for data in data_list]
-
-        data, slices = self.collate(data_list)
-        torch.save((data, slices), self.processed_paths[0])
+        # the raw files are streamed one at a time and every molecule is written
+        # as a block of all its conformers, which share the same atom types
+        with self.memmap_writer("ani1") as writer:
+            for path in tqdm(self.raw_paths, desc="raw h5 files"):
+                with h5py.File(path, "r") as data:
+                    for file_name in data:
+                        for molecule_name in tqdm(
+                            data[file_name], desc="molecules", leave=False
+                        ):
+                            group = data[file_name][molecule_name]
+                            z = np.array(
+                                [
+                                    self.element_numbers[str(elem)[-2]]
+                                    for elem in group["species"]
+                                ]
+                            )
+                            pos = group["coordinates"][:]
+                            y = group["energies"][:] * self.HAR2EV
+                            self.write_molecule(writer, z, pos, y)
+
+    def write_molecule(self, writer, z, pos, y):
+        """Writes all conformers of a molecule with atom types :obj:`z`,
+        positions :obj:`pos` and energies :obj:`y` in eV.
+        """
+        if self.pre_filter is None and self.pre_transform is None:
+            writer.write(
+                np.full(len(pos), len(z)), z=np.tile(z, len(pos)), pos=pos, y=y
+            )
+            return
+        z = torch.from_numpy(z)
+        for conf_pos, energy in zip(pos, y):
+            data = Data(
+                z=z,
+                pos=torch.from_numpy(conf_pos).float(),
+                y=torch.tensor([[energy]], dtype=torch.float32),
+            )
+            self.append_data(writer, data)
 
     def get_atomref(self, max_z=100):
         out = torch.zeros(max_z)
@@ -2,6 +2,7 @@ import glob
 import numpy as np
 import torch
 from torch_geometric.data import Dataset, Data
+from torchmdnet.utils import MissingEnergyException
 
 
 class Custom(Dataset):
@@ -49,14 +50,16 @@ class Custom(Dataset):
 
         print("Number of files: ", len(self.coordfiles))
 
-        # create index
-        self.index = []
+        # create index, reading only the headers of the coordinate, energy and
+        # force files. The embeddings are small and loaded once.
+        self.embeddings = []
+        sizes = []
         nfiles = len(self.coordfiles)
         for i in range(nfiles):
-            coord_data = np.load(self.coordfiles[i])
-            embed_data = np.load(self.embedfiles[i]).astype(np.int)
-            size = coord_data.shape[0]
-            self.index.extend(list(zip([i] * size, range(size))))
+            coord_data = np.load(self.coordfiles[i], mmap_mode="r")
+            embed_data = np.load(self.embedfiles[i]).astype(np.int64)
+            self.embeddings.append(embed_data)
+            sizes.append(coord_data.shape[0])
 
             # consistency check
             assert coord_data.shape[1] == embed_data.shape[0], (
@@ -64,42 +67,87 @@ class Custom(Dataset):
                 f"does not match number of atoms in embed file {i} ({embed_data.shape[0]})."
             )
             if self.has_energies:
-                energy_data = np.load(self.energyfiles[i])
+                energy_data = np.load(self.energyfiles[i], mmap_mode="r")
                 assert coord_data.shape[0] == energy_data.shape[0], (
                     f"Number of frames in coordinate file {i} ({coord_data.shape[0]}) "
                     f"does not match number of frames in energy file {i} ({energy_data.shape[0]})."
                 )
             if self.has_forces:
-                force_data = np.load(self.forcefiles[i])
+                force_data = np.load(self.forcefiles[i], mmap_mode="r")
                 assert coord_data.shape == force_data.shape, (
                     f"Data shape of coordinate file {i} {coord_data.shape} "
                     f"does not match the shape of force file {i} {force_data.shape}."
                 )
-        print("Combined dataset size {}".format(len(self.index)))
+        # index of the first frame of every file
+        self.file_offsets = np.cumsum([0] + sizes)
+        # memory maps are opened on first use in every process
+        self._mmaps = None
+        print("Combined dataset size {}".format(len(self)))
+
+    def _get_mmaps(self, fileid):
+        if self._mmaps is None:
+            self._mmaps = dict()
+        if fileid not in self._mmaps:
+            self._mmaps[fileid] = (
+                np.load(self.coordfiles[fileid], mmap_mode="r"),
+                (
+                    np.load(self.energyfiles[fileid], mmap_mode="r")
+                    if self.has_energies
+                    else None
+                ),
+                (
+                    np.load(self.forcefiles[fileid], mmap_mode="r")
+                    if self.has_forces
+                    else None
+                ),
+            )
+        return self._mmaps[fileid]
 
-    def get(self, idx):
-        fileid, index = self.index[idx]
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_mmaps"] = None
+        return state
 
-        coord_data = np.array(np.load(self.coordfiles[fileid], mmap_mode="r")[index])
-        embed_data = np.load(self.embedfiles[fileid]).astype(np.int)
+    def get(self, idx):
+        fileid = np.searchsorted(self.file_offsets, idx, side="right") - 1
+        index = idx - self.file_offsets[fileid]
+        coords, energies, forces = self._get_mmaps(fileid)
 
         features = dict(
-            pos=torch.from_numpy(coord_data), z=torch.from_numpy(embed_data)
+            pos=torch.from_numpy(np.array(coords[index])),
+            z=torch.from_numpy(self.embeddings[fileid].copy()),
         )
 
         if self.has_energies:
-            energy_data = np.array(
-                np.load(self.energyfiles[fileid], mmap_mode="r")[index]
-            )
-            features["y"] = torch.from_numpy(energy_data)
+            features["y"] = torch.from_numpy(np.array(energies[index]))
 
         if self.has_forces:
-            force_data = np.array(
-                np.load(self.forcefiles[fileid], mmap_mode="r")[index]
-            )
-            features["dy"] = torch.from_numpy(force_data)
+            features["dy"] = torch.from_numpy(np.array(forces[index]))
 
         return Data(**features)
 
     def len(self):
-        return len(self.index)
+        return int(self.file_offsets[-1])
+
+    def num_atoms(self):
+        """Returns the number of atoms of every sample without loading them."""
+        return np.repeat(
+            [len(embed) for embed in self.embeddings], np.diff(self.file_offsets)
+        )
+
+    def energies(self, atomref=None):
+        """Returns the energy of every sample without creating :obj:`Data`
+        objects. If :obj:`atomref` is given, the sum of the reference energies
+        of the atoms is subtracted.
+        """
+        if not self.has_energies:
+            raise MissingEnergyException()
+        energies = []
+        for fileid in range(len(self.coordfiles)):
+            energy = np.asarray(self._get_mmaps(fileid)[1], dtype=np.float64)
+            energy = energy.reshape(-1)
+            if atomref is not None:
+                atomref_energy = np.asarray(atomref, dtype=np.float64).reshape(-1)
+                energy = energy - atomref_energy[self.embeddings[fileid]].sum()
+            energies.append(energy)
+        return np.concatenate(energies)
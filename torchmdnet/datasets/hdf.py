@@ -1,3 +1,5 @@
+import os
+import numpy as np
 import torch
 from torch_geometric.data import Dataset, Data
 import h5py
@@ -14,46 +16,126 @@ class HDF5(Dataset):
     and "energy" (the energy of each sample).  It may optionally include an array
     called "forces" (the force on each atom).
 
+    The files are only opened on first access in every process, so that forked
+    DataLoader workers do not share h5py handles. A batch of samples requested
+    through :meth:`__getitems__` is read with one h5py call per array of every
+    group it touches instead of one call per sample and array. The DataLoader
+    only uses :meth:`__getitems__` from torch 2.0 on.
+
     Args:
         filename (string): A semicolon separated list of HDF5 files.
     """
 
     def __init__(self, filename, **kwargs):
         super(HDF5, self).__init__()
-        files = [h5py.File(f, "r") for f in filename.split(";")]
-        self.index = []
-        self.has_forces = False
-        for file in files:
-            for group_name in file:
-                group = file[group_name]
-                types = group["types"]
-                pos = group["pos"]
-                energy = group["energy"]
-                if "forces" in group:
-                    self.has_forces = True
-                    forces = group["forces"]
-                    for i in range(len(energy)):
-                        self.index.append((types, pos, energy, forces, i))
-                else:
-                    for i in range(len(energy)):
-                        self.index.append((types, pos, energy, i))
+        self.filenames = filename.split(";")
+        # every group is identified by its file index and name, samples are
+        # found by binary search over the cumulative group sizes
+        self.groups = []
+        self.group_has_forces = []
+        sizes = []
+        for file_idx, filename in enumerate(self.filenames):
+            with h5py.File(filename, "r") as file:
+                for group_name in file:
+                    group = file[group_name]
+                    self.groups.append((file_idx, group_name))
+                    self.group_has_forces.append("forces" in group)
+                    sizes.append(len(group["energy"]))
+        self.has_forces = any(self.group_has_forces)
+        self.group_offsets = np.cumsum([0] + sizes)
+        self._files = None
+        self._pid = None
+
+    def _get_group(self, group_idx):
+        # (re)open the files in every new process
+        if self._files is None or self._pid != os.getpid():
+            self._files = [h5py.File(f, "r") for f in self.filenames]
+            self._pid = os.getpid()
+        file_idx, group_name = self.groups[group_idx]
+        return self._files[file_idx][group_name]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_files"] = None
+        state["_pid"] = None
+        return state
+
+    def _read(self, indices):
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        group_indices = np.searchsorted(self.group_offsets, indices, side="right") - 1
+        samples = [None] * len(indices)
+        for group_idx in np.unique(group_indices):
+            group = self._get_group(group_idx)
+            fields = ["types", "pos", "energy"]
+            if self.group_has_forces[group_idx]:
+                fields.append("forces")
+            positions = np.nonzero(group_indices == group_idx)[0]
+            local = indices[positions] - self.group_offsets[group_idx]
+            # h5py only accepts increasing indices without duplicates
+            unique, inverse = np.unique(local, return_inverse=True)
+            start, end = unique[0], unique[-1] + 1
+            if end - start <= 2 * len(unique):
+                # dense enough that reading the bounding range is cheaper than
+                # selecting the samples one by one
+                blocks = {name: group[name][start:end] for name in fields}
+                rows = unique[inverse] - start
+            else:
+                blocks = {name: group[name][unique] for name in fields}
+                rows = inverse
+            for position, i in zip(positions, rows.reshape(-1)):
+                data = Data(
+                    pos=torch.from_numpy(blocks["pos"][i]),
+                    z=torch.from_numpy(blocks["types"][i]).to(torch.long),
+                    y=torch.from_numpy(np.array(blocks["energy"][i])).view(1, -1),
+                )
+                if "forces" in blocks:
+                    data.dy = torch.from_numpy(blocks["forces"][i])
+                samples[position] = data
+        return samples
 
     def get(self, idx):
-        if self.has_forces:
-            types, pos, energy, forces, i = self.index[idx]
-            return Data(
-                pos=torch.from_numpy(pos[i]),
-                z=torch.from_numpy(types[i]).to(torch.long),
-                y=torch.tensor([[energy[i]]]),
-                dy=torch.from_numpy(forces[i]),
-            )
-        else:
-            types, pos, energy, i = self.index[idx]
-            return Data(
-                pos=torch.from_numpy(pos[i]),
-                z=torch.from_numpy(types[i]).to(torch.long),
-                y=torch.tensor([[energy[i]]]),
-            )
+        return self._read([idx])[0]
+
+    def __getitems__(self, indices):
+        """Returns the samples at :obj:`indices`, reading the samples of each
+        group at once. Used by the DataLoader to fetch whole batches.
+        """
+        dataset_indices = self.indices()
+        samples = self._read([dataset_indices[idx] for idx in indices])
+        if self.transform is not None:
+            samples = [self.transform(data) for data in samples]
+        return samples
 
     def len(self):
-        return len(self.index)
+        return int(self.group_offsets[-1])
+
+    def _scan_groups(self):
+        # metadata is read from files that are only opened for the scan, so that
+        # no handles are left open in the main process before workers are forked
+        for file_idx, filename in enumerate(self.filenames):
+            with h5py.File(filename, "r") as file:
+                for group_file_idx, group_name in self.groups:
+                    if group_file_idx == file_idx:
+                        yield file[group_name]
+
+    def num_atoms(self):
+        """Returns the number of atoms of every sample without loading them."""
+        return np.repeat(
+            [group["types"].shape[1] for group in self._scan_groups()],
+            np.diff(self.group_offsets),
+        )
+
+    def energies(self, atomref=None):
+        """Returns the energy of every sample without creating :obj:`Data`
+        objects. If :obj:`atomref` is given, the sum of the reference energies
+        of the atoms is subtracted.
+        """
+        energies = []
+        for group in self._scan_groups():
+            energy = np.asarray(group["energy"][:], dtype=np.float64)
+            energy = energy.reshape(len(energy), -1)[:, 0]
+            if atomref is not None:
+                atomref_energy = np.asarray(atomref, dtype=np.float64).reshape(-1)
+                energy = energy - atomref_energy[group["types"][:]].sum(axis=1)
+            energies.append(energy)
+        return np.concatenate(energies)
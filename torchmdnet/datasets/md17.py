@@ -1,10 +1,11 @@
 import torch
-from torch_geometric.data import InMemoryDataset, download_url, Data
+from torch_geometric.data import download_url, Data
 from pytorch_lightning.utilities import rank_zero_warn
 import numpy as np
+from torchmdnet.datasets.memmap import MemmapDataset, ConcatStorage
 
 
-class MD17(InMemoryDataset):
+class MD17(MemmapDataset):
     """Machine learning of accurate energy-conserving molecular force fields (Chmiela et al. 2017)
     This class provides functionality for loading MD trajectories from the original dataset, not the revised versions.
     See http://www.quantum-machine.org/gdml/#datasets for details.
@@ -25,6 +26,9 @@ class MD17(InMemoryDataset):
 
     available_molecules = list(molecule_files.keys())
 
+    mol_fields = dict(y=(np.float32, (1,)))
+    atom_fields = dict(**MemmapDataset.atom_fields, dy=(np.float32, (3,)))
+
     def __init__(self, root, transform=None, pre_transform=None, dataset_arg=None):
         assert dataset_arg is not None, (
             "Please provide the desired comma separated molecule(s) through"
@@ -44,58 +48,50 @@ class MD17(InMemoryDataset):
 
         super(MD17, self).__init__(root, transform, pre_transform)
 
-        self.offsets = [0]
-        self.data_all, self.slices_all = [], []
-        for path in self.processed_paths:
-            data, slices = torch.load(path)
-            self.data_all.append(data)
-            self.slices_all.append(slices)
-            self.offsets.append(
-                len(slices[list(slices.keys())[0]]) - 1 + self.offsets[-1]
-            )
-
-    def len(self):
-        return sum(
-            len(slices[list(slices.keys())[0]]) - 1 for slices in self.slices_all
+        self.storage = ConcatStorage(
+            [self.memmap_storage(f"md17-{mol}") for mol in self.molecules]
         )
 
-    def get(self, idx):
-        data_idx = 0
-        while data_idx < len(self.data_all) - 1 and idx >= self.offsets[data_idx + 1]:
-            data_idx += 1
-        self.data = self.data_all[data_idx]
-        self.slices = self.slices_all[data_idx]
-        return super(MD17, self).get(idx - self.offsets[data_idx])
-
     @property
     def raw_file_names(self):
         return [MD17.molecule_files[mol] for mol in self.molecules]
 
     @property
     def processed_file_names(self):
-        return [f"md17-{mol}.pt" for mol in self.molecules]
+        return [
+            file_name
+            for mol in self.molecules
+            for file_name in self.memmap_file_names(f"md17-{mol}")
+        ]
 
     def download(self):
         for file_name in self.raw_file_names:
             download_url(MD17.raw_url + file_name, self.raw_dir)
 
     def process(self):
-        for path in self.raw_paths:
+        for mol, path in zip(self.molecules, self.raw_paths):
             data_npz = np.load(path)
-            z = torch.from_numpy(data_npz["z"]).long()
-            positions = torch.from_numpy(data_npz["R"]).float()
-            energies = torch.from_numpy(data_npz["E"]).float()
-            forces = torch.from_numpy(data_npz["F"]).float()
-
-            samples = []
-            for pos, y, dy in zip(positions, energies, forces):
-                samples.append(Data(z=z, pos=pos, y=y.unsqueeze(1), dy=dy))
-
-            if self.pre_filter is not None:
-                samples = [data for data in samples if self.pre_filter(data)]
-
-            if self.pre_transform is not None:
-                samples = [self.pre_transform(data) for data in samples]
-
-            data, slices = self.collate(samples)
-            torch.save((data, slices), self.processed_paths[0])
+            z, positions = data_npz["z"], data_npz["R"]
+            energies, forces = data_npz["E"], data_npz["F"]
+
+            with self.memmap_writer(f"md17-{mol}") as writer:
+                if self.pre_filter is None and self.pre_transform is None:
+                    # all conformers share the same atom types and are written
+                    # as a single block
+                    writer.write(
+                        np.full(len(positions), len(z)),
+                        z=np.tile(z, len(positions)),
+                        pos=positions,
+                        y=energies,
+                        dy=forces,
+                    )
+                    continue
+                z = torch.from_numpy(z).long()
+                for pos, y, dy in zip(positions, energies, forces):
+                    data = Data(
+                        z=z,
+                        pos=torch.from_numpy(pos).float(),
+                        y=torch.from_numpy(y).float().unsqueeze(1),
+                        dy=torch.from_numpy(dy).float(),
+                    )
+                    self.append_data(writer, data)
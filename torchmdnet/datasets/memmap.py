@@ -0,0 +1,274 @@
+import os
+import numpy as np
+import torch
+from torch_geometric.data import Dataset, Data
+from torchmdnet.utils import MissingEnergyException
+
+
+def memmap_file_names(name, atom_fields, mol_fields):
+    return [f"{name}.{field}.mmap" for field in ["offsets", *atom_fields, *mol_fields]]
+
+
+def _memmap(path, dtype, shape):
+    if os.path.getsize(path) == 0:
+        # empty files cannot be mapped
+        return np.empty((0, *shape), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r").reshape(-1, *shape)
+
+
+class MemmapWriter:
+    r"""Writes molecules into flat binary files, which can be memory-mapped by
+    :class:`MemmapStorage`.
+
+    Per-atom fields of all molecules are concatenated along the first dimension
+    and per-molecule fields are stacked. An additional offsets file stores the
+    index of the first atom of every molecule. The files are written under
+    temporary names and only renamed when the writer is closed, so that an
+    interrupted run does not leave behind files that look complete. Used as a
+    context manager, the temporary files are removed if an exception occurs.
+
+    Args:
+        prefix (str): Path prefix of the output files. Field :obj:`name` is
+            written to :obj:`{prefix}.{name}.mmap`.
+        atom_fields (dict): Maps the names of per-atom fields to the numpy dtype
+            and the shape of the entry of a single atom.
+        mol_fields (dict): Maps the names of per-molecule fields to the numpy
+            dtype and the shape of the entry of a single molecule.
+    """
+
+    def __init__(self, prefix, atom_fields, mol_fields):
+        self.prefix = prefix
+        self.atom_fields = atom_fields
+        self.mol_fields = mol_fields
+        self.files = {
+            name: open(self._path(name, tmp=True), "wb")
+            for name in ["offsets", *atom_fields, *mol_fields]
+        }
+
+    def _path(self, name, tmp=False):
+        return f"{self.prefix}.{name}.mmap" + (".tmp" if tmp else "")
+
+    def write(self, num_atoms, **fields):
+        """Appends a block of molecules with :obj:`num_atoms` atoms each. Per-atom
+        fields must contain the entries of all atoms of the block in order and
+        per-molecule fields one entry per molecule.
+        """
+        num_atoms = np.asarray(num_atoms, dtype=np.int64).reshape(-1)
+        assert set(fields) == set(self.atom_fields) | set(self.mol_fields), (
+            f"Expected the fields {', '.join(self.atom_fields)}, "
+            f"{', '.join(self.mol_fields)} but got {', '.join(fields)}."
+        )
+        for name, value in fields.items():
+            if name in self.atom_fields:
+                dtype, shape = self.atom_fields[name]
+                size = num_atoms.sum()
+            else:
+                dtype, shape = self.mol_fields[name]
+                size = len(num_atoms)
+            value = np.asarray(value, dtype=dtype).reshape(-1, *shape)
+            assert (
+                len(value) == size
+            ), f"Field {name} has {len(value)} entries but {size} were expected."
+            value.tofile(self.files[name])
+        # the number of atoms is converted to offsets when closing
+        num_atoms.tofile(self.files["offsets"])
+
+    def append(self, **fields):
+        """Appends a single molecule."""
+        name = next(iter(self.atom_fields))
+        shape = self.atom_fields[name][1]
+        num_atoms = np.asarray(fields[name]).reshape(-1, *shape).shape[0]
+        self.write([num_atoms], **fields)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        num_atoms = np.fromfile(self._path("offsets", tmp=True), dtype=np.int64)
+        offsets = np.zeros(len(num_atoms) + 1, dtype=np.int64)
+        np.cumsum(num_atoms, out=offsets[1:])
+        offsets.tofile(self._path("offsets", tmp=True))
+        for name in self.files:
+            os.replace(self._path(name, tmp=True), self._path(name))
+
+    def abort(self):
+        for name, file in self.files.items():
+            file.close()
+            os.remove(self._path(name, tmp=True))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class MemmapStorage:
+    r"""Read-only access to the files written by :class:`MemmapWriter`.
+
+    The files are only mapped on first access. Pickling drops the mappings, so
+    every DataLoader worker maps the files itself and all of them share the
+    same pages through the OS page cache instead of holding private copies.
+    """
+
+    def __init__(self, prefix, atom_fields, mol_fields):
+        self.prefix = prefix
+        self.atom_fields = atom_fields
+        self.mol_fields = mol_fields
+        self._offsets = None
+        self._arrays = None
+
+    def _open(self):
+        self._offsets = _memmap(f"{self.prefix}.offsets.mmap", np.int64, ())
+        self._arrays = {
+            name: _memmap(f"{self.prefix}.{name}.mmap", dtype, shape)
+            for name, (dtype, shape) in {**self.atom_fields, **self.mol_fields}.items()
+        }
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._open()
+        return self._offsets
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._open()
+        return self._arrays
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        sample = dict()
+        for name, array in self.arrays.items():
+            if name in self.atom_fields:
+                sample[name] = array[start:end]
+            else:
+                sample[name] = array[idx : idx + 1]
+        return sample
+
+    def num_atoms(self):
+        return np.diff(self.offsets)
+
+    def energies(self, atomref=None, chunk_size=1000000):
+        if "y" not in self.mol_fields:
+            raise MissingEnergyException()
+        energies = np.asarray(self.arrays["y"], dtype=np.float64)
+        if atomref is None:
+            return energies
+        atomref = np.asarray(atomref, dtype=np.float64).reshape(-1)
+        energies = energies.reshape(len(energies), -1)[:, 0].copy()
+        # sum the atomic reference energies of chunks of molecules
+        offsets = self.offsets
+        for start in range(0, len(energies), chunk_size):
+            end = min(start + chunk_size, len(energies))
+            z = self.arrays["z"][offsets[start] : offsets[end]]
+            energies[start:end] -= np.add.reduceat(
+                atomref[z], offsets[start:end] - offsets[start]
+            )
+        return energies
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_offsets"] = None
+        state["_arrays"] = None
+        return state
+
+
+class ConcatStorage:
+    r"""Concatenation of several :class:`MemmapStorage` objects. The storage
+    holding a sample is found by binary search over the cumulative lengths, so
+    indexing costs the same regardless of the number of storages.
+    """
+
+    def __init__(self, storages):
+        self.storages = storages
+        self.cumulative_lengths = np.cumsum([0] + [len(s) for s in storages])
+
+    def __len__(self):
+        return int(self.cumulative_lengths[-1])
+
+    def __getitem__(self, idx):
+        storage_idx = np.searchsorted(self.cumulative_lengths, idx, side="right") - 1
+        return self.storages[storage_idx][idx - self.cumulative_lengths[storage_idx]]
+
+    def num_atoms(self):
+        return np.concatenate([storage.num_atoms() for storage in self.storages])
+
+    def energies(self, atomref=None):
+        return np.concatenate([storage.energies(atomref) for storage in self.storages])
+
+
+class MemmapDataset(Dataset):
+    r"""Base class for datasets that store their processed molecules as
+    memory-mapped arrays (see :class:`MemmapWriter`) instead of a single pickled
+    tensor file. Opening a dataset is nearly instant and memory is shared between
+    DataLoader workers and processes.
+
+    Subclasses declare the stored fields in :obj:`atom_fields` and
+    :obj:`mol_fields`, write the molecules in :meth:`process` using
+    :meth:`memmap_writer` and read them through :obj:`self.storage`, created with
+    :meth:`memmap_storage` (or a :class:`ConcatStorage` of several of them).
+    Per-molecule fields are returned with a leading
+    dimension of size one and atomic numbers as :obj:`torch.long`.
+    """
+
+    atom_fields = dict(z=(np.uint8, ()), pos=(np.float32, (3,)))
+    mol_fields = dict()
+
+    @classmethod
+    def memmap_file_names(cls, name):
+        return memmap_file_names(name, cls.atom_fields, cls.mol_fields)
+
+    def memmap_writer(self, name):
+        return MemmapWriter(
+            os.path.join(self.processed_dir, name), self.atom_fields, self.mol_fields
+        )
+
+    def memmap_storage(self, name):
+        return MemmapStorage(
+            os.path.join(self.processed_dir, name), self.atom_fields, self.mol_fields
+        )
+
+    def append_data(self, writer, data):
+        """Applies :obj:`pre_filter` and :obj:`pre_transform` to :obj:`data` and
+        appends it to :obj:`writer`.
+        """
+        if self.pre_filter is not None and not self.pre_filter(data):
+            return
+        if self.pre_transform is not None:
+            data = self.pre_transform(data)
+        writer.append(
+            **{name: data[name] for name in [*self.atom_fields, *self.mol_fields]}
+        )
+
+    def len(self):
+        return len(self.storage)
+
+    def get(self, idx):
+        return self.to_data(self.storage[idx])
+
+    def num_atoms(self):
+        """Returns the number of atoms of every molecule without loading them."""
+        return self.storage.num_atoms()
+
+    def energies(self, atomref=None):
+        """Returns the energies :obj:`y` of all molecules without creating
+        :obj:`Data` objects. If :obj:`atomref` is given, the sum of the reference
+        energies of their atoms is subtracted and the result is flattened.
+        """
+        return self.storage.energies(atomref)
+
+    def to_data(self, sample):
+        data = Data()
+        for name, value in sample.items():
+            if name == "z":
+                data[name] = torch.from_numpy(value.astype(np.int64))
+            else:
+                data[name] = torch.from_numpy(np.array(value))
+        return data
@@ -3,34 +3,43 @@ from typing import Optional, Callable, List
 import os
 from tqdm import tqdm
 import glob
-import ase
+from multiprocessing import Pool
+from ase.data import atomic_numbers
 import numpy as np
 
 import torch
-from torch_geometric.data import (InMemoryDataset, download_url, extract_zip,
-                                  Data)
+from torch_geometric.data import download_url, extract_zip, Data
+from torchmdnet.datasets.memmap import MemmapDataset
 
 
-class PCQM4MV2_XYZ(InMemoryDataset):
+class PCQM4MV2_XYZ(MemmapDataset):
     r"""3D coordinates for molecules in the PCQM4Mv2 dataset (from zip).
     """
 
+    mol_fields = dict(idx=(np.int64, ()))
+
     raw_url = 'http://ogb-data.stanford.edu/data/lsc/pcqm4m-v2_xyz.zip'
 
+    # number of molecules per intermediate shard and per task of a worker process
+    shard_size = 100000
+    chunk_size = 1000
+
     def __init__(self, root: str, transform: Optional[Callable] = None,
                  pre_transform: Optional[Callable] = None,
-                 pre_filter: Optional[Callable] = None, dataset_arg: Optional[str] = None):
+                 pre_filter: Optional[Callable] = None, dataset_arg: Optional[str] = None,
+                 num_processes: Optional[int] = None):
         assert dataset_arg is None, "PCQM4MV2 does not take any dataset args."
+        self.num_processes = num_processes or os.cpu_count()
         super().__init__(root, transform, pre_transform, pre_filter)
-        self.data, self.slices = torch.load(self.processed_paths[0])
+        self.storage = self.memmap_storage('pcqm4mv2_xyz')
 
     @property
     def raw_file_names(self) -> List[str]:
         return ['pcqm4m-v2_xyz']
 
     @property
-    def processed_file_names(self) -> str:
-        return 'pcqm4mv2__xyz.pt'
+    def processed_file_names(self) -> List[str]:
+        return self.memmap_file_names('pcqm4mv2_xyz')
 
     def download(self):
         file_path = download_url(self.raw_url, self.raw_dir)
@@ -38,24 +47,74 @@ class PCQM4MV2_XYZ(InMemoryDataset):
         os.unlink(file_path)
 
     def process(self):
-        dataset = PCQM4MV2_3D(self.raw_paths[0])
-        
-        data_list = []
-        for i, mol in enumerate(tqdm(dataset)):
-            pos = mol['coords']
-            pos = torch.tensor(pos, dtype=torch.float)
-            z = torch.tensor(mol['atom_type'], dtype=torch.long)
-
-            data = Data(z=z, pos=pos, idx=i)
-
-            if self.pre_filter is not None and not self.pre_filter(data):
-                continue
-            if self.pre_transform is not None:
-                data = self.pre_transform(data)
-
-            data_list.append(data)
-
-        torch.save(self.collate(data_list), self.processed_paths[0])
+        """Parses the xyz files in parallel and writes them to shards of
+        :obj:`shard_size` molecules, which are merged at the end. Completed
+        shards are kept if processing is interrupted and skipped when it is
+        restarted.
+        """
+        xyz_files = PCQM4MV2_3D(self.raw_paths[0]).xyz_files
+        shard_starts = range(0, len(xyz_files), self.shard_size)
+        shard_names = [f'pcqm4mv2_xyz-shard{i:04d}' for i in range(len(shard_starts))]
+
+        with Pool(self.num_processes) as pool:
+            for start, name in zip(shard_starts, tqdm(shard_names, desc='shards')):
+                if all(os.path.exists(os.path.join(self.processed_dir, file_name))
+                       for file_name in self.memmap_file_names(name)):
+                    continue
+                files = xyz_files[start:start + self.shard_size]
+                chunks = [files[i:i + self.chunk_size]
+                          for i in range(0, len(files), self.chunk_size)]
+                with self.memmap_writer(name) as writer:
+                    for num_atoms, z, pos in pool.imap(read_xyz_files, chunks):
+                        idx = np.arange(start, start + len(num_atoms))
+                        self.write_chunk(writer, num_atoms, z, pos, idx)
+                        start += len(num_atoms)
+
+        with self.memmap_writer('pcqm4mv2_xyz') as writer:
+            for name in shard_names:
+                shard = self.memmap_storage(name)
+                writer.write(np.diff(shard.offsets), **shard.arrays)
+        for name in shard_names:
+            for file_name in self.memmap_file_names(name):
+                os.remove(os.path.join(self.processed_dir, file_name))
+
+    def write_chunk(self, writer, num_atoms, z, pos, idx):
+        if self.pre_filter is None and self.pre_transform is None:
+            writer.write(num_atoms, z=z, pos=pos, idx=idx)
+            return
+        offsets = np.concatenate([[0], np.cumsum(num_atoms)])
+        for i in range(len(num_atoms)):
+            data = Data(
+                z=torch.from_numpy(z[offsets[i]:offsets[i + 1]]).long(),
+                pos=torch.from_numpy(pos[offsets[i]:offsets[i + 1]]),
+                idx=int(idx[i]),
+            )
+            self.append_data(writer, data)
+
+
+def read_xyz(file_path):
+    """Reads the atomic numbers and positions from an xyz file in a single pass."""
+    with open(file_path) as f:
+        lines = f.read().splitlines()
+    num_atoms = int(lines[0])
+    z = np.empty(num_atoms, dtype=np.int64)
+    pos = np.empty((num_atoms, 3), dtype=np.float32)
+    for i, line in enumerate(lines[2:2 + num_atoms]):
+        symbol, x, y, z_coord = line.split()[:4]
+        z[i] = atomic_numbers[symbol]
+        pos[i] = (float(x), float(y), float(z_coord))
+    return z, pos
+
+
+def read_xyz_files(file_paths):
+    """Reads a list of xyz files into the number of atoms per molecule and the
+    concatenated atomic numbers and positions.
+    """
+    molecules = [read_xyz(file_path) for file_path in file_paths]
+    num_atoms = np.array([len(z) for z, _ in molecules], dtype=np.int64)
+    z = np.concatenate([z for z, _ in molecules])
+    pos = np.concatenate([pos for _, pos in molecules])
+    return num_atoms, z, pos
 
 
 
@@ -72,9 +131,7 @@ class PCQM4MV2_3D:
         self.num_molecules = len(self.xyz_files)
         
     def read_xyz_file(self, file_path):
-        atom_types = np.genfromtxt(file_path, skip_header=1, usecols=range(1), dtype=str)
-        atom_types = np.array([ase.Atom(sym).number for sym in atom_types])
-        atom_positions = np.genfromtxt(file_path, skip_header=1, usecols=range(1, 4), dtype=np.float32)        
+        atom_types, atom_positions = read_xyz(file_path)
         return {'atom_type': atom_types, 'coords': atom_positions}
     
     def _molecule_id_from_file(self, file_path):
@@ -0,0 +1,63 @@
+"""Export of trained models as frozen TorchScript modules for inference.
+
+The exported modules only depend on PyTorch and the compiled operators of
+torch_cluster (used to build the neighbor lists), Lightning and
+torch_geometric are not needed to load them::
+
+    import torch
+    import torch_cluster  # registers the neighbor list operators
+
+    model = torch.jit.load("model.pt")
+    energy, _, forces = model(z, pos, batch)
+"""
+
+import json
+import torch
+from torchmdnet.models.model import load_model
+
+
+def strip_model(model):
+    """Removes the parts of a :class:`TorchMD_Net` that are only used in training,
+    i.e. the denoising head and the position normalizer, and switches it to
+    evaluation mode.
+    """
+    model.output_model_noise = None
+    if hasattr(model, "pos_normalizer"):
+        del model.pos_normalizer
+    return model.eval()
+
+
+def export_model(model):
+    """Strips, scripts and freezes :obj:`model`. Parameters, buffers
+    and the derivative flag become constants of the returned module. Models
+    without derivative are additionally optimized for inference, which is not
+    compatible with the backward pass needed for the forces.
+    """
+    module = torch.jit.freeze(torch.jit.script(strip_model(model)))
+    if not model.derivative:
+        module = torch.jit.optimize_for_inference(module)
+    return module
+
+
+def export(filepath, output, derivative=False, device="cpu", **kwargs):
+    r"""Exports the checkpoint :obj:`filepath` to the TorchScript file
+    :obj:`output`.
+
+    Args:
+        filepath (str): Path to the checkpoint, passed to :func:`load_model`.
+        output (str): Path of the exported module.
+        derivative (bool, optional): Whether the exported module computes forces.
+            (default: :obj:`False`)
+        device (str, optional): Device the constants of the exported module
+            are placed on. (default: :obj:`"cpu"`)
+        **kwargs: Hyperparameters overwritten in :func:`load_model`.
+    """
+    args = torch.load(filepath, map_location="cpu")["hyper_parameters"]
+    model = load_model(
+        filepath, args=dict(args), device=device, derivative=derivative, **kwargs
+    )
+    module = export_model(model)
+    # the hyperparameters are stored next to the module for reference
+    hparams = json.dumps(dict(args, derivative=derivative, **kwargs), default=str)
+    torch.jit.save(module, output, _extra_files={"hparams.json": hparams})
+    return module
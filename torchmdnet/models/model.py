@@ -18,12 +18,15 @@ def create_model(args, prior_model=None, mean=None, std=None):
         num_rbf=args["num_rbf"],
         rbf_type=args["rbf_type"],
         trainable_rbf=args["trainable_rbf"],
+        rbf_table_size=args.get("rbf_table_size", None),
         activation=args["activation"],
         neighbor_embedding=args["neighbor_embedding"],
         cutoff_lower=args["cutoff_lower"],
         cutoff_upper=args["cutoff_upper"],
         max_z=args["max_z"],
         max_num_neighbors=args["max_num_neighbors"],
+        neighbor_list=args.get("neighbor_list", "radius_graph"),
+        adaptive_max_num_neighbors=args.get("adaptive_max_num_neighbors", False),
     )
 
     # representation network
@@ -32,7 +35,10 @@ def create_model(args, prior_model=None, mean=None, std=None):
 
         is_equivariant = False
         representation_model = TorchMD_GN(
-            num_filters=args["embedding_dimension"], aggr=args["aggr"], **shared_args
+            num_filters=args["embedding_dimension"],
+            aggr=args["aggr"],
+            half_list=args.get("half_list", False),
+            **shared_args,
         )
     elif args["model"] == "transformer":
         from torchmdnet.models.torchmd_t import TorchMD_T
@@ -42,17 +48,23 @@ def create_model(args, prior_model=None, mean=None, std=None):
             attn_activation=args["attn_activation"],
             num_heads=args["num_heads"],
             distance_influence=args["distance_influence"],
+            half_list=args.get("half_list", False),
             **shared_args,
         )
     elif args["model"] == "equivariant-transformer":
         from torchmdnet.models.torchmd_et import TorchMD_ET
 
+        if args.get("half_list", False):
+            raise ValueError("The equivariant transformer does not support half_list")
+
         is_equivariant = True
         representation_model = TorchMD_ET(
             attn_activation=args["attn_activation"],
             num_heads=args["num_heads"],
             distance_influence=args["distance_influence"],
             layernorm_on_vec=args["layernorm_on_vec"],
+            fuse_edge_projections=args.get("fuse_edge_projections", False),
+            edge_chunk_size=args.get("edge_chunk_size", None),
             **shared_args,
         )
     else:
@@ -105,7 +117,7 @@ def create_model(args, prior_model=None, mean=None, std=None):
     return model
 
 
-def load_model(filepath, args=None, device="cpu", mean=None, std=None, **kwargs):
+def load_model(filepath, args=None, device="cpu", mean=None, std=None, quantize=None, **kwargs):
     ckpt = torch.load(filepath, map_location="cpu")
     if args is None:
         args = ckpt["hyper_parameters"]
@@ -130,6 +142,13 @@ def load_model(filepath, args=None, device="cpu", mean=None, std=None, **kwargs)
     if std:
         model.std = std
 
+    if quantize is not None:
+        # quantized layers only run on the CPU
+        from torchmdnet.quantize import quantize_model
+
+        assert torch.device(device).type == "cpu", "Quantized models only run on the CPU."
+        return quantize_model(model, quantize)
+
     return model.to(device)
 
 
@@ -181,7 +200,13 @@ class TorchMD_Net(nn.Module):
         if self.prior_model is not None:
             self.prior_model.reset_parameters()
 
-    def forward(self, z, pos, batch: Optional[torch.Tensor] = None):
+    def forward(
+        self,
+        z,
+        pos,
+        batch: Optional[torch.Tensor] = None,
+        box: Optional[torch.Tensor] = None,
+    ):
         assert z.dim() == 1 and z.dtype == torch.long
         batch = torch.zeros_like(z) if batch is None else batch
 
@@ -189,7 +214,7 @@ class TorchMD_Net(nn.Module):
             pos.requires_grad_(True)
 
         # run the potentially wrapped representation model
-        x, v, z, pos, batch = self.representation_model(z, pos, batch=batch)
+        x, v, z, pos, batch = self.representation_model(z, pos, batch=batch, box=box)
 
         # predict noise
         noise_pred = None
@@ -217,15 +242,17 @@ class TorchMD_Net(nn.Module):
         # apply output model after reduction
         out = self.output_model.post_reduce(out)
 
-        # compute gradients with respect to coordinates
+        # compute gradients with respect to coordinates. The graph of the forces
+        # is only needed to train on them, in eval mode (validation, testing and
+        # MD through External) a single backward pass frees the graph instead
         if self.derivative:
             grad_outputs: List[Optional[torch.Tensor]] = [torch.ones_like(out)]
             dy = grad(
                 [out],
                 [pos],
                 grad_outputs=grad_outputs,
-                create_graph=True,
-                retain_graph=True,
+                create_graph=self.training,
+                retain_graph=self.training,
             )[0]
             if dy is None:
                 raise RuntimeError("Autograd returned None for the force prediction.")
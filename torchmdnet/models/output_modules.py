@@ -72,8 +72,10 @@ class EquivariantScalar(OutputModel):
     def pre_reduce(self, x, v, z, pos, batch):
         for layer in self.output_network:
             x, v = layer(x, v)
-        # include v in output to make sure all parameters have a gradient
-        return x + v.sum() * 0
+        if self.training:
+            # include v in output to make sure all parameters have a gradient
+            return x + v.sum() * 0
+        return x
 
 
 class DipoleMoment(Scalar):
@@ -1,6 +1,10 @@
-from typing import Optional, Tuple
+import math
+import inspect
+from typing import List, Optional, Tuple
 import torch
 from torch import nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch_geometric.nn import MessagePassing
 from torch_scatter import scatter
 from torchmdnet.models.utils import (
@@ -12,6 +16,10 @@ from torchmdnet.models.utils import (
 )
 from torch.nn.parameter import Parameter
 
+# non-reentrant checkpointing (torch >= 1.11) is required for torch.autograd.grad,
+# which computes the forces
+has_non_reentrant_checkpoint = "use_reentrant" in inspect.signature(checkpoint).parameters
+
 
 class TorchMD_ET(nn.Module):
     r"""The TorchMD equivariant Transformer architecture.
@@ -27,6 +35,10 @@ class TorchMD_ET(nn.Module):
             (default: :obj:`"expnorm"`)
         trainable_rbf (bool, optional): Whether to train RBF parameters with
             backpropagation. (default: :obj:`True`)
+        rbf_table_size (int, optional): If set, the distance expansion is tabulated
+            on this many points and evaluated by cubic interpolation instead of
+            being computed directly. Requires :obj:`trainable_rbf=False`. Larger
+            tables are more accurate. (default: :obj:`None`)
         activation (string, optional): The type of activation function to use.
             (default: :obj:`"silu"`)
         attn_activation (string, optional): The type of activation function to use
@@ -50,6 +62,30 @@ class TorchMD_ET(nn.Module):
             higher values if they are using higher upper distance cutoffs and expect more
             than 32 neighbors per node/atom.
             (default: :obj:`32`)
+        neighbor_list (string, optional): The neighbor search algorithm used to
+            construct the molecular graph. Can be one of 'radius_graph' or
+            'cell_list'. The cell list scales linearly with the number of atoms
+            and should be preferred for large systems.
+            (default: :obj:`"radius_graph"`)
+        adaptive_max_num_neighbors (bool, optional): If True, :obj:`max_num_neighbors`
+            is doubled whenever an atom reaches it, instead of silently dropping
+            neighbors beyond the cap. (default: :obj:`False`)
+        fuse_edge_projections (bool, optional): If True, the distance projections
+            (:obj:`dk_proj` and :obj:`dv_proj`) of all attention layers are applied
+            to the expanded distances in a single matrix multiplication, whose
+            output is then split between the layers. Cannot be combined with
+            :obj:`edge_chunk_size`. (default: :obj:`False`)
+        edge_chunk_size (int, optional): If set, edges are sorted by their target
+            atom and the attention layers compute and aggregate the messages of
+            at most this many edges at a time. This
+            bounds the memory taken by per-edge tensors, which otherwise limits
+            the system size during inference, at the cost of some speed. If
+            gradients are required, e.g. for forces, the messages of each chunk
+            are recomputed during the backward pass instead of being stored
+            (requires torch 1.11 or later). Training on forces differentiates
+            through that backward pass, which keeps the recomputed tensors of all
+            chunks, so the memory is only bounded for inference.
+            (default: :obj:`None`)
     """
 
     def __init__(
@@ -59,6 +95,7 @@ class TorchMD_ET(nn.Module):
         num_rbf=50,
         rbf_type="expnorm",
         trainable_rbf=True,
+        rbf_table_size=None,
         activation="silu",
         attn_activation="silu",
         neighbor_embedding=True,
@@ -68,7 +105,11 @@ class TorchMD_ET(nn.Module):
         cutoff_upper=5.0,
         max_z=100,
         max_num_neighbors=32,
+        neighbor_list="radius_graph",
+        adaptive_max_num_neighbors=False,
         layernorm_on_vec=None,
+        fuse_edge_projections=False,
+        edge_chunk_size=None,
     ):
         super(TorchMD_ET, self).__init__()
 
@@ -85,6 +126,10 @@ class TorchMD_ET(nn.Module):
             f'Unknown attention activation function "{attn_activation}". '
             f'Choose from {", ".join(act_class_mapping.keys())}.'
         )
+        assert not (fuse_edge_projections and edge_chunk_size), (
+            "fuse_edge_projections projects the distances of all edges at once "
+            "and cannot be combined with edge_chunk_size."
+        )
 
         self.hidden_channels = hidden_channels
         self.num_layers = num_layers
@@ -100,6 +145,8 @@ class TorchMD_ET(nn.Module):
         self.cutoff_upper = cutoff_upper
         self.max_z = max_z
         self.layernorm_on_vec = layernorm_on_vec
+        self.fuse_edge_projections = fuse_edge_projections and distance_influence != "none"
+        self.edge_chunk_size = edge_chunk_size or 0
 
         act_class = act_class_mapping[activation]
 
@@ -111,9 +158,15 @@ class TorchMD_ET(nn.Module):
             max_num_neighbors=max_num_neighbors,
             return_vecs=True,
             loop=True,
+            neighbor_list=neighbor_list,
+            adaptive_max_num_neighbors=adaptive_max_num_neighbors,
         )
         self.distance_expansion = rbf_class_mapping[rbf_type](
-            cutoff_lower, cutoff_upper, num_rbf, trainable_rbf
+            cutoff_lower,
+            cutoff_upper,
+            num_rbf,
+            trainable_rbf,
+            table_size=rbf_table_size,
         )
         self.neighbor_embedding = (
             NeighborEmbedding(
@@ -134,6 +187,7 @@ class TorchMD_ET(nn.Module):
                 attn_activation,
                 cutoff_lower,
                 cutoff_upper,
+                edge_chunk_size,
             ).jittable()
             self.attention_layers.append(layer)
 
@@ -157,14 +211,22 @@ class TorchMD_ET(nn.Module):
         if self.layernorm_on_vec:
             self.out_norm_vec.reset_parameters()
 
-    def forward(self, z, pos, batch):
+    def forward(self, z, pos, batch, box: Optional[torch.Tensor] = None):
         x = self.embedding(z)
 
-        edge_index, edge_weight, edge_vec = self.distance(pos, batch)
+        edge_index, edge_weight, edge_vec = self.distance(pos, batch, box)
         assert (
             edge_vec is not None
         ), "Distance module did not return directional information"
 
+        if self.edge_chunk_size > 0:
+            # CSR order, so that the messages of each chunk of edges are reduced
+            # into a contiguous range of target atoms
+            perm = torch.argsort(edge_index[1])
+            edge_index = edge_index[:, perm]
+            edge_weight = edge_weight[perm]
+            edge_vec = edge_vec[perm]
+
         edge_attr = self.distance_expansion(edge_weight)
         mask = edge_index[0] != edge_index[1]
         edge_vec[mask] = edge_vec[mask] / torch.norm(edge_vec[mask], dim=1).unsqueeze(1)
@@ -172,12 +234,38 @@ class TorchMD_ET(nn.Module):
         if self.neighbor_embedding is not None:
             x = self.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr)
 
-        vec = torch.zeros(x.size(0), 3, x.size(1), device=x.device)
-
-        for attn in self.attention_layers:
-            dx, dvec = attn(x, vec, edge_index, edge_weight, edge_attr, edge_vec)
+        edge_proj: Optional[List[torch.Tensor]] = None
+        if self.fuse_edge_projections:
+            # project the distance expansion for all layers at once
+            weights: List[torch.Tensor] = []
+            biases: List[torch.Tensor] = []
+            for attn in self.attention_layers:
+                weight, bias = attn.edge_projection_parameters()
+                weights.append(weight)
+                biases.append(bias)
+            edge_proj = F.linear(
+                edge_attr, torch.cat(weights), torch.cat(biases)
+            ).split(weights[0].size(0), dim=1)
+
+        # vector features start out as zeros, which the first layer exploits
+        vec: Optional[torch.Tensor] = None
+        for i, attn in enumerate(self.attention_layers):
+            dx, dvec = attn(
+                x,
+                vec,
+                edge_index,
+                edge_weight,
+                edge_attr,
+                edge_vec,
+                edge_proj[i] if edge_proj is not None else None,
+            )
             x = x + dx
-            vec = vec + dvec
+            if vec is None:
+                vec = dvec
+            else:
+                vec = vec + dvec
+        if vec is None:
+            vec = torch.zeros(x.size(0), 3, x.size(1), device=x.device)
         x = self.out_norm(x)
         if self.layernorm_on_vec:
             vec = self.out_norm_vec(vec)
@@ -213,6 +301,7 @@ class EquivariantMultiHeadAttention(MessagePassing):
         attn_activation,
         cutoff_lower,
         cutoff_upper,
+        edge_chunk_size=None,
     ):
         super(EquivariantMultiHeadAttention, self).__init__(aggr="add", node_dim=0)
         assert hidden_channels % num_heads == 0, (
@@ -225,6 +314,7 @@ class EquivariantMultiHeadAttention(MessagePassing):
         self.num_heads = num_heads
         self.hidden_channels = hidden_channels
         self.head_dim = hidden_channels // num_heads
+        self.edge_chunk_size = edge_chunk_size or 0
 
         self.layernorm = nn.LayerNorm(hidden_channels)
         self.act = activation()
@@ -266,49 +356,210 @@ class EquivariantMultiHeadAttention(MessagePassing):
             nn.init.xavier_uniform_(self.dv_proj.weight)
             self.dv_proj.bias.data.fill_(0)
 
-    def forward(self, x, vec, edge_index, r_ij, f_ij, d_ij):
+    def edge_projection_parameters(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the weights and biases of dk_proj and dv_proj stacked along the
+        output dimension, i.e. the layout expected by the edge_proj argument of forward.
+        """
+        weights: List[torch.Tensor] = []
+        biases: List[torch.Tensor] = []
+        if self.dk_proj is not None:
+            weights.append(self.dk_proj.weight)
+            biases.append(self.dk_proj.bias)
+        if self.dv_proj is not None:
+            weights.append(self.dv_proj.weight)
+            biases.append(self.dv_proj.bias)
+        return torch.cat(weights), torch.cat(biases)
+
+    def edge_projections(
+        self, f_ij, edge_proj: Optional[torch.Tensor]
+    ) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+        if edge_proj is not None:
+            # distance projections precomputed for all layers at once
+            dk: Optional[torch.Tensor] = None
+            dv: Optional[torch.Tensor] = None
+            if self.dk_proj is not None:
+                dk = self.act(edge_proj[:, : self.hidden_channels]).reshape(
+                    -1, self.num_heads, self.head_dim
+                )
+                edge_proj = edge_proj[:, self.hidden_channels :]
+            if self.dv_proj is not None:
+                dv = self.act(edge_proj).reshape(-1, self.num_heads, self.head_dim * 3)
+        else:
+            dk = (
+                self.act(self.dk_proj(f_ij)).reshape(-1, self.num_heads, self.head_dim)
+                if self.dk_proj is not None
+                else None
+            )
+            dv = (
+                self.act(self.dv_proj(f_ij)).reshape(
+                    -1, self.num_heads, self.head_dim * 3
+                )
+                if self.dv_proj is not None
+                else None
+            )
+        return dk, dv
+
+    def forward(
+        self,
+        x,
+        vec: Optional[torch.Tensor],
+        edge_index,
+        r_ij,
+        f_ij,
+        d_ij,
+        edge_proj: Optional[torch.Tensor] = None,
+    ):
+        """Passing :obj:`None` as :obj:`vec` is equivalent to all-zero vector
+        features, but skips all computations involving them.
+        """
         x = self.layernorm(x)
         q = self.q_proj(x).reshape(-1, self.num_heads, self.head_dim)
         k = self.k_proj(x).reshape(-1, self.num_heads, self.head_dim)
         v = self.v_proj(x).reshape(-1, self.num_heads, self.head_dim * 3)
 
+        if vec is None or self.edge_chunk_size > 0:
+            x, vec_msg = self.aggregate_chunked(
+                q, k, v, vec, edge_index, r_ij, f_ij, d_ij, edge_proj
+            )
+        else:
+            dk, dv = self.edge_projections(f_ij, edge_proj)
+            # propagate_type: (q: Tensor, k: Tensor, v: Tensor, vec: Tensor, dk: Tensor, dv: Tensor, r_ij: Tensor, d_ij: Tensor)
+            x, vec_msg = self.propagate(
+                edge_index,
+                q=q,
+                k=k,
+                v=v,
+                vec=vec.reshape(-1, 3, self.num_heads, self.head_dim),
+                dk=dk,
+                dv=dv,
+                r_ij=r_ij,
+                d_ij=d_ij,
+                size=None,
+            )
+        x = x.reshape(-1, self.hidden_channels)
+        vec_msg = vec_msg.reshape(-1, 3, self.hidden_channels)
+
+        if vec is None:
+            # With vec = 0, vec_dot and the vec3 term vanish and only o3
+            # contributes to dx.
+            o3 = F.linear(
+                x,
+                self.o_proj.weight[2 * self.hidden_channels :],
+                self.o_proj.bias[2 * self.hidden_channels :],
+            )
+            if self.training:
+                # keep vec_proj in the autograd graph, DistributedDataParallel
+                # without find_unused_parameters expects a gradient for it
+                o3 = o3 + self.vec_proj.weight.sum() * 0
+            return o3, vec_msg
+
         vec1, vec2, vec3 = torch.split(self.vec_proj(vec), self.hidden_channels, dim=-1)
-        vec = vec.reshape(-1, 3, self.num_heads, self.head_dim)
         vec_dot = (vec1 * vec2).sum(dim=1)
 
-        dk = (
-            self.act(self.dk_proj(f_ij)).reshape(-1, self.num_heads, self.head_dim)
-            if self.dk_proj is not None
-            else None
-        )
-        dv = (
-            self.act(self.dv_proj(f_ij)).reshape(-1, self.num_heads, self.head_dim * 3)
-            if self.dv_proj is not None
-            else None
-        )
-
-        # propagate_type: (q: Tensor, k: Tensor, v: Tensor, vec: Tensor, dk: Tensor, dv: Tensor, r_ij: Tensor, d_ij: Tensor)
-        x, vec = self.propagate(
-            edge_index,
-            q=q,
-            k=k,
-            v=v,
-            vec=vec,
-            dk=dk,
-            dv=dv,
-            r_ij=r_ij,
-            d_ij=d_ij,
-            size=None,
-        )
-        x = x.reshape(-1, self.hidden_channels)
-        vec = vec.reshape(-1, 3, self.hidden_channels)
-
         o1, o2, o3 = torch.split(self.o_proj(x), self.hidden_channels, dim=1)
         dx = vec_dot * o2 + o3
-        dvec = vec3 * o1.unsqueeze(1) + vec
+        dvec = vec3 * o1.unsqueeze(1) + vec_msg
         return dx, dvec
 
-    def message(self, q_i, k_j, v_j, vec_j, dk, dv, r_ij, d_ij):
+    def aggregate_chunked(
+        self,
+        q,
+        k,
+        v,
+        vec: Optional[torch.Tensor],
+        edge_index,
+        r_ij,
+        f_ij,
+        d_ij,
+        edge_proj: Optional[torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Computes and sums the messages of at most :obj:`edge_chunk_size` edges
+        at a time, so that the per-edge tensors (including the distance
+        projections) never exist for all edges at once. If :obj:`edge_chunk_size`
+        is set, the edges must be sorted by their target atom. If :obj:`vec` is
+        :obj:`None`, the vector features are taken to be zero and the
+        :obj:`vec_j` gather is skipped.
+        """
+        num_edges = edge_index.size(1)
+        chunk_size = self.edge_chunk_size if self.edge_chunk_size > 0 else num_edges
+        if vec is not None:
+            vec = vec.reshape(-1, 3, self.num_heads, self.head_dim)
+
+        x = q.new_zeros(q.shape)
+        vec_out = q.new_zeros(q.size(0), 3, self.num_heads, self.head_dim)
+        for start in range(0, num_edges, chunk_size):
+            i = edge_index[1, start : start + chunk_size]
+            chunk_edge_proj = (
+                edge_proj[start : start + chunk_size] if edge_proj is not None else None
+            )
+            chunk_args = (
+                q,
+                k,
+                v,
+                vec,
+                edge_index[:, start : start + chunk_size],
+                r_ij[start : start + chunk_size],
+                f_ij[start : start + chunk_size],
+                d_ij[start : start + chunk_size],
+                chunk_edge_proj,
+            )
+            if (
+                self.edge_chunk_size > 0
+                and torch.is_grad_enabled()
+                and not torch.jit.is_scripting()
+                and has_non_reentrant_checkpoint
+            ):
+                # store only the inputs of the chunk for the backward pass and
+                # recompute its messages there, otherwise the per-edge tensors of
+                # all chunks would be kept alive by autograd
+                x_msg, vec_msg = checkpoint(
+                    self.chunk_messages, *chunk_args, use_reentrant=False
+                )
+            else:
+                x_msg, vec_msg = self.chunk_messages(*chunk_args)
+            if self.edge_chunk_size > 0:
+                # the sorted targets of the chunk span a contiguous range of atoms,
+                # only that range of the output is updated (segment_csr would
+                # avoid the atomics but is not twice differentiable)
+                first, last = int(i[0]), int(i[-1])
+                x[first : last + 1].index_add_(0, i - first, x_msg)
+                vec_out[first : last + 1].index_add_(0, i - first, vec_msg)
+            else:
+                x.index_add_(0, i, x_msg)
+                vec_out.index_add_(0, i, vec_msg)
+        return x, vec_out
+
+    def chunk_messages(
+        self,
+        q,
+        k,
+        v,
+        vec: Optional[torch.Tensor],
+        edge_index,
+        r_ij,
+        f_ij,
+        d_ij,
+        edge_proj: Optional[torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        j, i = edge_index[0], edge_index[1]
+        dk, dv = self.edge_projections(f_ij, edge_proj)
+        x, vec1, vec2 = self.attention(
+            q.index_select(0, i), k.index_select(0, j), v.index_select(0, j), dk, dv, r_ij
+        )
+        vec_msg = vec2.unsqueeze(1) * d_ij.unsqueeze(2).unsqueeze(3)
+        if vec is not None:
+            vec_msg = vec_msg + vec.index_select(0, j) * vec1.unsqueeze(1)
+        return x, vec_msg
+
+    def attention(
+        self,
+        q_i,
+        k_j,
+        v_j,
+        dk: Optional[torch.Tensor],
+        dv: Optional[torch.Tensor],
+        r_ij,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         # attention mechanism
         if dk is None:
             attn = (q_i * k_j).sum(dim=-1)
@@ -325,6 +576,10 @@ class EquivariantMultiHeadAttention(MessagePassing):
 
         # update scalar features
         x = x * attn.unsqueeze(2)
+        return x, vec1, vec2
+
+    def message(self, q_i, k_j, v_j, vec_j, dk, dv, r_ij, d_ij):
+        x, vec1, vec2 = self.attention(q_i, k_j, v_j, dk, dv, r_ij)
         # update vector features
         vec = vec_j * vec1.unsqueeze(1) + vec2.unsqueeze(1) * d_ij.unsqueeze(
             2
@@ -349,6 +604,170 @@ class EquivariantMultiHeadAttention(MessagePassing):
         return inputs
 
 
+def sym_inv_sqrt_3x3(matrix, min_eigval_ratio: float = 0.0):
+    r"""Closed-form inverse square root of a batch of symmetric positive definite
+    3x3 matrices.
+
+    The eigenvalues are obtained with the trigonometric solution of the
+    characteristic polynomial and the result follows from the Cayley-Hamilton
+    theorem (Hoger & Carlson, 1984), so no eigenvectors are needed and the
+    result stays well-defined for (nearly) degenerate eigenvalues. The
+    trigonometric eigenvalues have an absolute error of up to
+    :math:`\sqrt{\epsilon} \lambda_{max}`, so badly conditioned matrices, e.g. the
+    regularized covariances of rank-deficient inputs, are handled with
+    :func:`torch.linalg.eigh` instead. Their eigenvalues are raised to at least
+    :obj:`min_eigval_ratio` times the largest one, which should reflect the
+    accuracy of :obj:`matrix`. Use :class:`SymInvSqrt3x3` to differentiate it
+    robustly.
+    """
+    eigvals = sym_eigvals_3x3(matrix)
+    ill_conditioned = is_ill_conditioned(eigvals.detach())
+    if not bool(ill_conditioned.any()):
+        return _sym_inv_sqrt_3x3(matrix, eigvals)
+
+    # the closed form is evaluated on the identity in place of the badly
+    # conditioned matrices, which keeps its derivatives finite
+    eye = torch.eye(3, dtype=matrix.dtype, device=matrix.device)
+    well_conditioned = torch.where(ill_conditioned[..., None, None], eye, matrix)
+    inv_sqrt = _sym_inv_sqrt_3x3(well_conditioned, sym_eigvals_3x3(well_conditioned))
+    eigvals, eigvecs = clamped_eigh(matrix[ill_conditioned], min_eigval_ratio)
+    inv_sqrt[ill_conditioned] = (
+        eigvecs * eigvals.rsqrt().unsqueeze(-2)
+    ) @ eigvecs.transpose(-1, -2)
+    return inv_sqrt
+
+
+def clamped_eigh(matrix, min_eigval_ratio: float):
+    """Eigendecomposition of symmetric matrices with the eigenvalues raised to at
+    least :obj:`min_eigval_ratio` times the largest one."""
+    eigvals, eigvecs = torch.linalg.eigh(matrix)
+    # eigenvalues below the accuracy of the matrix are rounding errors, which
+    # can be negative
+    eigvals = torch.maximum(eigvals, min_eigval_ratio * eigvals[..., 2:])
+    return eigvals, eigvecs
+
+
+def is_ill_conditioned(eigvals):
+    """Returns which matrices are too badly conditioned for the trigonometric
+    eigenvalues :obj:`eigvals` (in descending order)."""
+    return eigvals[..., 2] < 1e-3 * eigvals[..., 0]
+
+
+def sym_eigvals_3x3(matrix):
+    """Eigenvalues of a batch of symmetric 3x3 matrices in descending order."""
+    eye = torch.eye(3, dtype=matrix.dtype, device=matrix.device)
+    q = matrix.diagonal(dim1=-2, dim2=-1).mean(-1)
+    off_diag = matrix[..., 0, 1] ** 2 + matrix[..., 0, 2] ** 2 + matrix[..., 1, 2] ** 2
+    p = (
+        ((matrix.diagonal(dim1=-2, dim2=-1) - q.unsqueeze(-1)) ** 2).sum(-1)
+        + 2 * off_diag
+    ) / 6
+    p = p.sqrt().clamp(min=1e-30)
+    b = (matrix - q[..., None, None] * eye) / p[..., None, None]
+    phi = torch.acos((torch.det(b) / 2).clamp(-1, 1)) / 3
+    eig1 = q + 2 * p * torch.cos(phi)
+    eig3 = q + 2 * p * torch.cos(phi + 2 * math.pi / 3)
+    eig2 = 3 * q - eig1 - eig3
+    return torch.stack([eig1, eig2, eig3], dim=-1)
+
+
+def _sym_inv_sqrt_3x3(matrix, eigvals):
+    eye = torch.eye(3, dtype=matrix.dtype, device=matrix.device)
+
+    # principal invariants of the square root
+    mu = eigvals.clamp(min=0).sqrt()
+    i1 = mu.sum(-1)[..., None, None]
+    i2 = (mu[..., 0] * mu[..., 1] + mu[..., 0] * mu[..., 2] + mu[..., 1] * mu[..., 2])[
+        ..., None, None
+    ]
+    i3 = mu.prod(-1)[..., None, None]
+
+    sqrt = (-matrix @ matrix + (i1 ** 2 - i2) * matrix + i1 * i3 * eye) / (
+        i1 * i2 - i3
+    )
+    inv_sqrt = (matrix - i1 * sqrt + i2 * eye) / i3
+
+    # the trigonometric eigenvalues lose accuracy for nearly degenerate eigenvalues,
+    # one Newton step restores it
+    inv_sqrt = 0.5 * inv_sqrt @ (3 * eye - matrix @ inv_sqrt @ inv_sqrt)
+    return 0.5 * (inv_sqrt + inv_sqrt.transpose(-1, -2))
+
+
+class SymInvSqrt3x3(torch.autograd.Function):
+    """Inverse square root of symmetric positive definite 3x3 matrices with
+    analytic derivatives.
+
+    For :math:`Y = M^{-1/2}` and :math:`U = M^{1/2}`, the gradient with respect to
+    :math:`M` is :math:`-W`, where :math:`W` solves the Sylvester equation
+    :math:`U W + W U = Y G Y`. The solution is again a polynomial in :math:`U`
+    whose coefficients only depend on the invariants of :math:`U`, so unlike the
+    SVD backward it does not blow up for degenerate eigenvalues. The backward is
+    built from differentiable operations, which supports double backward as
+    needed for force training.
+    """
+
+    @staticmethod
+    def forward(ctx, matrix, min_eigval_ratio=0.0):
+        inv_sqrt = sym_inv_sqrt_3x3(matrix, min_eigval_ratio)
+        ctx.save_for_backward(matrix, inv_sqrt)
+        ctx.min_eigval_ratio = min_eigval_ratio
+        return inv_sqrt
+
+    @staticmethod
+    def backward(ctx, grad):
+        matrix, inv_sqrt = ctx.saved_tensors
+        sqrt = matrix @ inv_sqrt
+        # the solution below requires exactly symmetric matrices
+        sqrt = 0.5 * (sqrt + sqrt.transpose(-1, -2))
+        rhs = inv_sqrt @ (0.5 * (grad + grad.transpose(-1, -2))) @ inv_sqrt
+        rhs = 0.5 * (rhs + rhs.transpose(-1, -2))
+
+        # principal invariants of the square root
+        i1 = sqrt.diagonal(dim1=-2, dim2=-1).sum(-1)[..., None, None]
+        i2 = 0.5 * (i1 ** 2 - matrix.diagonal(dim1=-2, dim2=-1).sum(-1)[..., None, None])
+        i3 = 1 / torch.det(inv_sqrt)[..., None, None]
+
+        solution = sylvester_3x3(sqrt, matrix, i1, i2, i3, rhs)
+        # one step of iterative refinement against cancellation for widely
+        # spread eigenvalues
+        residual = rhs - sqrt @ solution - solution @ sqrt
+        residual = 0.5 * (residual + residual.transpose(-1, -2))
+        solution = solution + sylvester_3x3(sqrt, matrix, i1, i2, i3, residual)
+
+        # the polynomial solution cancels catastrophically for badly conditioned
+        # matrices, their equation is solved in the eigenbasis instead
+        ill_conditioned = is_ill_conditioned(sym_eigvals_3x3(matrix.detach()))
+        if bool(ill_conditioned.any()):
+            eigvals, eigvecs = clamped_eigh(
+                matrix[ill_conditioned], ctx.min_eigval_ratio
+            )
+            sqrt_eigvals = eigvals.sqrt()
+            rhs = eigvecs.transpose(-1, -2) @ rhs[ill_conditioned] @ eigvecs
+            rhs = rhs / (sqrt_eigvals.unsqueeze(-1) + sqrt_eigvals.unsqueeze(-2))
+            solution = solution.clone()
+            solution[ill_conditioned] = eigvecs @ rhs @ eigvecs.transpose(-1, -2)
+        return -solution, None
+
+
+def sylvester_3x3(sqrt, matrix, i1, i2, i3, rhs):
+    r"""Solves :math:`U W + W U = H` for symmetric positive definite 3x3 :math:`U`
+    with square :math:`M = U^2`, principal invariants :math:`I_1, I_2, I_3` and
+    symmetric :math:`H`. The solution is :math:`W = \sum_{kl} a_{kl} U^k H U^l`
+    with symmetric coefficients :math:`a_{kl}` that only depend on the invariants.
+    """
+    rhs_u = rhs @ sqrt
+    u_rhs_u = sqrt @ rhs_u
+    rhs_m = rhs @ matrix
+    return (
+        (i1 ** 2 * i3 + i1 * i2 ** 2 - i2 * i3) * rhs
+        - i1 ** 2 * i2 * (rhs_u + rhs_u.transpose(-1, -2))
+        + (i1 * i2 - i3) * (rhs_m + rhs_m.transpose(-1, -2))
+        + (i1 ** 3 + i3) * u_rhs_u
+        - i1 ** 2 * (u_rhs_u @ sqrt + sqrt @ u_rhs_u)
+        + i1 * matrix @ rhs_m
+    ) / (2 * i3 * (i1 * i2 - i3))
+
+
 class EquivariantLayerNorm(nn.Module):
     r"""Rotationally-equivariant Vector Layer Normalization
     Expects inputs with shape (N, n, d), where N is batch size, n is vector dimension, d is width/number of vectors.
@@ -391,44 +810,26 @@ class EquivariantLayerNorm(nn.Module):
     def covariance(self, input):
         return 1 / self.normalized_shape[0] * input @ input.transpose(-1, -2)
 
-    def symsqrtinv(self, matrix):
-        """Compute the inverse square root of a positive definite matrix.
-
-        Based on https://github.com/pytorch/pytorch/issues/25481
-        """
-        _, s, v = matrix.svd()
-        good = (
-            s > s.max(-1, True).values * s.size(-1) * torch.finfo(s.dtype).eps
-        )
-        components = good.sum(-1)
-        common = components.max()
-        unbalanced = common != components.min()
-        if common < s.size(-1):
-            s = s[..., :common]
-            v = v[..., :common]
-            if unbalanced:
-                good = good[..., :common]
-        if unbalanced:
-            s = s.where(good, torch.zeros((), device=s.device, dtype=s.dtype))
-        return (v * 1 / torch.sqrt(s + self.eps).unsqueeze(-2)) @ v.transpose(
-            -2, -1
-        )
-
     def forward(self, input: torch.Tensor) -> torch.Tensor:
-        input = input.to(torch.float64) # Need double precision for accurate inversion.
         input = self.mean_center(input)
-        # We use different diagonal elements in case input matrix is approximately zero,
-        # in which case all singular values are equal which is problematic for backprop.
-        # See e.g. https://pytorch.org/docs/stable/generated/torch.svd.html
-        reg_matrix = (
-            torch.diag(torch.tensor([1.0, 2.0, 3.0]))
-            .unsqueeze(0)
-            .to(input.device)
-            .type(input.dtype)
+        # Only the 3x3 covariance matrices are processed in double precision. They are
+        # regularized with different diagonal elements in case the input is
+        # approximately zero.
+        covar = self.covariance(input).to(torch.float64)
+        reg_matrix = torch.diag(
+            torch.tensor([2.0, 3.0, 4.0], dtype=covar.dtype, device=covar.device)
         )
-        covar = self.covariance(input) + self.eps * reg_matrix
-        covar_sqrtinv = self.symsqrtinv(covar)
-        return (covar_sqrtinv @ input).to(
+        covar = covar + self.eps * reg_matrix
+        # The covariances are accumulated in the precision of the input, whose
+        # rounding errors can make those of rank-deficient inputs (e.g. of linear
+        # molecules) indefinite. Eigenvalues below that accuracy are raised to it.
+        unit_roundoff = 1.1e-16 if input.dtype == torch.float64 else 6e-8
+        if torch.jit.is_scripting():
+            # custom autograd functions are not supported by TorchScript
+            covar_sqrtinv = sym_inv_sqrt_3x3(covar, 16 * unit_roundoff)
+        else:
+            covar_sqrtinv = SymInvSqrt3x3.apply(covar, 16 * unit_roundoff)
+        return (covar_sqrtinv.to(input.dtype) @ input).to(
             self.weight.dtype
         ) * self.weight.reshape(1, 1, self.normalized_shape[0])
 
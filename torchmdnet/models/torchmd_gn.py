@@ -1,9 +1,12 @@
+from typing import Optional
+import torch
 from torch import nn
 from torch_geometric.nn import MessagePassing
 from torchmdnet.models.utils import (
     NeighborEmbedding,
     CosineCutoff,
     Distance,
+    symmetrize_half_list,
     rbf_class_mapping,
     act_class_mapping,
 )
@@ -33,6 +36,10 @@ class TorchMD_GN(nn.Module):
             (default: :obj:`"expnorm"`)
         trainable_rbf (bool, optional): Whether to train RBF parameters with
             backpropagation. (default: :obj:`True`)
+        rbf_table_size (int, optional): If set, the distance expansion is tabulated
+            on this many points and evaluated by cubic interpolation instead of
+            being computed directly. Requires :obj:`trainable_rbf=False`. Larger
+            tables are more accurate. (default: :obj:`None`)
         activation (string, optional): The type of activation function to use.
             (default: :obj:`"silu"`)
         neighbor_embedding (bool, optional): Whether to perform an initial neighbor
@@ -49,10 +56,21 @@ class TorchMD_GN(nn.Module):
             max_num_neighbors, which normally defaults to 32. Users should set this to
             higher values if they are using higher upper distance cutoffs and expect more
             than 32 neighbors per node/atom. (default: :obj:`32`)
+        neighbor_list (string, optional): The neighbor search algorithm used to
+            construct the molecular graph. Can be one of 'radius_graph' or
+            'cell_list'. The cell list scales linearly with the number of atoms
+            and should be preferred for large systems.
+            (default: :obj:`"radius_graph"`)
+        adaptive_max_num_neighbors (bool, optional): If True, :obj:`max_num_neighbors`
+            is doubled whenever an atom reaches it, instead of silently dropping
+            neighbors beyond the cap. (default: :obj:`False`)
         aggr (str, optional): Aggregation scheme for continuous filter
             convolution ouput. Can be one of 'add', 'mean', or 'max' (see
             https://pytorch-geometric.readthedocs.io/en/latest/notes/create_gnn.html
             for more details). (default: :obj:`"add"`)
+        half_list (bool, optional): If True, distances, their expansion and the
+            continuous filters are computed once per atom pair and shared by both
+            edge directions. (default: :obj:`False`)
     """
 
     def __init__(
@@ -63,6 +81,7 @@ class TorchMD_GN(nn.Module):
         num_rbf=50,
         rbf_type="expnorm",
         trainable_rbf=True,
+        rbf_table_size=None,
         activation="silu",
         neighbor_embedding=True,
         cutoff_lower=0.0,
@@ -70,6 +89,9 @@ class TorchMD_GN(nn.Module):
         max_z=100,
         max_num_neighbors=32,
         aggr="add",
+        neighbor_list="radius_graph",
+        adaptive_max_num_neighbors=False,
+        half_list=False,
     ):
         super(TorchMD_GN, self).__init__()
 
@@ -99,16 +121,26 @@ class TorchMD_GN(nn.Module):
         self.cutoff_upper = cutoff_upper
         self.max_z = max_z
         self.aggr = aggr
+        self.half_list = half_list
 
         act_class = act_class_mapping[activation]
 
         self.embedding = nn.Embedding(self.max_z, hidden_channels)
 
         self.distance = Distance(
-            cutoff_lower, cutoff_upper, max_num_neighbors=max_num_neighbors
+            cutoff_lower,
+            cutoff_upper,
+            max_num_neighbors=max_num_neighbors,
+            neighbor_list=neighbor_list,
+            adaptive_max_num_neighbors=adaptive_max_num_neighbors,
+            half_list=half_list,
         )
         self.distance_expansion = rbf_class_mapping[rbf_type](
-            cutoff_lower, cutoff_upper, num_rbf, trainable_rbf
+            cutoff_lower,
+            cutoff_upper,
+            num_rbf,
+            trainable_rbf,
+            table_size=rbf_table_size,
         )
         self.neighbor_embedding = (
             NeighborEmbedding(
@@ -141,17 +173,23 @@ class TorchMD_GN(nn.Module):
         for interaction in self.interactions:
             interaction.reset_parameters()
 
-    def forward(self, z, pos, batch):
+    def forward(self, z, pos, batch, box: Optional[torch.Tensor] = None):
         x = self.embedding(z)
 
-        edge_index, edge_weight, _ = self.distance(pos, batch)
+        edge_index, edge_weight, _ = self.distance(pos, batch, box)
         edge_attr = self.distance_expansion(edge_weight)
 
+        half_index: Optional[torch.Tensor] = None
+        if self.half_list:
+            edge_index, half_index = symmetrize_half_list(edge_index)
+
         if self.neighbor_embedding is not None:
-            x = self.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr)
+            x = self.neighbor_embedding(
+                z, x, edge_index, edge_weight, edge_attr, half_index
+            )
 
         for interaction in self.interactions:
-            x = x + interaction(x, edge_index, edge_weight, edge_attr)
+            x = x + interaction(x, edge_index, edge_weight, edge_attr, half_index)
 
         return x, None, z, pos, batch
 
@@ -168,7 +206,8 @@ class TorchMD_GN(nn.Module):
             f"neighbor_embedding={self.neighbor_embedding}, "
             f"cutoff_lower={self.cutoff_lower}, "
             f"cutoff_upper={self.cutoff_upper}, "
-            f"aggr={self.aggr})"
+            f"aggr={self.aggr}, "
+            f"half_list={self.half_list})"
         )
 
 
@@ -212,8 +251,15 @@ class InteractionBlock(nn.Module):
         nn.init.xavier_uniform_(self.lin.weight)
         self.lin.bias.data.fill_(0)
 
-    def forward(self, x, edge_index, edge_weight, edge_attr):
-        x = self.conv(x, edge_index, edge_weight, edge_attr)
+    def forward(
+        self,
+        x,
+        edge_index,
+        edge_weight,
+        edge_attr,
+        half_index: Optional[torch.Tensor] = None,
+    ):
+        x = self.conv(x, edge_index, edge_weight, edge_attr, half_index)
         x = self.act(x)
         x = self.lin(x)
         return x
@@ -243,9 +289,19 @@ class CFConv(MessagePassing):
         nn.init.xavier_uniform_(self.lin2.weight)
         self.lin2.bias.data.fill_(0)
 
-    def forward(self, x, edge_index, edge_weight, edge_attr):
+    def forward(
+        self,
+        x,
+        edge_index,
+        edge_weight,
+        edge_attr,
+        half_index: Optional[torch.Tensor] = None,
+    ):
         C = self.cutoff(edge_weight)
         W = self.net(edge_attr) * C.view(-1, 1)
+        if half_index is not None:
+            # filters are symmetric in the atom pair, share them between directions
+            W = W.index_select(0, half_index)
 
         x = self.lin1(x)
         # propagate_type: (x: Tensor, W: Tensor)
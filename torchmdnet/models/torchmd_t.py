@@ -1,9 +1,12 @@
+from typing import Optional
+import torch
 from torch import nn
 from torch_geometric.nn import MessagePassing
 from torchmdnet.models.utils import (
     NeighborEmbedding,
     CosineCutoff,
     Distance,
+    symmetrize_half_list,
     rbf_class_mapping,
     act_class_mapping,
 )
@@ -23,6 +26,10 @@ class TorchMD_T(nn.Module):
             (default: :obj:`"expnorm"`)
         trainable_rbf (bool, optional): Whether to train RBF parameters with
             backpropagation. (default: :obj:`True`)
+        rbf_table_size (int, optional): If set, the distance expansion is tabulated
+            on this many points and evaluated by cubic interpolation instead of
+            being computed directly. Requires :obj:`trainable_rbf=False`. Larger
+            tables are more accurate. (default: :obj:`None`)
         activation (string, optional): The type of activation function to use.
             (default: :obj:`"silu"`)
         attn_activation (string, optional): The type of activation function to use
@@ -46,6 +53,17 @@ class TorchMD_T(nn.Module):
             higher values if they are using higher upper distance cutoffs and expect more
             than 32 neighbors per node/atom.
             (default: :obj:`32`)
+        neighbor_list (string, optional): The neighbor search algorithm used to
+            construct the molecular graph. Can be one of 'radius_graph' or
+            'cell_list'. The cell list scales linearly with the number of atoms
+            and should be preferred for large systems.
+            (default: :obj:`"radius_graph"`)
+        adaptive_max_num_neighbors (bool, optional): If True, :obj:`max_num_neighbors`
+            is doubled whenever an atom reaches it, instead of silently dropping
+            neighbors beyond the cap. (default: :obj:`False`)
+        half_list (bool, optional): If True, distances, their expansion and the
+            distance projections of the attention layers are computed once per
+            atom pair and shared by both edge directions. (default: :obj:`False`)
     """
 
     def __init__(
@@ -55,6 +73,7 @@ class TorchMD_T(nn.Module):
         num_rbf=50,
         rbf_type="expnorm",
         trainable_rbf=True,
+        rbf_table_size=None,
         activation="silu",
         attn_activation="silu",
         neighbor_embedding=True,
@@ -64,6 +83,9 @@ class TorchMD_T(nn.Module):
         cutoff_upper=5.0,
         max_z=100,
         max_num_neighbors=32,
+        neighbor_list="radius_graph",
+        adaptive_max_num_neighbors=False,
+        half_list=False,
     ):
         super(TorchMD_T, self).__init__()
 
@@ -90,6 +112,7 @@ class TorchMD_T(nn.Module):
         self.cutoff_lower = cutoff_lower
         self.cutoff_upper = cutoff_upper
         self.max_z = max_z
+        self.half_list = half_list
 
         act_class = act_class_mapping[activation]
         attn_act_class = act_class_mapping[attn_activation]
@@ -97,10 +120,20 @@ class TorchMD_T(nn.Module):
         self.embedding = nn.Embedding(self.max_z, hidden_channels)
 
         self.distance = Distance(
-            cutoff_lower, cutoff_upper, max_num_neighbors=max_num_neighbors, loop=True
+            cutoff_lower,
+            cutoff_upper,
+            max_num_neighbors=max_num_neighbors,
+            loop=True,
+            neighbor_list=neighbor_list,
+            adaptive_max_num_neighbors=adaptive_max_num_neighbors,
+            half_list=half_list,
         )
         self.distance_expansion = rbf_class_mapping[rbf_type](
-            cutoff_lower, cutoff_upper, num_rbf, trainable_rbf
+            cutoff_lower,
+            cutoff_upper,
+            num_rbf,
+            trainable_rbf,
+            table_size=rbf_table_size,
         )
         self.neighbor_embedding = (
             NeighborEmbedding(
@@ -137,17 +170,23 @@ class TorchMD_T(nn.Module):
             attn.reset_parameters()
         self.out_norm.reset_parameters()
 
-    def forward(self, z, pos, batch):
+    def forward(self, z, pos, batch, box: Optional[torch.Tensor] = None):
         x = self.embedding(z)
 
-        edge_index, edge_weight, _ = self.distance(pos, batch)
+        edge_index, edge_weight, _ = self.distance(pos, batch, box)
         edge_attr = self.distance_expansion(edge_weight)
 
+        half_index: Optional[torch.Tensor] = None
+        if self.half_list:
+            edge_index, half_index = symmetrize_half_list(edge_index)
+
         if self.neighbor_embedding is not None:
-            x = self.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr)
+            x = self.neighbor_embedding(
+                z, x, edge_index, edge_weight, edge_attr, half_index
+            )
 
         for attn in self.attention_layers:
-            x = x + attn(x, edge_index, edge_weight, edge_attr)
+            x = x + attn(x, edge_index, edge_weight, edge_attr, half_index)
         x = self.out_norm(x)
 
         return x, None, z, pos, batch
@@ -166,7 +205,8 @@ class TorchMD_T(nn.Module):
             f"num_heads={self.num_heads}, "
             f"distance_influence={self.distance_influence}, "
             f"cutoff_lower={self.cutoff_lower}, "
-            f"cutoff_upper={self.cutoff_upper})"
+            f"cutoff_upper={self.cutoff_upper}, "
+            f"half_list={self.half_list})"
         )
 
 
@@ -230,7 +270,14 @@ class MultiHeadAttention(MessagePassing):
             nn.init.xavier_uniform_(self.dv_proj.weight)
             self.dv_proj.bias.data.fill_(0)
 
-    def forward(self, x, edge_index, r_ij, f_ij):
+    def forward(
+        self,
+        x,
+        edge_index,
+        r_ij,
+        f_ij,
+        half_index: Optional[torch.Tensor] = None,
+    ):
         head_shape = (-1, self.num_heads, self.head_dim)
 
         x = self.layernorm(x)
@@ -249,6 +296,14 @@ class MultiHeadAttention(MessagePassing):
             else None
         )
 
+        if half_index is not None:
+            # distance terms are symmetric in the atom pair, share them between directions
+            r_ij = r_ij.index_select(0, half_index)
+            if dk is not None:
+                dk = dk.index_select(0, half_index)
+            if dv is not None:
+                dv = dv.index_select(0, half_index)
+
         # propagate_type: (q: Tensor, k: Tensor, v: Tensor, dk: Tensor, dv: Tensor, r_ij: Tensor)
         out = self.propagate(
             edge_index, q=q, k=k, v=v, dk=dk, dv=dv, r_ij=r_ij, size=None
@@ -1,9 +1,11 @@
 import math
+from typing import Optional, Tuple
 import torch
 from torch import nn
 import torch.nn.functional as F
 from torch_geometric.nn import MessagePassing
 from torch_cluster import radius_graph
+from torch_scatter import scatter
 
 
 def visualize_basis(basis_type, num_rbf=50, cutoff_lower=0, cutoff_upper=5):
@@ -54,16 +56,32 @@ class NeighborEmbedding(MessagePassing):
         self.distance_proj.bias.data.fill_(0)
         self.combine.bias.data.fill_(0)
 
-    def forward(self, z, x, edge_index, edge_weight, edge_attr):
+    def forward(
+        self,
+        z,
+        x,
+        edge_index,
+        edge_weight,
+        edge_attr,
+        half_index: Optional[torch.Tensor] = None,
+    ):
         # remove self loops
         mask = edge_index[0] != edge_index[1]
-        if not mask.all():
+        if half_index is not None:
+            # edge features are given once per pair, expand them to all edges
             edge_index = edge_index[:, mask]
-            edge_weight = edge_weight[mask]
-            edge_attr = edge_attr[mask]
+            C = self.cutoff(edge_weight)
+            W = (self.distance_proj(edge_attr) * C.view(-1, 1)).index_select(
+                0, half_index[mask]
+            )
+        else:
+            if not mask.all():
+                edge_index = edge_index[:, mask]
+                edge_weight = edge_weight[mask]
+                edge_attr = edge_attr[mask]
 
-        C = self.cutoff(edge_weight)
-        W = self.distance_proj(edge_attr) * C.view(-1, 1)
+            C = self.cutoff(edge_weight)
+            W = self.distance_proj(edge_attr) * C.view(-1, 1)
 
         x_neighbors = self.embedding(z)
         # propagate_type: (x: Tensor, W: Tensor)
@@ -75,13 +93,63 @@ class NeighborEmbedding(MessagePassing):
         return x_j * W
 
 
+def tabulate_expansion(expansion, cutoff_upper, table_size, device=None):
+    """Tabulates a fixed distance expansion on :obj:`table_size` equidistant points
+    in [0, cutoff_upper] as the coefficients of a piecewise cubic Hermite spline,
+    using the values and exact derivatives of the expansion at the points.
+    Returns a tensor of shape [table_size - 1, 4, num_rbf].
+    """
+    # in double precision to avoid cancellation in the coefficients
+    points = torch.linspace(
+        0, cutoff_upper, table_size, dtype=torch.float64, device=device
+    )
+    with torch.enable_grad():
+        values, derivs = torch.autograd.functional.jvp(
+            expansion, points, torch.ones_like(points)
+        )
+    values, derivs = values.detach(), derivs.detach() * (points[1] - points[0])
+    y0, y1, m0, m1 = values[:-1], values[1:], derivs[:-1], derivs[1:]
+    return torch.stack(
+        [y0, m0, 3 * (y1 - y0) - 2 * m0 - m1, 2 * (y0 - y1) + m0 + m1], dim=1
+    ).float()
+
+
+def interpolate_expansion(dist, table, cutoff_upper: float):
+    """Evaluates a table created by :func:`tabulate_expansion` at :obj:`dist`. The
+    result is differentiable with respect to :obj:`dist`.
+    """
+    t = dist * (table.size(0) / cutoff_upper)
+    idx = t.detach().floor().long().clamp(0, table.size(0) - 1)
+    u = (t - idx).unsqueeze(-1)
+    coeffs = table.index_select(0, idx.reshape(-1)).reshape(idx.shape + table.shape[1:])
+    return coeffs[..., 0, :] + u * (
+        coeffs[..., 1, :] + u * (coeffs[..., 2, :] + u * coeffs[..., 3, :])
+    )
+
+
 class GaussianSmearing(nn.Module):
-    def __init__(self, cutoff_lower=0.0, cutoff_upper=5.0, num_rbf=50, trainable=True):
+    """Gaussian distance expansion. If :obj:`table_size` is given, the expansion
+    is precomputed on that many points and evaluated by cubic interpolation,
+    which requires non-trainable parameters.
+    """
+
+    def __init__(
+        self,
+        cutoff_lower=0.0,
+        cutoff_upper=5.0,
+        num_rbf=50,
+        trainable=True,
+        table_size=None,
+    ):
         super(GaussianSmearing, self).__init__()
         self.cutoff_lower = cutoff_lower
         self.cutoff_upper = cutoff_upper
         self.num_rbf = num_rbf
         self.trainable = trainable
+        self.table_size = table_size or 0
+        assert not (
+            trainable and self.table_size > 0
+        ), "Tabulated distance expansions cannot be trainable."
 
         offset, coeff = self._initial_params()
         if trainable:
@@ -90,6 +158,8 @@ class GaussianSmearing(nn.Module):
         else:
             self.register_buffer("coeff", coeff)
             self.register_buffer("offset", offset)
+        self.register_buffer("table", torch.empty(0), persistent=False)
+        self.reset_table()
 
     def _initial_params(self):
         offset = torch.linspace(self.cutoff_lower, self.cutoff_upper, self.num_rbf)
@@ -100,19 +170,48 @@ class GaussianSmearing(nn.Module):
         offset, coeff = self._initial_params()
         self.offset.data.copy_(offset)
         self.coeff.data.copy_(coeff)
+        self.reset_table()
 
-    def forward(self, dist):
+    def reset_table(self):
+        if self.table_size > 0:
+            self.table = tabulate_expansion(
+                self.expand, self.cutoff_upper, self.table_size, self.offset.device
+            )
+
+    def expand(self, dist):
         dist = dist.unsqueeze(-1) - self.offset
         return torch.exp(self.coeff * torch.pow(dist, 2))
 
+    def forward(self, dist):
+        if self.table_size > 0:
+            return interpolate_expansion(dist, self.table, float(self.cutoff_upper))
+        return self.expand(dist)
+
 
 class ExpNormalSmearing(nn.Module):
-    def __init__(self, cutoff_lower=0.0, cutoff_upper=5.0, num_rbf=50, trainable=True):
+    """Exponential normal distance expansion (PhysNet), including a cosine cutoff.
+    If :obj:`table_size` is given, the expansion and the cutoff are precomputed on
+    that many points and evaluated together by cubic interpolation, which requires
+    non-trainable parameters.
+    """
+
+    def __init__(
+        self,
+        cutoff_lower=0.0,
+        cutoff_upper=5.0,
+        num_rbf=50,
+        trainable=True,
+        table_size=None,
+    ):
         super(ExpNormalSmearing, self).__init__()
         self.cutoff_lower = cutoff_lower
         self.cutoff_upper = cutoff_upper
         self.num_rbf = num_rbf
         self.trainable = trainable
+        self.table_size = table_size or 0
+        assert not (
+            trainable and self.table_size > 0
+        ), "Tabulated distance expansions cannot be trainable."
 
         self.cutoff_fn = CosineCutoff(0, cutoff_upper)
         self.alpha = 5.0 / (cutoff_upper - cutoff_lower)
@@ -124,6 +223,8 @@ class ExpNormalSmearing(nn.Module):
         else:
             self.register_buffer("means", means)
             self.register_buffer("betas", betas)
+        self.register_buffer("table", torch.empty(0), persistent=False)
+        self.reset_table()
 
     def _initial_params(self):
         # initialize means and betas according to the default values in PhysNet
@@ -141,14 +242,26 @@ class ExpNormalSmearing(nn.Module):
         means, betas = self._initial_params()
         self.means.data.copy_(means)
         self.betas.data.copy_(betas)
+        self.reset_table()
 
-    def forward(self, dist):
+    def reset_table(self):
+        if self.table_size > 0:
+            self.table = tabulate_expansion(
+                self.expand, self.cutoff_upper, self.table_size, self.means.device
+            )
+
+    def expand(self, dist):
         dist = dist.unsqueeze(-1)
         return self.cutoff_fn(dist) * torch.exp(
             -self.betas
             * (torch.exp(self.alpha * (-dist + self.cutoff_lower)) - self.means) ** 2
         )
 
+    def forward(self, dist):
+        if self.table_size > 0:
+            return interpolate_expansion(dist, self.table, float(self.cutoff_upper))
+        return self.expand(dist)
+
 
 class ShiftedSoftplus(nn.Module):
     def __init__(self):
@@ -190,7 +303,215 @@ class CosineCutoff(nn.Module):
             return cutoffs
 
 
+def minimum_image(vec: torch.Tensor, box: torch.Tensor) -> torch.Tensor:
+    r"""Wraps distance vectors to their nearest periodic image.
+
+    The box vectors are the rows of :obj:`box` and have to be given in reduced
+    lower-triangular form as used by OpenMM, i.e. :math:`a = (a_x, 0, 0)`,
+    :math:`b = (b_x, b_y, 0)` and :math:`c = (c_x, c_y, c_z)` with
+    :math:`a_x \geq 2 |b_x|`, :math:`a_x \geq 2 |c_x|` and :math:`b_y \geq 2 |c_y|`.
+    Orthorhombic boxes are diagonal. The result is exact for distances up to half
+    of the smallest box width.
+
+    Args:
+        vec (Tensor): Distance vectors with shape :obj:`[E, 3]`.
+        box (Tensor): Box vectors with shape :obj:`[E, 3, 3]` or :obj:`[1, 3, 3]`.
+    """
+    vec = vec - box[:, 2] * torch.round(vec[:, 2:3] / box[:, 2, 2:3])
+    vec = vec - box[:, 1] * torch.round(vec[:, 1:2] / box[:, 1, 1:2])
+    vec = vec - box[:, 0] * torch.round(vec[:, 0:1] / box[:, 0, 0:1])
+    return vec
+
+
+def cell_list_graph(
+    pos: torch.Tensor,
+    r: float,
+    batch: Optional[torch.Tensor] = None,
+    loop: bool = False,
+    max_num_neighbors: int = 32,
+    box: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    r"""Computes graph edges to all points within a given distance using a
+    linked-cell list. Atoms are binned into cells of side length at least
+    :obj:`r`, so only the 27 surrounding cells have to be searched for each atom
+    and the cost grows linearly with the number of atoms. Drop-in replacement for
+    :obj:`torch_cluster.radius_graph` with the same output convention:
+    :obj:`edge_index[1]` holds the central atoms and :obj:`edge_index[0]` their
+    neighbors, of which at most :obj:`max_num_neighbors` are kept per atom.
+
+    If :obj:`box` is given, the samples are treated as periodic and atoms are
+    connected to the nearest image of their neighbors (see :func:`minimum_image`).
+    The cutoff must not exceed half of the smallest box width, otherwise a
+    :obj:`ValueError` is raised.
+
+    Args:
+        pos (Tensor): Atomic positions with shape :obj:`[N, 3]`.
+        r (float): The cutoff radius.
+        batch (Tensor, optional): Sample index of each atom. Atoms in different
+            samples are never connected. (default: :obj:`None`)
+        loop (bool, optional): Whether to include self loops.
+            (default: :obj:`False`)
+        max_num_neighbors (int, optional): Maximum number of neighbors per atom.
+            (default: :obj:`32`)
+        box (Tensor, optional): Periodic box vectors of each sample with shape
+            :obj:`[num_samples, 3, 3]`, or :obj:`[3, 3]` if all samples share the
+            same box. (default: :obj:`None`)
+    """
+    num_atoms = pos.size(0)
+    if batch is None:
+        batch = torch.zeros(num_atoms, dtype=torch.long, device=pos.device)
+    if num_atoms == 0:
+        return torch.zeros(2, 0, dtype=torch.long, device=pos.device)
+    pos = pos.detach()
+
+    if box is None:
+        # bin atoms into cells relative to the lower corner of their sample
+        lower = scatter(pos, batch, dim=0, reduce="min")
+        cell = torch.floor((pos - lower[batch]) / r).long()
+        dims = scatter(cell, batch, dim=0, reduce="max") + 1
+    else:
+        box = box.detach().to(pos.dtype).view(-1, 3, 3)
+        inv_box = torch.inverse(box)
+        if box.size(0) > 1:
+            frac = torch.bmm(pos.unsqueeze(1), inv_box[batch]).squeeze(1)
+        else:
+            frac = pos @ inv_box[0]
+        # bin fractional coordinates into a grid whose cells are at least r wide
+        # along every box vector, wrapping atoms back into the box
+        frac = frac - torch.floor(frac)
+        # the width along each box vector is the volume over the opposite face area
+        face = torch.cross(box.roll(-1, dims=1), box.roll(-2, dims=1), dim=-1)
+        widths = torch.det(box).abs().unsqueeze(1) / face.pow(2).sum(dim=-1).sqrt()
+        if bool((widths < 2 * r).any()):
+            # beyond half of the box width the nearest image is not unique
+            raise ValueError(
+                "The cutoff must not exceed half of the smallest box width."
+            )
+        dims = torch.floor(widths / r).long().clamp(min=1)
+        if box.size(0) == 1:
+            dims = dims.expand(int(batch.max()) + 1, 3)
+        cell = torch.minimum(torch.floor(frac * dims[batch]).long(), dims[batch] - 1)
+
+    # cells are numbered consecutively within each sample, samples one after another
+    num_cells = dims.prod(dim=-1)
+    sample_offset = torch.cumsum(num_cells, dim=0) - num_cells
+    strides = torch.stack(
+        [dims[:, 1] * dims[:, 2], dims[:, 2], torch.ones_like(dims[:, 2])], dim=-1
+    )
+
+    key = sample_offset[batch] + (cell * strides[batch]).sum(dim=-1)
+    key, order = torch.sort(key)
+    cell_keys, cell_counts = torch.unique_consecutive(key, return_counts=True)
+    cell_starts = torch.cumsum(cell_counts, dim=0) - cell_counts
+
+    # work in cell order from here on, which keeps neighboring atoms close in memory
+    pos = pos[order]
+    cell = cell[order]
+    batch = batch[order]
+
+    # look up the 27 cells surrounding each atom
+    shift = torch.arange(-1, 2, device=pos.device)
+    stencil = torch.cartesian_prod(shift, shift, shift).unsqueeze(0)
+    atom_dims = dims[batch].unsqueeze(1)
+    neighbor_cell = cell.unsqueeze(1) + stencil
+    if box is None:
+        valid = ((neighbor_cell >= 0) & (neighbor_cell < atom_dims)).all(dim=-1)
+    else:
+        # with fewer than three cells along a box vector, some of the shifted
+        # cells coincide after wrapping and must only be visited once
+        valid = (
+            ((stencil >= 0) | (atom_dims > 2)) & ((stencil <= 0) | (atom_dims > 1))
+        ).all(dim=-1)
+        neighbor_cell = torch.remainder(neighbor_cell, atom_dims)
+    neighbor_key = sample_offset[batch].unsqueeze(1) + (
+        neighbor_cell * strides[batch].unsqueeze(1)
+    ).sum(dim=-1)
+    slot = torch.searchsorted(cell_keys, neighbor_key.view(-1)).view_as(neighbor_key)
+    slot = slot.clamp(max=cell_keys.size(0) - 1)
+    valid = valid & (cell_keys[slot] == neighbor_key)
+    count = torch.where(valid, cell_counts[slot], torch.zeros_like(slot)).view(-1)
+
+    # expand (atom, cell) pairs into candidate atom pairs
+    i = torch.arange(num_atoms, device=pos.device).repeat_interleave(27)
+    i = i.repeat_interleave(count)
+    j = torch.arange(i.size(0), device=pos.device) + (
+        cell_starts[slot].view(-1) - torch.cumsum(count, dim=0) + count
+    ).repeat_interleave(count)
+
+    vec = pos.index_select(0, j) - pos.index_select(0, i)
+    if box is not None:
+        if box.size(0) > 1:
+            vec = minimum_image(vec, box[batch.index_select(0, i)])
+        else:
+            vec = minimum_image(vec, box)
+    mask = vec.pow(2).sum(dim=-1) < r * r
+    if not loop:
+        mask = mask & (i != j)
+    i, j = i[mask], j[mask]
+
+    # candidates are grouped by the central atom, keep the first max_num_neighbors
+    degree = torch.bincount(i, minlength=num_atoms)
+    rank = torch.arange(i.size(0), device=pos.device) - (
+        torch.cumsum(degree, dim=0) - degree
+    ).index_select(0, i)
+    keep = rank < max_num_neighbors
+    return torch.stack([order[j[keep]], order[i[keep]]], dim=0)
+
+
+def symmetrize_half_list(
+    edge_index: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    r"""Expands a half neighbor list, which holds every pair of atoms once, into
+    the full list of directed edges. Self loops are kept once.
+
+    Returns the full edge index and, for every full edge, the position of its pair
+    in the half list. Pair-symmetric edge features, such as distance expansions and
+    filters, can thus be computed once per pair and gathered for both directions.
+
+    Args:
+        edge_index (Tensor): Half neighbor list with shape :obj:`[2, E]`.
+    """
+    pair = torch.arange(edge_index.size(1), device=edge_index.device)
+    mirror = edge_index[0] != edge_index[1]
+    edge_index = torch.cat([edge_index, edge_index.flip(0)[:, mirror]], dim=1)
+    return edge_index, torch.cat([pair, pair[mirror]])
+
+
 class Distance(nn.Module):
+    r"""Computes the graph edges, interatomic distances and, optionally, distance
+    vectors for all atom pairs within the cutoff.
+
+    With :obj:`skin > 0`, the module keeps a Verlet neighbor list: the graph is
+    built with radius :obj:`cutoff_upper + skin` and reused on subsequent calls
+    until some atom has moved more than :obj:`skin / 2` from its position at the
+    last rebuild. In between, only distances are recomputed and filtered by the
+    cutoff. This is meant for MD where consecutive calls see slightly moved
+    coordinates of the same system. Note that :obj:`max_num_neighbors` then
+    applies to the larger buffered radius.
+
+    If periodic box vectors are passed to :meth:`forward`, neighbors are searched
+    with the periodic cell list regardless of :obj:`neighbor_list` and the distance
+    vectors point to the nearest image (see :func:`minimum_image`).
+
+    Whenever the graph is built, :obj:`num_truncated` is set to the number of atoms
+    whose neighbor count reached :obj:`max_num_neighbors`, i.e. atoms that may have
+    lost neighbors to the cap. With :obj:`adaptive_max_num_neighbors`, the cap is
+    doubled and the graph rebuilt until no atom reaches it. The grown cap is kept
+    for later calls, so it settles at a size that fits the data, and is stored in
+    the state dict.
+
+    With :obj:`half_list`, only edges from lower to higher atom indices (and self
+    loops) are returned, i.e. every pair once. Use :func:`symmetrize_half_list` to
+    recover the full list. Pairs are selected after :obj:`max_num_neighbors` has
+    been applied, so results only match the full list without truncation.
+    """
+
+    num_truncated: Optional[torch.Tensor]
+    verlet_pos: Optional[torch.Tensor]
+    verlet_batch: Optional[torch.Tensor]
+    verlet_box: Optional[torch.Tensor]
+    verlet_edge_index: Optional[torch.Tensor]
+
     def __init__(
         self,
         cutoff_lower,
@@ -198,23 +519,141 @@ class Distance(nn.Module):
         max_num_neighbors=32,
         return_vecs=False,
         loop=False,
+        neighbor_list="radius_graph",
+        skin=0.0,
+        adaptive_max_num_neighbors=False,
+        half_list=False,
     ):
         super(Distance, self).__init__()
+        assert neighbor_list in neighbor_list_options, (
+            f'Unknown neighbor list "{neighbor_list}". '
+            f'Choose from {", ".join(neighbor_list_options)}.'
+        )
         self.cutoff_lower = cutoff_lower
         self.cutoff_upper = cutoff_upper
         self.max_num_neighbors = max_num_neighbors
         self.return_vecs = return_vecs
         self.loop = loop
+        self.neighbor_list = neighbor_list
+        self.skin = float(skin)
+        self.adaptive_max_num_neighbors = adaptive_max_num_neighbors
+        self.half_list = half_list
+        self.num_truncated = None
+        # the grown cap is saved with adaptive_max_num_neighbors, so that reloaded
+        # models do not have to grow it again
+        self.register_buffer(
+            "grown_max_num_neighbors",
+            torch.tensor(max_num_neighbors),
+            persistent=adaptive_max_num_neighbors,
+        )
+        self.reset_verlet_list()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        super(Distance, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self.max_num_neighbors = int(self.grown_max_num_neighbors)
 
-    def forward(self, pos, batch):
-        edge_index = radius_graph(
+    def reset_verlet_list(self):
+        self.verlet_pos = None
+        self.verlet_batch = None
+        self.verlet_box = None
+        self.verlet_edge_index = None
+
+    def build_graph(
+        self,
+        pos,
+        batch: Optional[torch.Tensor],
+        r: float,
+        box: Optional[torch.Tensor] = None,
+    ):
+        if box is not None or self.neighbor_list == "cell_list":
+            return cell_list_graph(
+                pos,
+                r=r,
+                batch=batch,
+                loop=self.loop,
+                max_num_neighbors=self.max_num_neighbors,
+                box=box,
+            )
+        return radius_graph(
             pos,
-            r=self.cutoff_upper,
+            r=r,
             batch=batch,
             loop=self.loop,
             max_num_neighbors=self.max_num_neighbors,
         )
+
+    def neighbors(
+        self,
+        pos,
+        batch: Optional[torch.Tensor],
+        r: float,
+        box: Optional[torch.Tensor] = None,
+    ):
+        edge_index = self.build_graph(pos, batch, r, box)
+        degree = torch.bincount(edge_index[1], minlength=pos.size(0))
+        num_truncated = (degree >= self.max_num_neighbors).sum()
+        while self.adaptive_max_num_neighbors and bool(num_truncated > 0):
+            # grow the cap geometrically so that rebuilds stay rare
+            self.max_num_neighbors *= 2
+            self.grown_max_num_neighbors.fill_(self.max_num_neighbors)
+            edge_index = self.build_graph(pos, batch, r, box)
+            degree = torch.bincount(edge_index[1], minlength=pos.size(0))
+            num_truncated = (degree >= self.max_num_neighbors).sum()
+        self.num_truncated = num_truncated
+        if self.half_list:
+            edge_index = edge_index[:, edge_index[0] <= edge_index[1]]
+        return edge_index
+
+    def verlet_neighbors(
+        self, pos, batch: Optional[torch.Tensor], box: Optional[torch.Tensor] = None
+    ):
+        pos = pos.detach()
+        ref_pos = self.verlet_pos
+        ref_batch = self.verlet_batch
+        ref_box = self.verlet_box
+        edge_index = self.verlet_edge_index
+        if (
+            ref_pos is None
+            or edge_index is None
+            or ref_pos.shape != pos.shape
+            or (ref_batch is None) != (batch is None)
+            or (
+                ref_batch is not None
+                and batch is not None
+                and not torch.equal(ref_batch, batch)
+            )
+            or (ref_box is None) != (box is None)
+            or (
+                ref_box is not None
+                and box is not None
+                and not torch.equal(ref_box, box)
+            )
+            or bool(((pos - ref_pos) ** 2).sum(dim=-1).max() > (0.5 * self.skin) ** 2)
+        ):
+            edge_index = self.neighbors(pos, batch, self.cutoff_upper + self.skin, box)
+            self.verlet_pos = pos.clone()
+            self.verlet_batch = batch
+            self.verlet_box = None if box is None else box.detach().clone()
+            self.verlet_edge_index = edge_index
+        return edge_index
+
+    def forward(
+        self,
+        pos,
+        batch: Optional[torch.Tensor] = None,
+        box: Optional[torch.Tensor] = None,
+    ):
+        if self.skin > 0:
+            edge_index = self.verlet_neighbors(pos, batch, box)
+        else:
+            edge_index = self.neighbors(pos, batch, self.cutoff_upper, box)
         edge_vec = pos[edge_index[0]] - pos[edge_index[1]]
+        if box is not None:
+            box = box.to(pos.dtype).view(-1, 3, 3)
+            if box.size(0) > 1:
+                assert batch is not None, "Per-sample boxes require a batch vector."
+                box = box[batch[edge_index[1]]]
+            edge_vec = minimum_image(edge_vec, box)
 
         if self.loop:
             # mask out self loops when computing distances because
@@ -226,12 +665,15 @@ class Distance(nn.Module):
         else:
             edge_weight = torch.norm(edge_vec, dim=-1)
 
-        lower_mask = edge_weight >= self.cutoff_lower
-        edge_index = edge_index[:, lower_mask]
-        edge_weight = edge_weight[lower_mask]
+        mask = edge_weight >= self.cutoff_lower
+        if self.skin > 0:
+            # drop the pairs that are only within the buffer region
+            mask = mask & (edge_weight < self.cutoff_upper)
+        edge_index = edge_index[:, mask]
+        edge_weight = edge_weight[mask]
 
         if self.return_vecs:
-            edge_vec = edge_vec[lower_mask]
+            edge_vec = edge_vec[mask]
             return edge_index, edge_weight, edge_vec
         # TODO: return only `edge_index` and `edge_weight` once
         # Union typing works with TorchScript (https://github.com/pytorch/pytorch/pull/53180)
@@ -292,6 +734,8 @@ class GatedEquivariantBlock(nn.Module):
 
 rbf_class_mapping = {"gauss": GaussianSmearing, "expnorm": ExpNormalSmearing}
 
+neighbor_list_options = ["radius_graph", "cell_list"]
+
 act_class_mapping = {
     "ssp": ShiftedSoftplus,
     "silu": nn.SiLU,
@@ -6,7 +6,7 @@ class BaseWrapper(nn.Module, metaclass=ABCMeta):
     r"""Base class for model wrappers.
 
     Children of this class should implement the `forward` method,
-    which calls `self.model(z, pos, batch=batch)` at some point.
+    which calls `self.model(z, pos, batch=batch, box=box)` at some point.
     Wrappers that are applied before the REDUCE operation should return
     the model's output, `z`, `pos`, `batch` and potentially vector
     features`v`. Wrappers that are applied after REDUCE should only
@@ -21,7 +21,7 @@ class BaseWrapper(nn.Module, metaclass=ABCMeta):
         self.model.reset_parameters()
 
     @abstractmethod
-    def forward(self, z, pos, batch=None):
+    def forward(self, z, pos, batch=None, box=None):
         return
 
 
@@ -30,8 +30,8 @@ class AtomFilter(BaseWrapper):
         super(AtomFilter, self).__init__(model)
         self.remove_threshold = remove_threshold
 
-    def forward(self, z, pos, batch=None):
-        x, v, z, pos, batch = self.model(z, pos, batch=batch)
+    def forward(self, z, pos, batch=None, box=None):
+        x, v, z, pos, batch = self.model(z, pos, batch=batch, box=box)
 
         n_samples = len(batch.unique())
 
@@ -5,6 +5,7 @@ from torch.nn.functional import mse_loss, l1_loss
 
 from pytorch_lightning import LightningModule
 from torchmdnet.models.model import create_model, load_model
+from torchmdnet.models.utils import Distance
 
 
 class LNNP(LightningModule):
@@ -19,6 +20,9 @@ class LNNP(LightningModule):
         else:
             self.model = create_model(self.hparams, prior_model, mean, std)
 
+        # neighbor list modules, which report atoms truncated at max_num_neighbors
+        self.distances = [m for m in self.model.modules() if isinstance(m, Distance)]
+
         # initialize exponential smoothing
         self.ema = None
         self._reset_ema_dict()
@@ -80,6 +84,14 @@ class LNNP(LightningModule):
             # Union typing works under TorchScript (https://github.com/pytorch/pytorch/pull/53180)
             pred, noise_pred, deriv = self(batch.z, batch.pos, batch.batch)
 
+        num_truncated = [d.num_truncated for d in self.distances if d.num_truncated is not None]
+        if len(num_truncated) > 0:
+            num_truncated = torch.stack(num_truncated).sum().float()
+            self.losses[stage + "_num_truncated"].append(num_truncated)
+            if stage != "train":
+                # training metrics, including this one, are logged per step below
+                self.log(stage + "_num_truncated_per_step", num_truncated, on_step=True, on_epoch=False, sync_dist=True)
+
         denoising_is_on = ("pos_target" in batch) and (self.hparams.denoising_weight > 0) and (noise_pred is not None)
 
         loss_y, loss_dy, loss_pos = 0, 0, 0
@@ -238,6 +250,13 @@ class LNNP(LightningModule):
                     self.losses["test_pos"]
                 ).mean()
 
+            # log the average number of atoms per batch that reached max_num_neighbors
+            for stage in ["train", "val", "test"]:
+                if len(self.losses[stage + "_num_truncated"]) > 0:
+                    result_dict[stage + "_num_truncated"] = torch.stack(
+                        self.losses[stage + "_num_truncated"]
+                    ).mean()
+
             self.log_dict(result_dict, sync_dist=True)
         self._reset_losses_dict()
 
@@ -255,6 +274,9 @@ class LNNP(LightningModule):
             "train_pos": [],
             "val_pos": [],
             "test_pos": [],
+            "train_num_truncated": [],
+            "val_num_truncated": [],
+            "test_num_truncated": [],
         }
 
     def _reset_ema_dict(self):
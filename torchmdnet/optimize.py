@@ -1,27 +1,64 @@
+from typing import Optional
+import warnings
 import torch as pt
-from NNPOps.CFConv import CFConv
-from NNPOps.CFConvNeighbors import CFConvNeighbors
+
+try:
+    from NNPOps.CFConv import CFConv
+    from NNPOps.CFConvNeighbors import CFConvNeighbors
+    has_nnpops = True
+except ImportError:
+    has_nnpops = False
 
 from .models.model import TorchMD_Net
 from .models.torchmd_gn import TorchMD_GN
+from .models.wrappers import BaseWrapper
+from .models.utils import symmetrize_half_list, ShiftedSoftplus
+
+# activations of the filter networks that the NNPOps CFConv kernel implements
+nnpops_activations = {ShiftedSoftplus: 'ssp', pt.nn.Tanh: 'tanh'}
+
+
+def unsupported_reason(model):
+    '''Returns why none of the layers of a representation model can use the NNPOps
+    kernels or None if at least some of them can.'''
+    if not has_nnpops:
+        return 'NNPOps is not installed'
+    if not isinstance(model, TorchMD_GN):
+        return f'NNPOps has no kernels for the layers of {model.__class__.__name__}'
+    if model.rbf_type != 'gauss':
+        return 'only rbf_type="gauss" is supported'
+    if model.trainable_rbf:
+        return 'trainable_rbf=True is not supported'
+    if model.cutoff_lower != 0.0:
+        return 'only cutoff_lower=0.0 is supported'
+    if model.aggr != 'add':
+        return 'only aggr="add" is supported'
+    if all(nnpops_activation(inter) is None for inter in model.interactions):
+        return 'only activation="ssp" and activation="tanh" are supported'
+    return None
+
+
+def nnpops_activation(interaction):
+    '''Returns the NNPOps name of the filter network activation of an interaction
+    block or None if NNPOps does not implement it.'''
+    return nnpops_activations.get(type(interaction.mlp[1]))
 
 
 class TorchMD_GN_optimized(pt.nn.Module):
+    '''TorchMD_GN with the interactions computed by the NNPOps CFConv kernels.
+
+    Interaction blocks whose filter network activation NNPOps does not implement
+    keep their original implementation, as do the embedding layers. The NNPOps
+    neighbor list covers all atoms of one molecule, so batches of several
+    molecules would need one kernel call per molecule and layer. They are
+    evaluated by the original model instead, as are periodic boxes.
+    '''
 
     def __init__(self, model):
 
-        if model.rbf_type != 'gauss':
-            raise ValueError('Only rbf_type="gauss" is supproted')
-        if model.trainable_rbf:
-            raise ValueError('trainalbe_rbf=True is not supported')
-        if model.activation != 'ssp':
-            raise ValueError('Only activation="ssp" is supported')
-        if model.neighbor_embedding:
-            raise ValueError('neighbor_embedding=True is not supported')
-        if model.cutoff_lower != 0.0:
-            raise ValueError('Only lower_cutoff=0.0 is supported')
-        if model.aggr != 'add':
-            raise ValueError('Only aggr="add" is supported')
+        reason = unsupported_reason(model)
+        if reason is not None:
+            raise ValueError(reason)
 
         super().__init__()
         self.model = model
@@ -30,19 +67,39 @@ class TorchMD_GN_optimized(pt.nn.Module):
 
         offset = self.model.distance_expansion.offset
         width = offset[1] - offset[0]
-        self.convs = [CFConv(gaussianWidth=width, activation='ssp',
+        self.convs = [CFConv(gaussianWidth=width, activation=nnpops_activation(inter),
                              weights1=inter.mlp[0].weight.T, biases1=inter.mlp[0].bias,
                              weights2=inter.mlp[2].weight.T, biases2=inter.mlp[2].bias)
+                      if nnpops_activation(inter) is not None else None
                       for inter in self.model.interactions]
 
-    def forward(self, z, pos, batch):
+    def forward(self, z, pos, batch, box: Optional[pt.Tensor] = None):
 
-        assert pt.all(batch == 0)
+        if box is not None or bool((batch != batch[0]).any()):
+            # the NNPOps neighbor list is neither periodic nor batched
+            return self.model(z, pos, batch, box)
 
         x = self.model.embedding(z)
 
+        edge_index: Optional[pt.Tensor] = None
+        edge_weight: Optional[pt.Tensor] = None
+        edge_attr: Optional[pt.Tensor] = None
+        half_index: Optional[pt.Tensor] = None
+        if self.model.neighbor_embedding is not None or None in self.convs:
+            # the graph of the original layers
+            edge_index, edge_weight, _ = self.model.distance(pos, batch, box)
+            edge_attr = self.model.distance_expansion(edge_weight)
+            if self.model.half_list:
+                edge_index, half_index = symmetrize_half_list(edge_index)
+
+        if self.model.neighbor_embedding is not None:
+            x = self.model.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr, half_index)
+
         self.neighbors.build(pos)
         for inter, conv in zip(self.model.interactions, self.convs):
+            if conv is None:
+                x = x + inter(x, edge_index, edge_weight, edge_attr, half_index)
+                continue
             y = inter.conv.lin1(x)
             y = conv(self.neighbors, pos, y)
             y = inter.conv.lin2(y)
@@ -56,12 +113,32 @@ class TorchMD_GN_optimized(pt.nn.Module):
 
 
 def optimize(model):
+    '''Replaces the representation model of a TorchMD_Net with its optimized
+    version, in which the layers supported by the optimized kernels use them and
+    the other layers keep their original implementation. If no layer is
+    supported, the model is left unchanged and a warning is issued.'''
 
     assert isinstance(model, TorchMD_Net)
 
-    if isinstance(model.representation_model, TorchMD_GN):
-        model.representation_model = TorchMD_GN_optimized(model.representation_model)
-    else:
-        raise ValueError('Unsupported model! Only TorchMD_GN is suppored.')
+    model.representation_model = _optimize_representation(model.representation_model)
+
+    return model
+
+
+def _optimize_representation(model):
+
+    if isinstance(model, BaseWrapper):
+        model.model = _optimize_representation(model.model)
+        return model
+
+    reason = unsupported_reason(model)
+    if reason is not None:
+        warnings.warn(f'Model is not optimized: {reason}.')
+        return model
 
-    return model
\ No newline at end of file
+    optimized = TorchMD_GN_optimized(model)
+    unsupported = [i for i, conv in enumerate(optimized.convs) if conv is None]
+    if len(unsupported) > 0:
+        warnings.warn(f'Interaction blocks {unsupported} are not optimized: only '
+                      'activation="ssp" and activation="tanh" are supported.')
+    return optimized
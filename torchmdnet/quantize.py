@@ -0,0 +1,94 @@
+"""Dynamic int8 quantization of trained models for CPU inference.
+
+Only linear layers acting on scalar (invariant) features are quantized. Layers
+applied to vector features (`vec_proj` of the equivariant attention layers and
+`vec1_proj`/`vec2_proj` of the gated equivariant blocks) stay in float32, because
+the per-tensor rounding of their inputs would mix the Cartesian components and
+break equivariance. The edge-level distance projections (`dk_proj`, `dv_proj`)
+are kept as well, their weights are read directly when the projections of all
+layers are fused.
+"""
+
+import time
+import torch
+from torch import nn
+from torch.quantization import quantize_dynamic
+from torchmdnet.models.torchmd_et import TorchMD_ET
+
+quantize_modes = ["dynamic-int8"]
+
+excluded_linears = ["vec_proj", "vec1_proj", "vec2_proj", "dk_proj", "dv_proj"]
+
+
+def quantizable_linears(model):
+    """Returns the names of the linear layers of :obj:`model` that are quantized."""
+    excluded = set()
+    for module in model.modules():
+        if isinstance(module, TorchMD_ET) and len(module.attention_layers) > 0:
+            # the first attention layer slices the weight of o_proj
+            excluded.add(module.attention_layers[0].o_proj)
+    return {
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear)
+        and name.split(".")[-1] not in excluded_linears
+        and module not in excluded
+    }
+
+
+def quantize_model(model, mode="dynamic-int8"):
+    """Quantizes the scalar linear layers of :obj:`model` in place. Dynamically
+    quantized layers cannot be differentiated with respect to their input, so
+    models predicting forces are not supported.
+    """
+    if mode not in quantize_modes:
+        raise ValueError(
+            f"Unknown quantization mode {mode}, choose from {', '.join(quantize_modes)}."
+        )
+    if model.derivative:
+        raise ValueError(
+            "Forces cannot be computed through dynamically quantized layers, "
+            "quantization requires derivative=False."
+        )
+    return quantize_dynamic(
+        model, quantizable_linears(model), dtype=torch.qint8, inplace=True
+    )
+
+
+@torch.no_grad()
+def quantization_report(reference, quantized, loader, num_repeats=1):
+    """Compares the predictions and the throughput of :obj:`quantized` with
+    those of the float32 model :obj:`reference` on the batches of :obj:`loader`.
+
+    Returns a dictionary with the mean absolute errors of both models with
+    respect to the targets `y` (if present), the mean and maximum absolute
+    deviation of the quantized from the float32 predictions and the number of
+    samples per second of both models.
+    """
+    reference.eval()
+    quantized.eval()
+    batches = list(loader)
+    num_samples = sum(batch.num_graphs for batch in batches)
+
+    def evaluate(model):
+        start = time.perf_counter()
+        for _ in range(num_repeats):
+            preds = [model(batch.z, batch.pos, batch.batch)[0] for batch in batches]
+        return torch.cat(preds), time.perf_counter() - start
+
+    ref_pred, ref_time = evaluate(reference)
+    pred, time_ = evaluate(quantized)
+
+    deviation = (pred - ref_pred).abs()
+    report = dict(
+        num_samples=num_samples,
+        mean_deviation=deviation.mean().item(),
+        max_deviation=deviation.max().item(),
+        fp32_samples_per_second=num_samples * num_repeats / ref_time,
+        int8_samples_per_second=num_samples * num_repeats / time_,
+    )
+    if all("y" in batch for batch in batches):
+        y = torch.cat([batch.y for batch in batches]).view_as(ref_pred)
+        report["fp32_mae"] = (ref_pred - y).abs().mean().item()
+        report["int8_mae"] = (pred - y).abs().mean().item()
+    return report
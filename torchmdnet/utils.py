@@ -153,5 +153,42 @@ def number(text):
     return num_float
 
 
+class RunningStats:
+    """Mean and standard deviation of values that arrive in batches, combined with
+    the parallel formulation of Welford's algorithm (Chan et al., 1979) instead of
+    keeping all values in memory. Statistics are taken over the first dimension.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._mean = None
+        self._m2 = None
+
+    def update(self, values):
+        values = torch.as_tensor(values, dtype=torch.float64)
+        count = values.size(0)
+        if count == 0:
+            return
+        mean = values.mean(dim=0)
+        m2 = ((values - mean) ** 2).sum(dim=0)
+        if self.count == 0:
+            self._mean, self._m2 = mean, m2
+        else:
+            total = self.count + count
+            delta = mean - self._mean
+            self._mean = self._mean + delta * count / total
+            self._m2 = self._m2 + m2 + delta**2 * self.count * count / total
+        self.count += count
+
+    @property
+    def mean(self):
+        return self._mean.float()
+
+    @property
+    def std(self):
+        # unbiased, like torch.std
+        return (self._m2 / (self.count - 1)).sqrt().float()
+
+
 class MissingEnergyException(Exception):
     pass